@@ -1,16 +1,21 @@
 from flask import (
-    Blueprint, render_template, request, url_for, redirect, current_app
+    Blueprint, render_template, request, url_for, redirect, current_app, Response,
+    stream_with_context, make_response
 )
 from werkzeug.exceptions import abort
 import database
 import json
+import csv
+import io
 from hashlib import sha256
 from users import UserContext
 from events import Event
 import datetime
 from ledger import TransactionLedger
 from credits import Credits
-from smart_contract import SmartContract
+from smart_contract import SmartContractRepository
+from token_issuance import TokenIssuance
+from command_queue import CommandQueue
 from charting import Charting
 from mailer import Mailer
 import re
@@ -25,6 +30,13 @@ admin_blueprint = Blueprint('admin', __name__, url_prefix="/admin")
 
 PAGE_LIMIT = 20
 MOVING_AVERAGE_WINDOW = 100
+# token export format -> mimetype
+TOKEN_EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+TOKEN_EXPORT_COLUMNS = ["serial", "eth_address", "owner_id", "issued", "created"]
+# the session token is in the URL, browsers keep the page to themselves and revalidate it on every view
+VIEW_SOURCE_CACHE_CONTROL = "private, no-cache"
+# part of the view source ETag with the source hash, bump it when view_smart_contract.html changes
+VIEW_SOURCE_TEMPLATE_VERSION = "1"
 
 
 @admin_blueprint.route('/')
@@ -307,6 +319,36 @@ def eth_network_admin(session_token):
     abort(403)
 
 
+@admin_blueprint.route('/command_queue/<session_token>')
+def admin_command_queue(session_token):
+    db = database.Database(logger=current_app.logger)
+    user_id = db.validate_session(session_token)
+    if user_id:
+        authorized = db.validate_permission(user_id, "ethereum-network")
+        if authorized:
+            metrics = CommandQueue(db, current_app.logger).queue_metrics()
+            if metrics is None:
+                abort(500)
+            return render_template("admin/admin_command_queue.jinja2",
+                                   session_token=session_token,
+                                   metrics=metrics)
+    abort(403)
+
+
+@admin_blueprint.route('/command_queue/json/<session_token>')
+def admin_command_queue_json(session_token):
+    db = database.Database(logger=current_app.logger)
+    user_id = db.validate_session(session_token)
+    if user_id:
+        authorized = db.validate_permission(user_id, "ethereum-network")
+        if authorized:
+            metrics = CommandQueue(db, current_app.logger).queue_metrics()
+            if metrics is None:
+                abort(500)
+            return Response(json.dumps(metrics), mimetype="application/json")
+    abort(403)
+
+
 @admin_blueprint.route('/users/create/<session_token>')
 def admin_create_user(session_token):
     db = database.Database(current_app.logger)
@@ -329,26 +371,29 @@ def admin_create_user(session_token):
     abort(403)
 
 
-def get_owned_tokens(user_id, db, logger=None):
-    smart_contracts = db.get_smart_contracts(user_id)
+def get_owned_tokens(user_id, db, logger=None, managed_ids=()):
+    contracts = SmartContractRepository(db, logger)
+    smart_contracts = contracts.list_for_user(user_id, managed_ids) or []
+    smart_contract_ids = [each["token_id"] for each in smart_contracts]
+    token_supply = contracts.get_token_supply(smart_contract_ids)
+    issuance_jobs = TokenIssuance(db, logger).get_unfinished_jobs(smart_contract_ids)
     owned_tokens = []
     for each in smart_contracts:
-        pending = False
-        if each["published"] is not None and each["eth_address"] is None:
-            pending = True
         token_data = {"token_id": each["token_id"],
                       "token_name": each["token_name"],
                       "ico_tokens": each["tokens"],
                       "token_symbol": each["token_symbol"],
                       "eth_address": each["eth_address"],
-                      "created": each["created"],
+                      "created": each["created"].isoformat(),
                       "published": each["published"],
-                      "pending": pending,
+                      "pending": each["pending"],
                       "max_priority": each["max_priority"]}
-        if not pending:
-            sc = SmartContract(each["token_id"], logger=logger)
-            token_data["issued_tokens"] = sc.get_issued_token_count()
-            token_data["issued_not_confirmed"] = 0
+        if not each["pending"]:
+            supply = token_supply[each["token_id"]]
+            token_data["issued_tokens"] = supply["issued"]
+            token_data["issued_not_confirmed"] = supply["created"] - supply["issued"]
+            token_data["remaining_tokens"] = each["tokens"] - supply["created"]
+            token_data["issuance_jobs"] = issuance_jobs[each["token_id"]]
             token_data["confirmed_not_assigned"] = 0
         owned_tokens.append(token_data)
     owned_tokens = sorted(owned_tokens, key=lambda token: token['created'], reverse=True)
@@ -365,14 +410,52 @@ def admin_tokens_issue():
         sc_info = db.get_smart_contract_info(token_id)
 
         if sc_info['owner_id'] == user_id:
-            sc = SmartContract(smart_token_id=token_id)
             if request.form['generate'] == "random":
-                tokens = int(request.form['random_token_count'])
-                sc.issue_tokens(tokens)
+                tokens = int(request.form['tokens'])
+                if tokens > 0:
+                    # issued in chunks by the background worker, the tokens page polls its progress
+                    TokenIssuance(db, current_app.logger).create_job(token_id, tokens, user_id)
             elif request.form['generate'] == "hash":
                 hash_string = request.form['hash']
                 if ETH_ADDRESS_REGEX.match(hash_string):
-                    sc.issue_token(hash_string)
+                    SmartContractRepository(db, current_app.logger).issue_token(token_id, hash_string)
+            return redirect(url_for("admin.admin_tokens", session_token=session_token))
+    abort(403)
+
+
+@admin_blueprint.route('/tokens/issuance/<int:job_id>/<session_token>')
+def admin_issuance_status(job_id, session_token):
+    db = database.Database(logger=current_app.logger)
+    user_id = db.validate_session(session_token)
+    if user_id:
+        job = TokenIssuance(db, current_app.logger).get_job(job_id)
+        if job is None:
+            abort(404)
+        sc_info = db.get_smart_contract_info(job["token_id"])
+        if sc_info and sc_info["owner_id"] == user_id:
+            return Response(json.dumps({"job_id": job["job_id"],
+                                        "token_id": job["token_id"],
+                                        "requested": job["requested"],
+                                        "issued": job["issued"],
+                                        "status": job["status"],
+                                        "error_message": job["error_message"]}),
+                            mimetype="application/json")
+    abort(403)
+
+
+@admin_blueprint.route('/tokens/issuance/resume', methods=['POST'])
+def admin_issuance_resume():
+    db = database.Database(logger=current_app.logger)
+    session_token = request.form['session_token']
+    user_id = db.validate_session(session_token)
+    if user_id:
+        issuance = TokenIssuance(db, current_app.logger)
+        job = issuance.get_job(int(request.form['job_id']))
+        if job is None:
+            abort(404)
+        sc_info = db.get_smart_contract_info(job["token_id"])
+        if sc_info and sc_info["owner_id"] == user_id:
+            issuance.resume_job(job["job_id"])
             return redirect(url_for("admin.admin_tokens", session_token=session_token))
     abort(403)
 
@@ -382,10 +465,52 @@ def admin_view_all_tokens(token_id, session_token):
     db = database.Database(logger=current_app.logger)
     user_id = db.validate_session(session_token)
     sc_info = db.get_smart_contract_info(token_id)
-    if sc_info["owner_id"] == user_id:
-        sc = SmartContract(smart_token_id=token_id)
-        all_tokens = sc.list_all_issued_tokens(token_id)
-        return render_template("admin/view_all_tokens.jinja2",{"all_tokens":all_tokens})
+    if user_id and sc_info and sc_info["owner_id"] == user_id:
+        after_serial = request.args.get("after", 0, type=int)
+        page = SmartContractRepository(db, current_app.logger).list_issued_tokens(token_id, after_serial)
+        if page is None:
+            abort(500)
+        return render_template("admin/view_all_tokens.jinja2",
+                               session_token=session_token,
+                               token_id=token_id,
+                               token_name=sc_info["token_name"],
+                               all_tokens=page["tokens"],
+                               next_serial=page["next_serial"])
+    abort(403)
+
+
+@admin_blueprint.route('/tokens/export/<token_id>/<export_format>/<session_token>')
+def admin_export_tokens(token_id, export_format, session_token):
+    if export_format not in TOKEN_EXPORT_FORMATS:
+        abort(404)
+    db = database.Database(logger=current_app.logger)
+    user_id = db.validate_session(session_token)
+    sc_info = db.get_smart_contract_info(token_id)
+    if user_id and sc_info and sc_info["owner_id"] == user_id:
+        tokens = SmartContractRepository(db, current_app.logger).stream_issued_tokens(token_id)
+
+        def generate():
+            # rows go out as they are read from the server-side cursor, nothing is buffered
+            try:
+                if export_format == "csv":
+                    yield ",".join(TOKEN_EXPORT_COLUMNS) + "\n"
+                for token in tokens:
+                    if token["created"]:
+                        token["created"] = token["created"].isoformat()
+                    if export_format == "csv":
+                        row = io.StringIO()
+                        csv.writer(row).writerow([token[key] for key in TOKEN_EXPORT_COLUMNS])
+                        yield row.getvalue()
+                    else:
+                        yield json.dumps(token) + "\n"
+            finally:
+                tokens.close()
+                db.close()
+
+        filename = "tokens_{0}.{1}".format(token_id, export_format)
+        return Response(stream_with_context(generate()),
+                        mimetype=TOKEN_EXPORT_FORMATS[export_format],
+                        headers={"Content-Disposition": "attachment; filename=" + filename})
     abort(403)
 
 
@@ -397,25 +522,9 @@ def admin_tokens(session_token):
         ctx = UserContext(user_id, db=db, logger=db.logger)
         can_launch_ico = ctx.check_acl("launch-ico")
 
-        erc20_mined = Event("ERC20 Token Mined", db, logger=current_app.logger)
-        mined_count = erc20_mined.get_event_count(user_id)
-        mined_ids = []
-
-        if mined_count:
-            mined_erc20_events = erc20_mined.get_latest_events(mined_count, user_id)
-            for each in mined_erc20_events:
-                json_data = json.loads(each[0])
-                token_id = json_data["token_id"]
-                if token_id not in mined_ids:
-                    mined_ids.append(token_id)
-
-        if can_launch_ico or len(ctx.acl()["management"]) > 0:
-            owned_tokens = []
-            for key in ctx.acl()["management"].keys():
-                token_id = ctx.acl()["management"][key]["token_id"]
-                token_info = db.get_smart_contract_info(token_id)
-                owned_tokens.append(token_info)
-            owned_tokens.extend(get_owned_tokens(user_id, db, current_app.logger))
+        managed_ids = [each["token_id"] for each in ctx.acl()["management"].values()]
+        if can_launch_ico or len(managed_ids) > 0:
+            owned_tokens = get_owned_tokens(user_id, db, current_app.logger, managed_ids)
             if len(owned_tokens) == 0:
                 owned_tokens = None
             email_address = ctx.user_info["email_address"]
@@ -423,13 +532,6 @@ def admin_tokens(session_token):
             last_logged_in_ip = ctx.user_info["last_logged_in_ip"]
             credit_ctx = Credits(user_id, db, current_app.logger)
             credit_balance = credit_ctx.get_credit_balance()
-            if owned_tokens:
-                for each in owned_tokens:
-                    if each["token_id"] in mined_ids:
-                        if each["eth_address"] is None:
-                            each["pending"] = True
-                        else:
-                            each["pending"] = False
 
             return render_template("admin/admin_tokens.jinja2",
                                    session_token=session_token,
@@ -481,13 +583,13 @@ def admin_confirm():
         user_ctx = UserContext(user_id, db, current_app.logger)
         if confirmation_type == "erc20_publish":
             token_id = int(confirmation_val)
-            sc = SmartContract(smart_token_id=token_id)
+            sc = SmartContractRepository(db, current_app.logger).get(token_id)
             credits = Credits(user_id, db, logger=current_app.logger)
-            if sc.smart_contract_id > 0:
-                event_data = {"token_name": sc.token_name,
-                              "token_symbol": sc.token_symbol,
-                              "token_count": sc.tokens,
-                              "token_id": sc.smart_contract_id,
+            if sc:
+                event_data = {"token_name": sc["token_name"],
+                              "token_symbol": sc["token_symbol"],
+                              "token_count": sc["tokens"],
+                              "token_id": sc["token_id"],
                               "ip_address": request.access_route[-1]}
                 if user_ctx.check_acl("launch-ico"):
                     credits_balance = credits.get_credit_balance()
@@ -496,11 +598,13 @@ def admin_confirm():
                         event_id = new_event.log_event(user_id, event_data)
                         event_data["event_id"] = event_id
                         credits.debit(credits.erc20_publish_price, event_data)
+                        SmartContractRepository(db, current_app.logger).publish_smart_contract(sc["token_id"])
                         command_id = db.post_command(json.dumps({"erc20_function":"publish",
-                                                                 "token_name":sc.token_name,
-                                                                 "token_symbol":sc.token_symbol,
-                                                                 "token_count":sc.tokens,
-                                                                 "token_id":sc.smart_contract_id}), 100)
+                                                                 "token_name":sc["token_name"],
+                                                                 "token_symbol":sc["token_symbol"],
+                                                                 "token_count":sc["tokens"],
+                                                                 "token_id":sc["token_id"]}),
+                                                     priority=database.COMMAND_PRIORITY_ERC20)
                         if command_id:
                             return redirect(url_for("admin.admin_tokens", session_token=session_token))
                         else:
@@ -588,8 +692,8 @@ def erc20_publish():
         token_id = int(token_id_form_field)
         if token_id < 1:
             raise ValueError
-        sc = SmartContract(smart_token_id=token_id)
-        if sc.smart_contract_id < 1:
+        sc = SmartContractRepository(db, current_app.logger).get(token_id)
+        if not sc:
             abort(404)
         if confirmation == "true":
             credits = Credits(user_id, db, current_app.logger)
@@ -608,7 +712,7 @@ def erc20_publish():
                                        confirmation_type="insufficient_credits",
                                        confirmation_message=message,
                                        default_choice="Cancel")
-            message = "Are you sure you want to publish <em>" + sc.token_name + "</em> permanently to the Ethereum "
+            message = "Are you sure you want to publish <em>" + sc["token_name"] + "</em> permanently to the Ethereum "
             message += "blockchain, costing <span class=\"credit_price\">"
             message += str(credits.erc20_publish_price) + "</span> credits?"
             return render_template("admin/admin_confirmation.jinja2",
@@ -661,18 +765,17 @@ def create_tokens_form():
                                    default_choice="OK")
         token_count = int(token_count)
         if auth:
-            sc = SmartContract(token_name=token_name,
-                               token_symbol=token_symbol,
-                               token_count=token_count,
-                               logger=current_app.logger,
-                               owner_id=user_id)
-            if sc.smart_contract_id > 0:
+            smart_contract_id = SmartContractRepository(db, current_app.logger).create(token_name,
+                                                                                       token_symbol,
+                                                                                       token_count,
+                                                                                       owner_id=user_id)
+            if smart_contract_id:
                 new_event = Event("ERC20 Token Created", db, current_app.logger)
                 new_event.log_event(user_id, {"ip_address": request.access_route[-1],
                                               "token_name": token_name,
                                               "token_symbol": token_symbol,
                                               "token_count": token_count,
-                                              "token_id": sc.smart_contract_id,
+                                              "token_id": smart_contract_id,
                                               })
                 return redirect(url_for("admin.admin_tokens", session_token=session_token))
             else:
@@ -694,11 +797,22 @@ def admin_view_source(token_id, session_token):
     db = database.Database(logger=current_app.logger)
     user_id = db.validate_session(session_token)
     if user_id and token_id > 0:
-        token_info = db.get_smart_contract_info(token_id)
-        if token_info["owner_id"] == user_id:
-            sc = SmartContract(smart_token_id=token_id)
-            return render_template("view_smart_contract.html",
-                                   new_solidity_contract=sc.solidity_code)
+        contracts = SmartContractRepository(db, current_app.logger)
+        tag = contracts.get_source_etag(token_id)
+        if tag and tag[0] == user_id:
+            # the source never changes after creation, its content hash and the template version are a
+            # strong validator; contracts without a source hash are served without one
+            etag = VIEW_SOURCE_TEMPLATE_VERSION + "-" + tag[1] if tag[1] else None
+            if etag and etag in request.if_none_match:
+                response = Response(status=304)
+            else:
+                solidity_source = contracts.get_solidity_source(token_id)
+                response = make_response(render_template("view_smart_contract.html",
+                                                         new_solidity_contract=solidity_source))
+            if etag:
+                response.set_etag(etag)
+            response.headers["Cache-Control"] = VIEW_SOURCE_CACHE_CONTROL
+            return response
     abort(403)
 
 
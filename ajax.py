@@ -1,10 +1,15 @@
 from flask import (
-    Blueprint, Response, current_app
+    Blueprint, Response, current_app, request
 )
 import json
-from block_data import BlockDataManager
+import re
+from block_data import BlockDataManager, ADDRESS_HISTORY_LIMIT
 import database
 
+ETH_ADDRESS_REGEX = re.compile("^0x[0-9a-fA-F]{40}$")
+HASH_REGEX = re.compile("^0x[0-9a-fA-F]{64}$")
+MAX_ADDRESS_HISTORY_LIMIT = 500
+
 ajax_api_blueprint = Blueprint('ajax', __name__, url_prefix="/ajax")
 
 
@@ -36,3 +41,58 @@ def block_data(block_number):
     else:
         return Response(json.dumps({"result": False, "error": "Block data not found."}),
                         content_type="application/json")
+
+
+@ajax_api_blueprint.route("/address_history/<eth_address>")
+def address_history(eth_address):
+    if not ETH_ADDRESS_REGEX.match(eth_address):
+        return Response(json.dumps({"result": False, "error": "Invalid Ethereum address."}),
+                        content_type="application/json")
+    # type=int gives None for a value that is not an integer, told apart from a missing one below
+    limit = request.args.get("limit", type=int)
+    before_block = request.args.get("before_block", type=int)
+    before_txid = request.args.get("before_txid", type=int)
+    malformed = any(name in request.args and value is None for name, value in (("limit", limit),
+                                                                              ("before_block", before_block),
+                                                                              ("before_txid", before_txid)))
+    # the cursor is both values or neither
+    if malformed or (before_block is None) != (before_txid is None) or \
+            (before_block is not None and (before_block < 0 or before_txid < 0)):
+        return Response(json.dumps({"result": False, "error": "Invalid limit or cursor."}),
+                        content_type="application/json", status=400)
+    if limit is None:
+        limit = ADDRESS_HISTORY_LIMIT
+    limit = max(1, min(limit, MAX_ADDRESS_HISTORY_LIMIT))
+
+    db = database.Database()
+    manager = BlockDataManager(db, logger=current_app.logger)
+    history = manager.get_address_history(eth_address, before_block, before_txid, limit)
+    if history is None:
+        return Response(json.dumps({"result": False, "error": "Could not load address history."}),
+                        content_type="application/json")
+    for each_tx in history["transactions"]:
+        # convert to JSON serializable/JavaScript format
+        if each_tx["block_timestamp"]:
+            each_tx["block_timestamp"] = each_tx["block_timestamp"].isoformat()
+    history["result"] = True
+    history["address"] = eth_address
+    return Response(json.dumps(history), content_type="application/json")
+
+
+@ajax_api_blueprint.route("/lookup/<hash_string>")
+def lookup_hash(hash_string):
+    if not HASH_REGEX.match(hash_string):
+        return Response(json.dumps({"result": False, "error": "Invalid transaction or block hash."}),
+                        content_type="application/json")
+    db = database.Database()
+    manager = BlockDataManager(db, logger=current_app.logger)
+    found = manager.lookup_hash(hash_string)
+    if found:
+        hash_type, data = found
+        # convert to JSON serializable/JavaScript format
+        if data["block_timestamp"]:
+            data["block_timestamp"] = data["block_timestamp"].isoformat()
+        return Response(json.dumps({"result": True, "type": hash_type, "data": data}),
+                        content_type="application/json")
+    return Response(json.dumps({"result": False, "error": "Hash not found."}),
+                    content_type="application/json")
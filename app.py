@@ -3,7 +3,6 @@ from database import Database
 from charting import Charting
 from credits import Credits
 from block_data import BlockDataManager
-import smart_contract
 import datetime
 import json
 import node_api
@@ -12,6 +11,9 @@ import users
 import events
 import whitepapers
 import ajax
+import ethereum_address_pool
+import token_issuance
+import command_queue
 import re
 
 EMAIL_REGEX = re.compile(r"^[a-zA-Z0-9.!#$%&’*+/=?^_`{|}~-]+@[a-zA-Z0-9-]+(?:\.[a-zA-Z0-9-]+)*$")
@@ -23,6 +25,15 @@ app.register_blueprint(node_api.node_api_blueprint)
 app.register_blueprint(whitepapers.whitepapers_blueprint)
 app.register_blueprint(ajax.ajax_api_blueprint)
 
+# keeps the Ethereum address pool topped up outside of request handling
+ethereum_address_pool.start_refiller(app.logger)
+# works through queued bulk token issuance jobs
+token_issuance.start_issuance_worker(app.logger)
+# returns commands whose lease expired without output to the queue
+command_queue.start_reaper(app.logger)
+# wakes this worker's long-polling nodes when another worker posts a command
+command_queue.start_watcher(app.logger)
+
 
 @app.route('/')
 def homepage():
@@ -206,20 +217,22 @@ def home_page_transaction_count():
                            whitepapers=whitepapers.whitepaper_urls)
 
 
-@app.route('/wallet/<user_id>/<session_token>')
+@app.route('/wallet/<int:user_id>/<session_token>')
 def view_wallet(user_id, session_token):
     db = Database(logger=current_app.logger)
-    wallet_tokens = {}
     session_user_id = db.validate_session(session_token)
     if session_user_id == user_id:
-        owned_tokens = db.list_owned_tokens(user_id)
-
-        for each in owned_tokens:
-            sc = smart_contract.SmartContract(smart_token_id=each["token_id"])
-            tokens = sc.list_owned_tokens_for_user_id(user_id)
-            wallet_tokens[each] = tokens
-
+        after_serial = request.args.get("after", 0, type=int)
+        # type=int falls back to the default for a malformed value, reject it along with negative ones
+        if after_serial < 0 or ("after" in request.args and not request.args["after"].isdigit()):
+            abort(400)
+        wallet = db.view_wallet(user_id, after_serial)
+        if wallet is None:
+            abort(500)
         return render_template("wallet.jinja2",
-                               wallet_tokens=wallet_tokens)
+                               wallet_tokens=wallet["contracts"],
+                               next_serial=wallet["next_serial"],
+                               user_id=user_id,
+                               session_token=session_token)
 
-    abort(403)
\ No newline at end of file
+    abort(403)
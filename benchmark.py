@@ -0,0 +1,214 @@
+# benchmarks for bulk database operations
+#
+# Run against a scratch copy of the database, every benchmark creates its own rows
+# and deletes them again when it is done:
+#   python benchmark.py assign-tokens [size ...]
+#   python benchmark.py dispatch [nodes ...]
+
+import MySQLdb
+import json
+import sys
+import os
+import time
+import pprint
+import threading
+from events import Event
+from smart_contract import SmartContractRepository
+from command_queue import CommandQueue
+
+ASSIGN_TOKENS_SIZES = [1000, 100000, 1000000]
+# token rows written per INSERT while setting up a benchmark
+INSERT_BATCH_SIZE = 10000
+# simulated nodes claiming undirected commands at the same time
+DISPATCH_NODE_COUNTS = [1, 4, 16]
+DISPATCH_COMMANDS = 2000
+
+
+class Benchmark:
+    def __init__(self, logger=None):
+        self.logger = logger
+        self.db = self.connect()
+
+    def connect(self):
+        config_stream = open("config.json", "r")
+        config_data = json.load(config_stream)
+        config_stream.close()
+        return MySQLdb.connect(config_data["mysql_host"],
+                               config_data["mysql_user"],
+                               config_data["mysql_password"],
+                               config_data["mysql_database"])
+
+    def log_info(self, msg):
+        if self.logger:
+            self.logger.info(msg)
+        else:
+            print(msg)
+
+    def create_benchmark_contract(self, tokens):
+        c = self.db.cursor()
+        c.execute("INSERT INTO smart_contracts (token_name,tokens,token_symbol) VALUES (%s,%s,%s)",
+                  ("benchmark", tokens, "BENCH"))
+        smart_contract_id = c.lastrowid
+        for x in range(0, tokens, INSERT_BATCH_SIZE):
+            c.executemany("INSERT INTO tokens (smart_contract_id) VALUES (%s)",
+                          [(smart_contract_id,)] * min(INSERT_BATCH_SIZE, tokens - x))
+            self.db.commit()
+        return smart_contract_id
+
+    def drop_benchmark_contract(self, smart_contract_id):
+        c = self.db.cursor()
+        c.execute("DELETE transaction_ledger FROM transaction_ledger INNER JOIN tokens "
+                  "ON transaction_ledger.token_id=tokens.serial WHERE tokens.smart_contract_id=%s",
+                  (smart_contract_id,))
+        c.execute("DELETE FROM tokens WHERE smart_contract_id=%s", (smart_contract_id,))
+        # the counter rows the assignments adjusted go with the contract
+        c.execute("DELETE FROM token_supply WHERE smart_contract_id=%s", (smart_contract_id,))
+        c.execute("DELETE FROM token_holdings WHERE smart_contract_id=%s", (smart_contract_id,))
+        c.execute("DELETE FROM smart_contracts WHERE id=%s", (smart_contract_id,))
+        self.db.commit()
+
+    def assign_tokens(self, sizes=ASSIGN_TOKENS_SIZES):
+        """Times set-based assignment and unassignment of every token of a contract with size tokens"""
+        output = {}
+        c = self.db.cursor()
+        c.execute("SELECT user_id FROM users WHERE email_address='admin';")
+        row = c.fetchone()
+        if not row:
+            self.log_info("assign-tokens needs the admin user, assignments are initiated by it")
+            return None
+        user_id = row[0]
+        contracts = SmartContractRepository(self.db, self.logger)
+        for size in sizes:
+            self.log_info("Creating {0} benchmark tokens...".format(size))
+            smart_contract_id = self.create_benchmark_contract(size)
+            try:
+                started = time.perf_counter()
+                assigned = contracts.assign_tokens_to_user_id(smart_contract_id, user_id, size)
+                assign_seconds = time.perf_counter() - started
+                started = time.perf_counter()
+                unassigned = contracts.unassign_tokens_from_user_id(smart_contract_id, user_id, size)
+                unassign_seconds = time.perf_counter() - started
+            finally:
+                self.drop_benchmark_contract(smart_contract_id)
+            output[size] = {
+                "assigned": assigned,
+                "assign_seconds": assign_seconds,
+                "unassigned": unassigned,
+                "unassign_seconds": unassign_seconds,
+                "tokens_per_second": size * 2 / (assign_seconds + unassign_seconds)
+            }
+        return output
+
+    def legacy_claim(self, db, node_id):
+        """The dispatch path before atomic claims: look up, log the event, then mark the command taken.
+
+        Kept here as the baseline only, it bypasses leases and the queue_depth counters (dispatch_round
+        reconciles them afterwards)."""
+        c = db.cursor()
+        c.execute("SELECT command_id, command FROM commands WHERE dispatch_event_id IS NULL AND node_id IS NULL "
+                  "ORDER BY priority DESC, command_id LIMIT 1")
+        next_command = c.fetchone()
+        if not next_command:
+            db.commit()
+            return None
+        event_id = Event("Ethereum Node Command Dispatch", db, self.logger).log_event(node_id, {
+            "node_id": node_id, "command": next_command[1], "command_id": next_command[0]})
+        c.execute("UPDATE commands SET dispatch_event_id=%s, node_id=%s WHERE command_id=%s",
+                  (event_id, node_id, next_command[0]))
+        db.commit()
+        return {"command_id": next_command[0], "event_id": event_id}
+
+    def dispatch_round(self, nodes, commands, legacy):
+        marker = os.urandom(8).hex()
+        c = self.db.cursor()
+        for x in range(0, commands, INSERT_BATCH_SIZE):
+            c.executemany("INSERT INTO commands (command) VALUES (%s)",
+                          [(json.dumps({"benchmark": marker}),)] * min(INSERT_BATCH_SIZE, commands - x))
+        self.db.commit()
+        claims = []
+        claims_lock = threading.Lock()
+
+        def node(node_id):
+            if legacy:
+                db = self.connect()
+            else:
+                queue = CommandQueue(self.connect(), self.logger)
+            while True:
+                if legacy:
+                    claimed = self.legacy_claim(db, node_id)
+                else:
+                    claimed = queue.claim_command(node_id)
+                if claimed is None:
+                    break
+                with claims_lock:
+                    claims.append((claimed["command_id"], claimed["event_id"]))
+            if legacy:
+                db.close()
+            else:
+                queue.db.close()
+
+        threads = [threading.Thread(target=node, args=(node_id,)) for node_id in range(1, nodes + 1)]
+        started = time.perf_counter()
+        for each in threads:
+            each.start()
+        for each in threads:
+            each.join()
+        seconds = time.perf_counter() - started
+
+        event_ids = [event_id for command_id, event_id in claims if event_id]
+        for x in range(0, len(event_ids), INSERT_BATCH_SIZE):
+            batch = event_ids[x:x + INSERT_BATCH_SIZE]
+            c.execute("DELETE FROM event_log WHERE event_id IN (" + ",".join(["%s"] * len(batch)) + ")", batch)
+        c.execute("DELETE FROM commands WHERE JSON_UNQUOTE(JSON_EXTRACT(command, '$.benchmark'))=%s", (marker,))
+        self.db.commit()
+        # the benchmark commands were inserted around the counters, their claims were not
+        CommandQueue(self.db, self.logger).reconcile_queue_depth()
+        distinct = len(set(command_id for command_id, event_id in claims))
+        return {
+            "claims": len(claims),
+            "duplicate_dispatches": len(claims) - distinct,
+            "seconds": seconds,
+            "commands_per_second": distinct / seconds if seconds else None
+        }
+
+    def dispatch(self, node_counts=DISPATCH_NODE_COUNTS, commands=DISPATCH_COMMANDS):
+        """Drains commands undirected commands with each number of simulated nodes, through the
+        legacy look-up-then-mark path and through atomic claims"""
+        output = {}
+        for nodes in node_counts:
+            self.log_info("Dispatching {0} commands to {1} nodes...".format(commands, nodes))
+            output[nodes] = {
+                "legacy": self.dispatch_round(nodes, commands, legacy=True),
+                "atomic_claim": self.dispatch_round(nodes, commands, legacy=False)
+            }
+        return output
+
+
+if __name__ == "__main__":
+    HELP = """python benchmark.py command [arguments]
+
+        assign-tokens [size ...]
+        dispatch [nodes ...]
+
+        python benchmark.py assign-tokens
+        python benchmark.py assign-tokens 1000 100000
+        python benchmark.py dispatch 1 8 32
+"""
+    if len(sys.argv) < 2:
+        print(HELP)
+    else:
+        benchmark = Benchmark()
+        command = sys.argv[1]
+        if command == "assign-tokens":
+            if len(sys.argv) > 2:
+                pprint.pprint(benchmark.assign_tokens([int(each) for each in sys.argv[2:]]))
+            else:
+                pprint.pprint(benchmark.assign_tokens())
+        elif command == "dispatch":
+            if len(sys.argv) > 2:
+                pprint.pprint(benchmark.dispatch([int(each) for each in sys.argv[2:]]))
+            else:
+                pprint.pprint(benchmark.dispatch())
+        else:
+            print("Unknown command.\n\n")
+            print(HELP)
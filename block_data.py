@@ -1,20 +1,64 @@
 from ethereum_address_pool import EthereumAddressPool
+from database import encode_hash, decode_hash
 import MySQLdb
 import json
 import logging
 import datetime
 import random
+import threading
+import time
+from collections import OrderedDict
 
 MAX_PENDING_COMMANDS = 25
 WINDOW_SIZE = 100
 GROWTH_RATE = 15
+ADDRESS_HISTORY_LIMIT = 50
+NEGATIVE_CACHE_SIZE = 4096
+NEGATIVE_CACHE_TTL = 60
+# returned by the hash getters on a database error, None means there is no such row
+LOOKUP_ERROR = object()
+
+
+class NegativeCache:
+    """Per-process LRU of recent lookup misses, so repeated misses for the same key don't hit MySQL"""
+    def __init__(self, size=NEGATIVE_CACHE_SIZE, ttl=NEGATIVE_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._misses = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            expires = self._misses.get(key)
+            if expires is None:
+                return False
+            if expires < time.time():
+                del self._misses[key]
+                return False
+            self._misses.move_to_end(key)
+            return True
+
+    def add(self, key):
+        with self._lock:
+            self._misses[key] = time.time() + self.ttl
+            self._misses.move_to_end(key)
+            while len(self._misses) > self.size:
+                self._misses.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._misses.pop(key, None)
+
+
+hash_lookup_misses = NegativeCache()
 
 
 class TransactionData:
     def __init__(self, from_address=None, gas=None, gas_price=None, tx_hash=None,
                  to_address=None, wei_value=None, json_data=None):
         if json_data:
-            tx_data = json.loads(json_data)
+            # node outputs already decoded by the caller are used as they are
+            tx_data = json.loads(json_data) if isinstance(json_data, str) else json_data
             self.from_address = tx_data["from"]
             self.gas = tx_data["gas"]
             self.gas_price = tx_data["gas_price"]
@@ -44,7 +88,7 @@ class BlockData:
     def __init__(self, block_number=None, block_hash=None, block_timestamp=None, gas_used=None, gas_limit=None,
                  block_size=None, tx_count=None, json_data=None):
         if json_data:
-            block_data = json.loads(json_data)
+            block_data = json.loads(json_data) if isinstance(json_data, str) else json_data
             self.block_number = block_data["block_number"]
             self.block_hash = block_data["block_hash"]
             self.block_timestamp = block_data["block_timestamp"]
@@ -112,6 +156,7 @@ class BlockDataManager:
         config_stream.close()
         self.MAX_PENDING_COMMANDS = self.config["block_data"]["max_pending_commands"]
         self.WINDOW_SIZE = self.config["block_data"]["window_size"]
+        self.binary_hashes = self.config.get("binary_hashes", False)
 
         if db:
             self.db = db
@@ -165,15 +210,30 @@ class BlockDataManager:
                 print(error_message)
         return latest_blocks
 
-    def put_block(self, block_data):
-        eth_pool = EthereumAddressPool(self.db, self.logger)
+    def prepare_block(self, block_data, eth_pool):
+        # a block we just stored must not keep answering "not found" from the miss cache
+        if block_data.block_hash:
+            hash_lookup_misses.discard(block_data.block_hash.lower())
+        for each_tx in block_data.transactions:
+            if each_tx.tx_hash:
+                hash_lookup_misses.discard(each_tx.tx_hash.lower())
         for each_tx in block_data.transactions:
             if each_tx.from_address:
-                each_tx.from_address = eth_pool.add_new_ethereum_address(each_tx.from_address)
+                each_tx.from_address = eth_pool.get_or_add_ethereum_address(each_tx.from_address)
             if each_tx.to_address:
-                each_tx.to_address = eth_pool.add_new_ethereum_address(each_tx.to_address)
+                each_tx.to_address = eth_pool.get_or_add_ethereum_address(each_tx.to_address)
+
+    def put_block(self, block_data):
+        self.prepare_block(block_data, EthereumAddressPool(self.db, self.logger))
         return self.db.put_block(block_data)
 
+    def put_blocks(self, blocks):
+        """Stores a batch of blocks together, see Database.put_blocks"""
+        eth_pool = EthereumAddressPool(self.db, self.logger)
+        for each in blocks:
+            self.prepare_block(each, eth_pool)
+        return self.db.put_blocks(blocks)
+
     def target_new_blocks(self, latest_block, window_size=WINDOW_SIZE, max_targets=MAX_PENDING_COMMANDS):
         """
         Target new blocks for addition and removal (duplicates)
@@ -246,7 +306,7 @@ class BlockDataManager:
             if row:
                 block_data_id = row[0]
                 block_data = {"block_number": block_number,
-                              "block_hash": row[1],
+                              "block_hash": decode_hash(row[1]),
                               "block_timestamp": row[2],
                               "gas_used": row[3],
                               "gas_limit": row[4],
@@ -265,7 +325,7 @@ class BlockDataManager:
                               "to": row[1],
                               "external_contract_id": row[2],
                               "amount": ether_to_wei(row[3]),
-                              "hash": row[4],
+                              "hash": decode_hash(row[4]),
                               "gas_used": row[5],
                               "priority": row[6],
                               "usd_price": row[7]}
@@ -276,13 +336,13 @@ class BlockDataManager:
                     c.execute(sql, (each_tx["from"],))
                     row = c.fetchone()
                     if row:
-                        each_tx["from"] = row[0]
+                        each_tx["from"] = decode_hash(row[0])
                     else:
                         each_tx["from"] = None
                     c.execute(sql, (each_tx["to"],))
                     row = c.fetchone()
                     if row:
-                        each_tx["to"] = row[0]
+                        each_tx["to"] = decode_hash(row[0])
                     else:
                         each_tx["to"] = None
 
@@ -308,6 +368,187 @@ class BlockDataManager:
                 print(error_message)
         return None
 
+    def get_address_history(self, eth_address, before_block_data_id=None, before_txid=None,
+                            limit=ADDRESS_HISTORY_LIMIT):
+        """
+        Transfers sent or received by an address, newest first
+
+        Each side of the UNION is an index range scan on (address_id, block_data_id, txid) that stops
+        after `limit` rows, so the cost depends on the page size and not on the size of the ledger.
+
+        :param eth_address: 0x prefixed hex address
+        :param before_block_data_id: block_data_id of the last transfer on the previous page
+        :param before_txid: txid of the last transfer on the previous page
+        :param limit: page size
+        :return: {"transactions": [...], "next_cursor": {"block_data_id": .., "txid": ..} or None}
+        """
+        # the ledger columns hold ether, see get_block_from_db
+        def ether_to_wei(ether):
+            return ether * 10 ** 18
+
+        output = {"transactions": [], "next_cursor": None}
+        try:
+            encoded_address = encode_hash(eth_address, self.binary_hashes)
+        except ValueError:
+            # not an address, it has no history
+            return output
+        try:
+            c = self.db_conn.cursor()
+            c.execute("SELECT id FROM ethereum_address_pool WHERE ethereum_address=%s", (encoded_address,))
+            address_ids = [row[0] for row in c]
+            if not address_ids:
+                return output
+
+            id_placeholders = ",".join(["%s"] * len(address_ids))
+            branch_params = list(address_ids)
+            keyset = ""
+            if before_block_data_id is not None and before_txid is not None:
+                keyset = " AND (block_data_id < %s OR (block_data_id = %s AND txid < %s))"
+                branch_params += [before_block_data_id, before_block_data_id, before_txid]
+            branch_params.append(limit)
+            branch = "(SELECT txid, block_data_id FROM external_transaction_ledger WHERE {0} IN (" + id_placeholders
+            branch += "){1} ORDER BY block_data_id DESC, txid DESC LIMIT %s)"
+
+            sql = "SELECT page.txid, page.block_data_id, block_number, block_timestamp, sender.ethereum_address, "
+            sql += "receiver.ethereum_address, amount, transaction_hash, ledger.gas_used, priority FROM ("
+            sql += branch.format("sender_address_id", keyset) + " UNION "
+            sql += branch.format("received_address_id", keyset) + ") AS page "
+            sql += "INNER JOIN external_transaction_ledger AS ledger ON ledger.txid=page.txid "
+            sql += "LEFT JOIN block_data ON block_data.block_data_id=page.block_data_id "
+            sql += "LEFT JOIN ethereum_address_pool AS sender ON sender.id=ledger.sender_address_id "
+            sql += "LEFT JOIN ethereum_address_pool AS receiver ON receiver.id=ledger.received_address_id "
+            sql += "ORDER BY page.block_data_id DESC, page.txid DESC LIMIT %s"
+            c.execute(sql, branch_params + branch_params + [limit])
+            for row in c:
+                output["transactions"].append({"txid": row[0],
+                                               "block_data_id": row[1],
+                                               "block_number": row[2],
+                                               "block_timestamp": row[3],
+                                               "from": decode_hash(row[4]),
+                                               "to": decode_hash(row[5]),
+                                               "amount": ether_to_wei(row[6]) if row[6] is not None else None,
+                                               "hash": decode_hash(row[7]),
+                                               "gas_used": row[8],
+                                               "priority": row[9]})
+            c.close()
+            if len(output["transactions"]) == limit:
+                last_tx = output["transactions"][-1]
+                output["next_cursor"] = {"block_data_id": last_tx["block_data_id"], "txid": last_tx["txid"]}
+        except MySQLdb.Error as e:
+            try:
+                error_message = "MySQL Error [%d]: %s" % (e.args[0], e.args[1])
+            except IndexError:
+                error_message = "MySQL Error: %s" % (str(e),)
+
+            if self.logger:
+                self.logger.error(error_message)
+            else:
+                print(error_message)
+            return None
+        return output
+
+    def get_transaction_by_hash(self, tx_hash):
+        # the ledger columns hold ether, see get_block_from_db
+        def ether_to_wei(ether):
+            return ether * 10 ** 18
+
+        try:
+            encoded_hash = encode_hash(tx_hash, self.binary_hashes)
+        except ValueError:
+            # malformed, a miss
+            return None
+        try:
+            sql = "SELECT txid, sender.ethereum_address, receiver.ethereum_address, contract_id, amount, "
+            sql += "transaction_hash, ledger.gas_used, priority, usd_price, block_number, block_hash, block_timestamp "
+            sql += "FROM external_transaction_ledger AS ledger "
+            sql += "LEFT JOIN block_data ON block_data.block_data_id=ledger.block_data_id "
+            sql += "LEFT JOIN ethereum_address_pool AS sender ON sender.id=ledger.sender_address_id "
+            sql += "LEFT JOIN ethereum_address_pool AS receiver ON receiver.id=ledger.received_address_id "
+            sql += "WHERE transaction_hash=%s LIMIT 1"
+            c = self.db_conn.cursor()
+            c.execute(sql, (encoded_hash,))
+            row = c.fetchone()
+            c.close()
+            if row:
+                return {"txid": row[0],
+                        "from": decode_hash(row[1]),
+                        "to": decode_hash(row[2]),
+                        "external_contract_id": row[3],
+                        "amount": ether_to_wei(row[4]) if row[4] is not None else None,
+                        "hash": decode_hash(row[5]),
+                        "gas_used": row[6],
+                        "priority": row[7],
+                        "usd_price": row[8],
+                        "block_number": row[9],
+                        "block_hash": decode_hash(row[10]),
+                        "block_timestamp": row[11]}
+        except MySQLdb.Error as e:
+            try:
+                error_message = "MySQL Error [%d]: %s" % (e.args[0], e.args[1])
+            except IndexError:
+                error_message = "MySQL Error: %s" % (str(e),)
+
+            if self.logger:
+                self.logger.error(error_message)
+            else:
+                print(error_message)
+            return LOOKUP_ERROR
+        return None
+
+    def get_block_by_hash(self, block_hash, no_txns=True):
+        try:
+            encoded_hash = encode_hash(block_hash, self.binary_hashes)
+        except ValueError:
+            # malformed, a miss
+            return None
+        try:
+            c = self.db_conn.cursor()
+            c.execute("SELECT block_number FROM block_data WHERE block_hash=%s", (encoded_hash,))
+            row = c.fetchone()
+            c.close()
+            if row:
+                block = self.get_block_from_db(row[0], no_txns=no_txns)
+                # the hash is known, no block here means get_block_from_db failed
+                return block if block else LOOKUP_ERROR
+        except MySQLdb.Error as e:
+            try:
+                error_message = "MySQL Error [%d]: %s" % (e.args[0], e.args[1])
+            except IndexError:
+                error_message = "MySQL Error: %s" % (str(e),)
+
+            if self.logger:
+                self.logger.error(error_message)
+            else:
+                print(error_message)
+            return LOOKUP_ERROR
+        return None
+
+    def lookup_hash(self, hash_string):
+        """
+        Resolve a 32 byte hash to a transaction or a block
+
+        Misses are remembered for NEGATIVE_CACHE_TTL seconds by this process, put_block forgets
+        the hashes it stores. A lookup that failed on a database error is not a miss and is not remembered.
+
+        :param hash_string: 0x prefixed transaction or block hash
+        :return: ("transaction", tx_dict), ("block", block_dict) or None
+        """
+        cache_key = hash_string.lower()
+        if cache_key in hash_lookup_misses:
+            return None
+        tx_data = self.get_transaction_by_hash(hash_string)
+        if tx_data is LOOKUP_ERROR:
+            return None
+        if tx_data:
+            return "transaction", tx_data
+        block = self.get_block_by_hash(hash_string)
+        if block is LOOKUP_ERROR:
+            return None
+        if block:
+            return "block", block
+        hash_lookup_misses.add(cache_key)
+        return None
+
     def get_block(self, block_number: int, no_txns=True) -> BlockData:
         block_dict = self.get_block_from_db(block_number, no_txns=no_txns)
         if block_dict:
@@ -331,11 +572,12 @@ class BlockDataManager:
 
         target_list = self.target_new_blocks(block_number, max_targets=remaining)
 
-        for each in target_list:
-            command_data = {"get_block_data": each}
-            if self.logger:
-                self.logger.info("Posting command to get_block_data for {0}".format(each))
-            self.db.post_command(json.dumps(command_data))
+        # keyed by block number, a block already requested by a concurrent caller is not requested again
+        commands = [(json.dumps({"get_block_data": each}), "get_block_data:{0}".format(each)) for each in target_list]
+        posted = self.db.post_commands(commands)
+        if self.logger and target_list:
+            self.logger.info("Posted {0} get_block_data commands for {1} target blocks".format(posted,
+                                                                                              len(target_list)))
 
         return block_data
 
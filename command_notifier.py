@@ -0,0 +1,43 @@
+# command_notifier.py
+#
+# in-process wake-ups for long-polling dispatch requests. Anything that posts commands
+# (database.py, token_issuance.py) notifies; command_queue.py waits. Kept apart from both
+# so neither has to import the other.
+
+import threading
+
+
+class CommandNotifier:
+    """Wakes this process's long-polling dispatch requests when a command is posted"""
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._sequence = 0
+        self._waiting = 0
+
+    @property
+    def sequence(self):
+        with self._condition:
+            return self._sequence
+
+    @property
+    def waiting(self):
+        """Requests blocked in wait() right now"""
+        with self._condition:
+            return self._waiting
+
+    def notify(self):
+        with self._condition:
+            self._sequence += 1
+            self._condition.notify_all()
+
+    def wait(self, sequence, timeout):
+        """Blocks until a post after sequence was notified or timeout seconds pass"""
+        with self._condition:
+            self._waiting += 1
+            try:
+                self._condition.wait_for(lambda: self._sequence != sequence, timeout)
+            finally:
+                self._waiting -= 1
+
+
+command_notifier = CommandNotifier()
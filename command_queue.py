@@ -0,0 +1,655 @@
+# command_queue.py
+#
+# the queue of commands for Ethereum nodes. A node claims its next commands in one
+# transaction: the rows are locked with SKIP LOCKED, their dispatch events are logged
+# and the rows are marked dispatched before the locks are released, so nodes polling
+# at the same time never receive the same command.
+#
+# Idle nodes long-poll: a dispatch request is held open until a command is posted
+# or LONG_POLL_TIMEOUT passes. Posts from this process wake it at once through
+# command_notifier; posts from other workers are noticed by one CommandWatcher thread
+# per worker, which reads the newest command id every LONG_POLL_CHECK_INTERVAL while
+# anyone is waiting and notifies on a change, so waiting requests don't query at all.
+# Each held request occupies a uwsgi thread: at most LONG_POLL_MAX_WAITERS are held per
+# worker, further long-polls answer at once, and config/uwsgi.ini gives every worker
+# LONG_POLL_MAX_WAITERS threads on top of those serving other requests.
+#
+# Scheduling: commands are handed out highest priority first (commands.priority, see
+# COMMAND_PRIORITY_* in database.py) and oldest first within a priority, so a block data
+# backfill can't hold back ERC20 commands. A batch claim of undirected commands is capped
+# at the node's fair share of the queue, the pending depth divided by the synchronized
+# nodes, so one node can't drain the queue while others sit idle.
+#
+# A claim is a lease of LEASE_SECONDS. The node's output completes the command; a failure
+# report or an expired lease (found by the CommandReaper thread) puts it back in the queue,
+# until it has been dispatched MAX_ATTEMPTS times, after which it is dead-lettered.
+#
+# Queue depth is kept in queue_depth counters (node 0 for undirected commands), adjusted in the
+# same transaction as every post, claim and requeue; the reaper recounts them from commands every
+# RECONCILE_INTERVAL to repair drift from writes that bypass this module.
+#
+# Completed and dead-lettered commands are purged by the reaper every RETENTION_INTERVAL once they
+# are older than command_retention.retention_hours in config.json, in chunks over the completed and
+# dead_lettered indexes.
+# With command_retention.archive_directory set, each purged row is first appended to a
+# gzipped NDJSON file there (commands-<date>-<pid>.ndjson.gz, one per day and worker).
+#
+# Metrics (queue_metrics): depth per node and command type from queue_depth, the age of the
+# oldest pending command, outputs and failures per node from per-minute command_completions
+# counters, and dispatch-to-output latency percentiles from a rolling histogram kept in
+# memory by each worker for the outputs it received.
+
+import MySQLdb
+import bisect
+import datetime
+import gzip
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from database import Database, add_to_queue_depth
+from command_notifier import command_notifier
+import events
+
+DISPATCH_EVENT_TYPE = "Ethereum Node Command Dispatch"
+# most commands a node can claim per request
+DISPATCH_BATCH_LIMIT = 50
+# longest a long-poll dispatch request is held open, in seconds
+LONG_POLL_TIMEOUT = 25
+# seconds between checks for commands posted by other workers while long-polling
+LONG_POLL_CHECK_INTERVAL = 1
+# long-poll requests held open at once per worker, keep uwsgi threads at this plus the request threads
+LONG_POLL_MAX_WAITERS = 16
+# a long-poll also retries its claim this often, commands requeued by another worker's reaper keep their ids
+LONG_POLL_RECLAIM_INTERVAL = 5
+# seconds a node has to report the output of a dispatched command
+LEASE_SECONDS = 300
+# dispatches of one command before it is dead-lettered
+MAX_ATTEMPTS = 5
+# seconds between passes of the reaper and rows it updates per statement
+REAP_INTERVAL = 30
+REAP_BATCH_SIZE = 1000
+# seconds between recounts of the queue_depth counters
+RECONCILE_INTERVAL = 600
+# seconds between purges of completed commands and rows deleted per statement
+RETENTION_INTERVAL = 3600
+RETENTION_CHUNK_SIZE = 1000
+# used when config.json has no command_retention section
+RETENTION_HOURS = 24
+# minutes covered by the latency histogram and completion rates
+METRICS_WINDOW_MINUTES = 60
+# upper bounds in seconds of the dispatch-to-output latency histogram buckets
+LATENCY_BUCKETS = [0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600]
+LATENCY_PERCENTILES = [50, 90, 99]
+
+
+class LatencyHistogram:
+    """Per-process rolling histogram: one row of bucket counts per minute, the last window minutes are kept"""
+    def __init__(self, buckets=LATENCY_BUCKETS, window=METRICS_WINDOW_MINUTES):
+        self.buckets = buckets
+        self.window = window
+        self._minutes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        minute = int(time.time() // 60)
+        bucket = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            counts = self._minutes.get(minute)
+            if counts is None:
+                counts = [0] * (len(self.buckets) + 1)
+                self._minutes[minute] = counts
+                while len(self._minutes) > self.window:
+                    self._minutes.popitem(last=False)
+            counts[bucket] += 1
+
+    def percentiles(self, percentiles=LATENCY_PERCENTILES):
+        """{"count": n, "p50": upper bound in seconds of the bucket holding it (None past the last bucket), ...}"""
+        oldest = int(time.time() // 60) - self.window
+        totals = [0] * (len(self.buckets) + 1)
+        with self._lock:
+            for minute, counts in self._minutes.items():
+                if minute > oldest:
+                    totals = [a + b for a, b in zip(totals, counts)]
+        count = sum(totals)
+        output = {"count": count}
+        for percentile in percentiles:
+            value = None
+            if count:
+                rank = count * percentile / 100.0
+                seen = 0
+                for x in range(0, len(totals)):
+                    seen += totals[x]
+                    if seen >= rank:
+                        value = self.buckets[x] if x < len(self.buckets) else None
+                        break
+            output["p{0}".format(percentile)] = value
+        return output
+
+
+dispatch_latency = LatencyHistogram()
+
+
+def record_completion(c, node_id, completed=0, failed=0):
+    """Counts a node's command outputs and failures in the current minute, inside the caller's transaction"""
+    sql = "INSERT INTO command_completions (minute,node_id,completed,failed) "
+    sql += "VALUES (DATE_FORMAT(NOW(),'%%Y-%%m-%%d %%H:%%i:00'),%s,%s,%s) "
+    sql += "ON DUPLICATE KEY UPDATE completed=completed+VALUES(completed),failed=failed+VALUES(failed)"
+    c.execute(sql, (node_id, completed, failed))
+
+
+class CommandQueue:
+    def __init__(self, db, logger=None):
+        if isinstance(db, Database):
+            self.db = db.db
+        else:
+            self.db = db
+        self.logger = logger
+        self._dispatch_event_type_id = None
+        self._config = None
+
+    def log_error(self, e):
+        try:
+            msg = "MySQL Error [%d]: %s" % (e.args[0], e.args[1])
+        except IndexError:
+            msg = "MySQL Error: %s" % (str(e),)
+        if self.logger:
+            self.logger.error(msg)
+        else:
+            print(msg)
+        return msg
+
+    @property
+    def config(self):
+        if self._config is None:
+            config_stream = open("config.json", "r")
+            self._config = json.load(config_stream)
+            config_stream.close()
+        return self._config
+
+    @property
+    def retention_hours(self):
+        return self.config.get("command_retention", {}).get("retention_hours", RETENTION_HOURS)
+
+    @property
+    def archive_directory(self):
+        return self.config.get("command_retention", {}).get("archive_directory") or None
+
+    @property
+    def dispatch_event_type_id(self):
+        if self._dispatch_event_type_id is None:
+            self._dispatch_event_type_id = events.Event(DISPATCH_EVENT_TYPE, self.db, self.logger).event_type_id
+        return self._dispatch_event_type_id
+
+    def claim_command(self, node_id, ip_addr=None, directed=False):
+        """Claims the next command for node_id, see claim_commands.
+
+        :return: the command data with command_id, event_id and directed added, None when
+        there is nothing to claim or on error"""
+        commands = self.claim_commands(node_id, ip_addr, directed, limit=1)
+        if commands:
+            return commands[0]
+        return None
+
+    def fair_share(self):
+        """Undirected commands one node may claim at once: the pending ones split across synchronized nodes"""
+        c = self.db.cursor()
+        c.execute("SELECT IFNULL(SUM(pending),0) FROM queue_depth WHERE node_id=0")
+        pending = max(0, int(c.fetchone()[0]))
+        c.execute("SELECT COUNT(*) FROM ethereum_network WHERE status=%s", (Database.ETH_NODE_STATUS_SYNCED,))
+        nodes = max(1, c.fetchone()[0])
+        c.close()
+        return max(1, -(-pending // nodes))
+
+    def claim_commands(self, node_id, ip_addr=None, directed=False, limit=DISPATCH_BATCH_LIMIT):
+        """Claims up to limit commands for node_id in one transaction.
+
+        Undirected claims take commands posted for any node and assign them to node_id, at most the
+        node's fair share of them; directed claims take commands posted for node_id. The dispatch
+        events of all claimed commands are logged with one multi-row insert.
+
+        :return: list of command data with command_id, event_id and directed added, empty when
+        there is nothing to claim, None on error"""
+        limit = max(1, min(limit, DISPATCH_BATCH_LIMIT))
+        event_type_id = self.dispatch_event_type_id
+        try:
+            c = self.db.cursor()
+            if directed:
+                c.execute("SELECT command_id, command, command_type FROM commands WHERE dispatch_event_id IS NULL "
+                          "AND node_id=%s ORDER BY priority DESC, command_id LIMIT %s FOR UPDATE SKIP LOCKED",
+                          (node_id, limit))
+            else:
+                if limit > 1:
+                    limit = min(limit, self.fair_share())
+                c.execute("SELECT command_id, command, command_type FROM commands WHERE dispatch_event_id IS NULL "
+                          "AND node_id IS NULL ORDER BY priority DESC, command_id LIMIT %s FOR UPDATE SKIP LOCKED",
+                          (limit,))
+            rows = list(c.fetchall())
+            if not rows:
+                self.db.commit()
+                return []
+            commands = []
+            event_rows = []
+            claimed_types = {}
+            for command_id, command, claimed_type in rows:
+                claimed_types[claimed_type] = claimed_types.get(claimed_type, 0) + 1
+                command_data = json.loads(command)
+                event_data = {"ip_address": ip_addr,
+                              "node_id": node_id,
+                              "command": json.dumps(command_data),
+                              "command_id": command_id}
+                event_rows.append((event_type_id, node_id, json.dumps(event_data)))
+                commands.append(command_data)
+            # one multi-row insert, its auto increment ids are consecutive from lastrowid
+            c.executemany("INSERT INTO event_log (event_type_id, user_id, event_data) VALUES (%s,%s,%s)", event_rows)
+            first_event_id = c.lastrowid
+            cases = []
+            params = []
+            for x in range(0, len(rows)):
+                cases.append("WHEN %s THEN %s")
+                params.extend([rows[x][0], first_event_id + x])
+            sql = "UPDATE commands SET dispatch_event_id=CASE command_id " + " ".join(cases) + " END, "
+            sql += "dispatched=NOW(), lease_expires=NOW() + INTERVAL %s SECOND, attempts=attempts+1"
+            params.append(LEASE_SECONDS)
+            if not directed:
+                sql += ", node_id=%s"
+                params.append(node_id)
+            sql += " WHERE command_id IN (" + ",".join(["%s"] * len(rows)) + ")"
+            c.execute(sql, params + [row[0] for row in rows])
+            for each_type in claimed_types:
+                add_to_queue_depth(c, node_id if directed else None, -claimed_types[each_type], each_type)
+            self.db.commit()
+            for x in range(0, len(rows)):
+                commands[x]["command_id"] = rows[x][0]
+                commands[x]["event_id"] = first_event_id + x
+                commands[x]["directed"] = directed
+            return commands
+        except MySQLdb.Error as e:
+            self.db.rollback()
+            self.log_error(e)
+        return None
+
+    def latest_command_id(self):
+        """Newest command id, read from the end of the primary key; it changes whenever any worker posts"""
+        c = self.db.cursor()
+        c.execute("SELECT MAX(command_id) FROM commands")
+        row = c.fetchone()
+        c.close()
+        # end the read so the next check sees commands committed since
+        self.db.commit()
+        return row[0]
+
+    def wait_for_commands(self, node_id, ip_addr=None, directed=False, limit=DISPATCH_BATCH_LIMIT,
+                          timeout=LONG_POLL_TIMEOUT):
+        """Claims commands like claim_commands, waiting up to timeout seconds for some to be posted.
+
+        Past LONG_POLL_MAX_WAITERS held requests in this worker it claims once and answers at once.
+
+        :return: list of claimed commands, empty when none were posted in time, None on error"""
+        if not long_poll_slots.acquire(blocking=False):
+            return self.claim_commands(node_id, ip_addr, directed, limit)
+        try:
+            deadline = time.monotonic() + min(timeout, LONG_POLL_TIMEOUT)
+            while True:
+                sequence = command_notifier.sequence
+                commands = self.claim_commands(node_id, ip_addr, directed, limit)
+                if commands is None or commands:
+                    return commands
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                # woken by a post (here or, through the watcher, in another worker) or retried after
+                # LONG_POLL_RECLAIM_INTERVAL for commands requeued by a reaper
+                command_notifier.wait(sequence, min(remaining, LONG_POLL_RECLAIM_INTERVAL))
+        finally:
+            long_poll_slots.release()
+
+    def complete_command(self, command_id, node_id):
+        """Records that node_id reported the command's output, ending its lease"""
+        try:
+            c = self.db.cursor()
+            c.execute("SELECT TIMESTAMPDIFF(MICROSECOND, dispatched, NOW()) FROM commands WHERE command_id=%s "
+                      "AND node_id=%s AND completed IS NULL FOR UPDATE", (command_id, node_id))
+            row = c.fetchone()
+            if not row:
+                self.db.commit()
+                return False
+            # the key is released, the same work can be requested again
+            c.execute("UPDATE commands SET completed=NOW(), lease_expires=NULL, idempotency_key=NULL "
+                      "WHERE command_id=%s", (command_id,))
+            record_completion(c, node_id, completed=1)
+            self.db.commit()
+            if row[0] is not None:
+                dispatch_latency.add(row[0] / 1000000.0)
+            return True
+        except MySQLdb.Error as e:
+            self.db.rollback()
+            self.log_error(e)
+        return False
+
+    def fail_command(self, command_id, node_id):
+        """Puts a command node_id reported as failed back in the queue, or dead-letters it after MAX_ATTEMPTS"""
+        try:
+            c = self.db.cursor()
+            c.execute("SELECT attempts, directed, command_type FROM commands WHERE command_id=%s AND node_id=%s "
+                      "AND completed IS NULL AND dead_lettered IS NULL FOR UPDATE", (command_id, node_id))
+            row = c.fetchone()
+            if not row:
+                self.db.commit()
+                return False
+            if row[0] >= MAX_ATTEMPTS:
+                c.execute("UPDATE commands SET lease_expires=NULL, dead_lettered=NOW(), idempotency_key=NULL "
+                          "WHERE command_id=%s", (command_id,))
+            else:
+                c.execute("UPDATE commands SET lease_expires=NULL, dispatch_event_id=NULL, "
+                          "node_id=IF(directed,node_id,NULL) WHERE command_id=%s", (command_id,))
+                add_to_queue_depth(c, node_id if row[1] else None, 1, row[2])
+            record_completion(c, node_id, failed=1)
+            self.db.commit()
+            if row[0] < MAX_ATTEMPTS:
+                command_notifier.notify()
+            return True
+        except MySQLdb.Error as e:
+            self.db.rollback()
+            self.log_error(e)
+        return False
+
+    def reap_expired_leases(self, batch_size=REAP_BATCH_SIZE):
+        """Requeues commands whose lease expired without output and dead-letters those out of attempts.
+
+        Both are bulk UPDATEs over the lease_expires index, batch_size rows per statement.
+        :return: (requeued, dead_lettered) or None on error"""
+        requeued = 0
+        dead_lettered = 0
+        try:
+            c = self.db.cursor()
+            while True:
+                sql = "UPDATE commands SET lease_expires=NULL, dead_lettered=NOW(), idempotency_key=NULL "
+                sql += "WHERE lease_expires < NOW() AND attempts >= %s ORDER BY lease_expires LIMIT %s"
+                c.execute(sql, (MAX_ATTEMPTS, batch_size))
+                self.db.commit()
+                dead_lettered += c.rowcount
+                if c.rowcount < batch_size:
+                    break
+            while True:
+                # the rows are read first to know which counters they go back to
+                c.execute("SELECT command_id, directed, node_id, command_type FROM commands "
+                          "WHERE lease_expires < NOW() ORDER BY lease_expires LIMIT %s FOR UPDATE SKIP LOCKED",
+                          (batch_size,))
+                rows = c.fetchall()
+                if rows:
+                    sql = "UPDATE commands SET lease_expires=NULL, dispatch_event_id=NULL, "
+                    sql += "node_id=IF(directed,node_id,NULL) "
+                    sql += "WHERE command_id IN (" + ",".join(["%s"] * len(rows)) + ")"
+                    c.execute(sql, [row[0] for row in rows])
+                    depth = {}
+                    for command_id, directed, node_id, requeued_type in rows:
+                        key = (node_id if directed else None, requeued_type)
+                        depth[key] = depth.get(key, 0) + 1
+                    for key in depth:
+                        add_to_queue_depth(c, key[0], depth[key], key[1])
+                self.db.commit()
+                requeued += len(rows)
+                if len(rows) < batch_size:
+                    break
+            if requeued:
+                command_notifier.notify()
+            return requeued, dead_lettered
+        except MySQLdb.Error as e:
+            self.db.rollback()
+            self.log_error(e)
+        return None
+
+    def purge_completed(self, retention_hours=None, archive_directory=None, chunk_size=RETENTION_CHUNK_SIZE):
+        """Deletes commands completed or dead-lettered more than retention_hours ago, chunk_size rows per transaction.
+
+        With an archive_directory the rows of each chunk are appended to that day's gzipped NDJSON
+        archive before the chunk is deleted; a crash between the two can archive a chunk twice.
+        :return: number of commands deleted, or None on error"""
+        if retention_hours is None:
+            retention_hours = self.retention_hours
+        if archive_directory is None:
+            archive_directory = self.archive_directory
+        purged = 0
+        try:
+            c = self.db.cursor()
+            # dead-lettered commands never complete, they age out from their dead-letter time
+            for column in ("completed", "dead_lettered"):
+                while True:
+                    sql = "SELECT command_id,node_id,command,priority,directed,attempts,created,dispatched,completed,"
+                    sql += "dispatch_event_id,dead_lettered FROM commands WHERE " + column
+                    sql += " < NOW() - INTERVAL %s HOUR ORDER BY " + column + " LIMIT %s FOR UPDATE SKIP LOCKED"
+                    c.execute(sql, (retention_hours, chunk_size))
+                    rows = c.fetchall()
+                    if not rows:
+                        self.db.commit()
+                        break
+                    if archive_directory:
+                        self.archive_commands(archive_directory, rows)
+                    c.execute("DELETE FROM commands WHERE command_id IN (" + ",".join(["%s"] * len(rows)) + ")",
+                              [row[0] for row in rows])
+                    self.db.commit()
+                    purged += len(rows)
+                    if len(rows) < chunk_size:
+                        break
+            c.execute("DELETE FROM command_completions WHERE minute < NOW() - INTERVAL %s HOUR", (retention_hours,))
+            self.db.commit()
+            return purged
+        except MySQLdb.Error as e:
+            self.db.rollback()
+            self.log_error(e)
+        except OSError as e:
+            # nothing of the chunk is deleted when its archive can't be written
+            self.db.rollback()
+            if self.logger:
+                self.logger.error("Command archive: %s" % (str(e),))
+            else:
+                print("Command archive: %s" % (str(e),))
+        return None
+
+    def archive_commands(self, archive_directory, rows):
+        filename = "commands-{0}-{1}.ndjson.gz".format(datetime.date.today().isoformat(), os.getpid())
+        # appending writes another gzip member, zcat and gzip.open read the members as one stream
+        archive = gzip.open(os.path.join(archive_directory, filename), "at")
+        for row in rows:
+            archive.write(json.dumps({"command_id": row[0],
+                                      "node_id": row[1],
+                                      "command": json.loads(row[2]),
+                                      "priority": row[3],
+                                      "directed": bool(row[4]),
+                                      "attempts": row[5],
+                                      "created": row[6].isoformat(),
+                                      "dispatched": row[7].isoformat() if row[7] else None,
+                                      "completed": row[8].isoformat() if row[8] else None,
+                                      "dispatch_event_id": row[9],
+                                      "dead_lettered": row[10].isoformat() if row[10] else None}) + "\n")
+        archive.close()
+
+    def queue_metrics(self, window=METRICS_WINDOW_MINUTES):
+        """Queue health from counters: a few counter rows, one pending-index lookup and this worker's histogram.
+
+        :return: {"depth": [{"node_id", "command_type", "pending"}], "pending": total, "oldest_pending_seconds",
+        "latency": dispatch-to-output percentiles, "nodes": [{"node_id", "completed", "failed",
+        "completion_rate", "completed_per_minute"}], "window_minutes", "worker"} or None on error"""
+        try:
+            c = self.db.cursor()
+            c.execute("SELECT node_id, command_type, SUM(pending) FROM queue_depth GROUP BY node_id, command_type "
+                      "ORDER BY node_id, command_type")
+            depth = [{"node_id": row[0] or None, "command_type": row[1], "pending": int(row[2])} for row in c]
+            # the oldest pending row is the first entry of the (dispatch_event_id, command_id) index, one probe
+            c.execute("SELECT TIMESTAMPDIFF(SECOND, created, NOW()) FROM commands WHERE dispatch_event_id IS NULL "
+                      "ORDER BY command_id LIMIT 1")
+            row = c.fetchone()
+            oldest_pending_seconds = row[0] if row else None
+            c.execute("SELECT node_id, SUM(completed), SUM(failed) FROM command_completions "
+                      "WHERE minute >= NOW() - INTERVAL %s MINUTE GROUP BY node_id ORDER BY node_id", (window,))
+            nodes = []
+            for row in c:
+                completed = int(row[1])
+                failed = int(row[2])
+                nodes.append({"node_id": row[0],
+                              "completed": completed,
+                              "failed": failed,
+                              "completion_rate": completed / (completed + failed) if completed + failed else None,
+                              "completed_per_minute": completed / float(window)})
+            c.close()
+            self.db.commit()
+            return {"depth": depth,
+                    "pending": sum(each["pending"] for each in depth),
+                    "oldest_pending_seconds": oldest_pending_seconds,
+                    "latency": dispatch_latency.percentiles(),
+                    "nodes": nodes,
+                    "window_minutes": window,
+                    "worker": os.getpid()}
+        except MySQLdb.Error as e:
+            self.log_error(e)
+        return None
+
+    def reconcile_queue_depth(self):
+        """Recounts the queue_depth counters from commands, returns True on success.
+
+        The counter rows are locked first: a writer that has not adjusted its counter yet is not
+        committed either, so the recount neither sees its commands nor loses its adjustment."""
+        try:
+            c = self.db.cursor()
+            c.execute("SELECT node_id FROM queue_depth FOR UPDATE")
+            c.fetchall()
+            c.execute("DELETE FROM queue_depth")
+            c.execute("INSERT INTO queue_depth (node_id,command_type,shard,pending) "
+                      "SELECT IFNULL(node_id,0),command_type,0,COUNT(*) FROM commands WHERE dispatch_event_id IS NULL "
+                      "GROUP BY IFNULL(node_id,0),command_type")
+            self.db.commit()
+            c.close()
+            return True
+        except MySQLdb.Error as e:
+            self.db.rollback()
+            self.log_error(e)
+        return False
+
+
+class CommandReaper(threading.Thread):
+    """Daemon thread that returns commands with expired leases to the queue"""
+
+    def __init__(self, logger=None, interval=REAP_INTERVAL):
+        threading.Thread.__init__(self, name="command-reaper", daemon=True)
+        self.logger = logger
+        self.interval = interval
+        self.wakeup = threading.Event()
+
+    def wake(self):
+        self.wakeup.set()
+
+    def run(self):
+        queue = None
+        last_reconciled = time.monotonic()
+        last_purged = 0
+        while True:
+            if queue is None:
+                try:
+                    queue = CommandQueue(Database(self.logger), self.logger)
+                except MySQLdb.Error as e:
+                    if self.logger:
+                        self.logger.error("Command reaper: %s" % (str(e),))
+            if queue is not None:
+                reaped = queue.reap_expired_leases()
+                if reaped is None:
+                    # reconnect on the next pass
+                    queue = None
+                elif any(reaped) and self.logger:
+                    self.logger.info("Requeued {0} commands with expired leases, "
+                                     "dead-lettered {1}.".format(reaped[0], reaped[1]))
+                if queue is not None and time.monotonic() - last_reconciled >= RECONCILE_INTERVAL:
+                    if queue.reconcile_queue_depth():
+                        last_reconciled = time.monotonic()
+                if queue is not None and time.monotonic() - last_purged >= RETENTION_INTERVAL:
+                    purged = queue.purge_completed()
+                    if purged is not None:
+                        last_purged = time.monotonic()
+                        if purged and self.logger:
+                            self.logger.info("Purged {0} completed and dead-lettered commands.".format(purged))
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+
+class CommandWatcher(threading.Thread):
+    """Daemon thread that wakes this worker's long-polls when another worker posts a command"""
+
+    def __init__(self, logger=None, interval=LONG_POLL_CHECK_INTERVAL):
+        threading.Thread.__init__(self, name="command-watcher", daemon=True)
+        self.logger = logger
+        self.interval = interval
+
+    def run(self):
+        queue = None
+        last_command_id = None
+        while True:
+            if not command_notifier.waiting:
+                # nobody to wake, a new long-poll claims before it waits
+                last_command_id = None
+            else:
+                try:
+                    if queue is None:
+                        queue = CommandQueue(Database(self.logger), self.logger)
+                    latest = queue.latest_command_id()
+                    if last_command_id is not None and latest != last_command_id:
+                        command_notifier.notify()
+                    last_command_id = latest
+                except MySQLdb.Error as e:
+                    if self.logger:
+                        self.logger.error("Command watcher: %s" % (str(e),))
+                    # reconnect on the next pass
+                    queue = None
+            time.sleep(self.interval)
+
+
+long_poll_slots = threading.BoundedSemaphore(LONG_POLL_MAX_WAITERS)
+reaper = None
+watcher = None
+
+
+def start_reaper(logger=None):
+    """Starts this worker's lease reaper thread, once"""
+    global reaper
+    if reaper is None:
+        reaper = CommandReaper(logger)
+        reaper.start()
+    return reaper
+
+
+def start_watcher(logger=None):
+    """Starts this worker's command watcher thread for long-polls, once"""
+    global watcher
+    if watcher is None:
+        watcher = CommandWatcher(logger)
+        watcher.start()
+    return watcher
+
+
+if __name__ == "__main__":
+    HELP = """python command_queue.py command
+
+        reconcile                    recounts the queue_depth counters from commands
+        purge [retention hours]      deletes (and archives, see config.json) completed and dead-lettered commands
+
+        python command_queue.py purge 48
+"""
+    if len(sys.argv) < 2:
+        print(HELP)
+    else:
+        command = sys.argv[1]
+        if command == "reconcile":
+            if CommandQueue(Database()).reconcile_queue_depth():
+                print("Reconciled queue depth counters.")
+        elif command == "purge":
+            queue = CommandQueue(Database())
+            if len(sys.argv) > 2:
+                purged = queue.purge_completed(int(sys.argv[2]))
+            else:
+                purged = queue.purge_completed()
+            if purged is not None:
+                print("Purged {0} completed and dead-lettered commands.".format(purged))
+        else:
+            print("Unknown command.\n\n")
+            print(HELP)
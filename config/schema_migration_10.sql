@@ -0,0 +1,5 @@
+--
+-- Keyset pages and exports of a contract's tokens walk (smart_contract_id, serial);
+-- tokens_smart_contract_id_index used to serve this ordering and was dropped in migration 8.
+--
+CREATE INDEX tokens_smart_contract_id_serial_index ON tokens (smart_contract_id, serial);
@@ -0,0 +1,16 @@
+--
+-- When a contract's publish was requested, recorded on the contract itself. The admin tokens page used to
+-- rebuild this by decoding every "ERC20 Token Mined" event of the user; a contract is pending while
+-- publish_requested is set and eth_address is not.
+--
+ALTER TABLE smart_contracts ADD COLUMN publish_requested datetime DEFAULT NULL;
+CREATE INDEX smart_contracts_owner_id_index ON smart_contracts (owner_id);
+
+UPDATE smart_contracts s
+  INNER JOIN (SELECT CAST(JSON_UNQUOTE(JSON_EXTRACT(l.event_data, '$.token_id')) AS UNSIGNED) AS smart_contract_id,
+                     MIN(l.created) AS requested
+              FROM event_log l INNER JOIN event_type t ON l.event_type_id = t.event_type_id
+              WHERE t.event_type = 'ERC20 Token Mined'
+              GROUP BY smart_contract_id) m
+    ON s.id = m.smart_contract_id
+SET s.publish_requested = m.requested;
@@ -0,0 +1,6 @@
+--
+-- Content hash of the rendered Solidity source, stored once when a contract is created;
+-- view-source responses use it as their ETag. Existing contracts are hashed in place.
+--
+ALTER TABLE smart_contracts ADD COLUMN source_hash char(64) DEFAULT NULL;
+UPDATE smart_contracts SET source_hash = SHA2(solidity_source, 256) WHERE solidity_source IS NOT NULL;
@@ -0,0 +1,7 @@
+--
+-- Undirected commands are posted without a node and claimed by the first node to ask for one.
+-- The claim looks up undispatched rows by (dispatch_event_id, node_id) in command_id order;
+-- the index covers it, so SKIP LOCKED only ever touches the rows it returns.
+--
+ALTER TABLE commands MODIFY node_id smallint(5) unsigned DEFAULT NULL;
+CREATE INDEX commands_dispatch_event_id_node_id_index ON commands (dispatch_event_id, node_id, command_id);
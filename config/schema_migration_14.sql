@@ -0,0 +1,12 @@
+--
+-- Explicit command priority. Priority used to be encoded as a node_id above 9 (MAX_NODES), which capped
+-- the cluster at nine nodes; those commands become undirected commands with their priority, capped at 255.
+-- Claims read undispatched rows per node in (priority DESC, command_id) order, which the index serves
+-- directly; it replaces the claim index from migration 13.
+--
+ALTER TABLE commands ADD COLUMN priority tinyint(3) unsigned NOT NULL DEFAULT 0;
+UPDATE commands SET priority = LEAST(node_id, 255) WHERE node_id > 9;
+UPDATE commands SET node_id = NULL WHERE node_id > 9 AND dispatch_event_id IS NULL;
+CREATE INDEX commands_dispatch_event_id_node_id_priority_index
+  ON commands (dispatch_event_id, node_id, priority DESC, command_id);
+DROP INDEX commands_dispatch_event_id_node_id_index ON commands;
@@ -0,0 +1,15 @@
+--
+-- Command leases. A claim sets dispatched and a lease_expires deadline and counts an attempt; output
+-- sets completed. The reaper returns commands whose lease expired to the queue (undirected ones lose
+-- the node that claimed them, directed ones keep theirs) and dead-letters those out of attempts.
+-- Commands dispatched before this migration have no lease and are never reaped.
+--
+ALTER TABLE commands
+  ADD COLUMN directed tinyint(1) NOT NULL DEFAULT 0,
+  ADD COLUMN attempts tinyint(3) unsigned NOT NULL DEFAULT 0,
+  ADD COLUMN dispatched datetime DEFAULT NULL,
+  ADD COLUMN lease_expires datetime DEFAULT NULL,
+  ADD COLUMN completed datetime DEFAULT NULL,
+  ADD COLUMN dead_lettered datetime DEFAULT NULL;
+UPDATE commands SET directed = 1 WHERE node_id IS NOT NULL AND dispatch_event_id IS NULL;
+CREATE INDEX commands_lease_expires_index ON commands (lease_expires);
@@ -0,0 +1,7 @@
+--
+-- Optional idempotency key per command, e.g. get_block_data:<block number>. A post with the key of a
+-- command that is queued or in flight is absorbed by the unique index; completing or dead-lettering a
+-- command clears its key so the same work can be requested again.
+--
+ALTER TABLE commands ADD COLUMN idempotency_key varchar(64) DEFAULT NULL;
+CREATE UNIQUE INDEX commands_idempotency_key_uindex ON commands (idempotency_key);
@@ -0,0 +1,15 @@
+--
+-- Pending command counters per node (node_id 0: undirected commands), adjusted in the same transaction as
+-- every post, claim and requeue. Each node has up to QUEUE_DEPTH_SHARDS rows, the depth is their sum.
+-- Recount at any time with: python command_queue.py reconcile
+--
+CREATE TABLE queue_depth
+(
+    node_id smallint(5) unsigned NOT NULL,
+    shard tinyint(3) unsigned NOT NULL,
+    pending bigint(20) NOT NULL DEFAULT 0,
+    PRIMARY KEY (node_id, shard)
+);
+
+INSERT INTO queue_depth (node_id, shard, pending)
+  SELECT IFNULL(node_id, 0), 0, COUNT(*) FROM commands WHERE dispatch_event_id IS NULL GROUP BY IFNULL(node_id, 0);
@@ -0,0 +1,4 @@
+--
+-- Completed commands are purged in completed order once past their retention (python command_queue.py purge).
+--
+CREATE INDEX commands_completed_index ON commands (completed);
@@ -0,0 +1,28 @@
+--
+-- Commands carry their type (the erc20_function, get_block_data or other) and pending counters are kept
+-- per node and command type, the admin queue page reads depth by type from queue_depth alone.
+--
+ALTER TABLE commands ADD COLUMN command_type varchar(32) NOT NULL DEFAULT 'other';
+
+UPDATE commands SET command_type=IFNULL(JSON_UNQUOTE(JSON_EXTRACT(command, '$.erc20_function')),
+    IF(JSON_CONTAINS_PATH(command, 'one', '$.get_block_data'), 'get_block_data', 'other'));
+
+ALTER TABLE queue_depth ADD COLUMN command_type varchar(32) NOT NULL DEFAULT 'other' AFTER node_id,
+    DROP PRIMARY KEY, ADD PRIMARY KEY (node_id, command_type, shard);
+
+DELETE FROM queue_depth;
+
+INSERT INTO queue_depth (node_id, command_type, shard, pending)
+  SELECT IFNULL(node_id, 0), command_type, 0, COUNT(*) FROM commands WHERE dispatch_event_id IS NULL
+  GROUP BY IFNULL(node_id, 0), command_type;
+--
+-- Command outputs and failures per node and minute, counted with each output, purged with completed commands.
+--
+CREATE TABLE command_completions
+(
+    minute datetime NOT NULL,
+    node_id smallint(5) unsigned NOT NULL,
+    completed int(10) unsigned NOT NULL DEFAULT 0,
+    failed int(10) unsigned NOT NULL DEFAULT 0,
+    PRIMARY KEY (minute, node_id)
+);
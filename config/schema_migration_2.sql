@@ -0,0 +1,5 @@
+--
+-- Wallet pages are keyset-paginated by serial per owner
+--
+
+CREATE INDEX tokens_owner_id_serial_index ON tokens (owner_id, serial);
@@ -0,0 +1,17 @@
+--
+-- Per-owner token counters, adjusted in the same transaction as assign and unassign move tokens.
+-- The primary key serves both the per-owner total (wallet, admin user list) and one contract's count.
+-- Rebuilt along with token_supply by: python smart_contract.py rebuild-supply [smart_contract_id]
+--
+
+CREATE TABLE token_holdings
+(
+    owner_id int(10) unsigned NOT NULL,
+    smart_contract_id smallint(5) unsigned NOT NULL,
+    tokens bigint(20) NOT NULL DEFAULT 0,
+    PRIMARY KEY (owner_id, smart_contract_id)
+);
+
+INSERT INTO token_holdings (owner_id, smart_contract_id, tokens)
+  SELECT owner_id, smart_contract_id, COUNT(*) FROM tokens
+  WHERE owner_id IS NOT NULL AND smart_contract_id IS NOT NULL GROUP BY owner_id, smart_contract_id;
@@ -0,0 +1,6 @@
+--
+-- Oldest pending command for queue metrics: the first undispatched row in command_id order. The claim index
+-- has node_id and priority between dispatch_event_id and command_id, so it can't serve that order; this one
+-- answers it with a single index probe.
+--
+CREATE INDEX commands_dispatch_event_id_command_id_index ON commands (dispatch_event_id, command_id);
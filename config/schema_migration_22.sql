@@ -0,0 +1,5 @@
+--
+-- Dead-lettered commands never complete; they are purged in dead_lettered order once past the
+-- completed commands' retention (python command_queue.py purge).
+--
+CREATE INDEX commands_dead_lettered_index ON commands (dead_lettered);
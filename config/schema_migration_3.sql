@@ -0,0 +1,9 @@
+--
+-- Address history: transfers by sender/receiver, newest first, keyset on (block_data_id, txid)
+--
+
+CREATE INDEX external_transaction_ledger_sender_index
+  ON external_transaction_ledger (sender_address_id, block_data_id, txid);
+CREATE INDEX external_transaction_ledger_receiver_index
+  ON external_transaction_ledger (received_address_id, block_data_id, txid);
+CREATE INDEX ethereum_address_pool_ethereum_address_index ON ethereum_address_pool (ethereum_address);
@@ -0,0 +1,6 @@
+--
+-- Transaction hash lookups (block_data.block_hash is already covered by block_data_block_hash_uindex)
+--
+
+CREATE INDEX external_transaction_ledger_transaction_hash_index
+  ON external_transaction_ledger (transaction_hash);
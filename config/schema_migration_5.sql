@@ -0,0 +1,6 @@
+--
+-- Address claiming: free addresses (assigned IS NULL) newest first, also covers the refiller's pool level COUNT
+-- Claims use SELECT ... FOR UPDATE SKIP LOCKED, which needs MySQL 8.0
+--
+
+CREATE INDEX ethereum_address_pool_assigned_index ON ethereum_address_pool (assigned, id);
@@ -0,0 +1,38 @@
+--
+-- One row per address: add_new_ethereum_address used to insert a new row every time an address was seen.
+-- Point every reference at the oldest row for its address, drop the duplicates and make the index unique.
+--
+
+CREATE TEMPORARY TABLE ethereum_address_pool_canonical
+  SELECT p.id, c.canonical_id
+  FROM ethereum_address_pool p
+  INNER JOIN (SELECT ethereum_address, MIN(id) AS canonical_id FROM ethereum_address_pool
+              WHERE ethereum_address IS NOT NULL GROUP BY ethereum_address HAVING COUNT(*) > 1) c
+    ON p.ethereum_address = c.ethereum_address AND p.id <> c.canonical_id;
+ALTER TABLE ethereum_address_pool_canonical ADD PRIMARY KEY (id);
+
+UPDATE tokens t INNER JOIN ethereum_address_pool_canonical m ON t.eth_address = m.id
+  SET t.eth_address = m.canonical_id;
+UPDATE smart_contracts s INNER JOIN ethereum_address_pool_canonical m ON s.eth_address = m.id
+  SET s.eth_address = m.canonical_id;
+UPDATE external_tokens t INNER JOIN ethereum_address_pool_canonical m ON t.eth_address = m.id
+  SET t.eth_address = m.canonical_id;
+UPDATE external_erc20_contracts e INNER JOIN ethereum_address_pool_canonical m ON e.eth_address = m.id
+  SET e.eth_address = m.canonical_id;
+UPDATE external_transaction_ledger l INNER JOIN ethereum_address_pool_canonical m ON l.sender_address_id = m.id
+  SET l.sender_address_id = m.canonical_id;
+UPDATE external_transaction_ledger l INNER JOIN ethereum_address_pool_canonical m ON l.received_address_id = m.id
+  SET l.received_address_id = m.canonical_id;
+
+-- a canonical row that was only seen on chain keeps the earliest assignment of any of its duplicates
+UPDATE ethereum_address_pool p
+  INNER JOIN (SELECT m.canonical_id, MIN(d.assigned) AS assigned FROM ethereum_address_pool_canonical m
+              INNER JOIN ethereum_address_pool d ON d.id = m.id GROUP BY m.canonical_id) a
+    ON p.id = a.canonical_id
+  SET p.assigned = IFNULL(p.assigned, a.assigned);
+
+DELETE p FROM ethereum_address_pool p INNER JOIN ethereum_address_pool_canonical m ON p.id = m.id;
+DROP TEMPORARY TABLE ethereum_address_pool_canonical;
+
+DROP INDEX ethereum_address_pool_ethereum_address_index ON ethereum_address_pool;
+CREATE UNIQUE INDEX ethereum_address_pool_ethereum_address_uindex ON ethereum_address_pool (ethereum_address);
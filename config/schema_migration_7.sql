@@ -0,0 +1,22 @@
+--
+-- Bulk token issuance jobs, worked through in chunks by a background thread in each uWSGI worker.
+-- issued is advanced in the same transaction as each chunk's tokens and commands, so a job resumes
+-- exactly where it stopped after a failure or a worker restart.
+--
+
+CREATE TABLE token_issuance_jobs
+(
+    id bigint(20) unsigned PRIMARY KEY AUTO_INCREMENT,
+    smart_contract_id smallint(5) unsigned NOT NULL,
+    requested_by int(10) unsigned DEFAULT NULL,
+    requested int(10) unsigned NOT NULL,
+    issued int(10) unsigned NOT NULL DEFAULT 0,
+    status ENUM('pending', 'running', 'complete', 'failed') NOT NULL DEFAULT 'pending',
+    error_message varchar(255) DEFAULT NULL,
+    heartbeat DATETIME DEFAULT NULL,
+    created timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    completed DATETIME DEFAULT NULL
+);
+
+CREATE INDEX token_issuance_jobs_status_index ON token_issuance_jobs (status, heartbeat);
+CREATE INDEX token_issuance_jobs_smart_contract_id_index ON token_issuance_jobs (smart_contract_id, id);
@@ -0,0 +1,11 @@
+--
+-- Set-based token assignment: UPDATE ... LIMIT n stamps the tokens it moves with a claim marker,
+-- then INSERT ... SELECT writes their ledger rows by that marker, in one transaction.
+-- (smart_contract_id, owner_id, serial) serves the unassigned (owner_id IS NULL) and per-owner lookups
+-- and replaces tokens_smart_contract_id_index, which is its prefix.
+--
+
+ALTER TABLE tokens ADD claim_marker bigint(20) unsigned DEFAULT NULL;
+CREATE INDEX tokens_claim_marker_index ON tokens (claim_marker);
+CREATE INDEX tokens_smart_contract_id_owner_id_index ON tokens (smart_contract_id, owner_id, serial);
+DROP INDEX tokens_smart_contract_id_index ON tokens;
@@ -0,0 +1,17 @@
+--
+-- Per-contract token counters, adjusted in the same transaction as the token rows they count.
+-- tokens_created: rows in tokens, tokens_issued: mined (tokens.issued set), tokens_assigned: owner_id set.
+-- Rebuild from tokens at any time with: python smart_contract.py rebuild-supply [smart_contract_id]
+--
+
+CREATE TABLE token_supply
+(
+    smart_contract_id smallint(5) unsigned PRIMARY KEY,
+    tokens_created bigint(20) NOT NULL DEFAULT 0,
+    tokens_issued bigint(20) NOT NULL DEFAULT 0,
+    tokens_assigned bigint(20) NOT NULL DEFAULT 0
+);
+
+INSERT INTO token_supply (smart_contract_id, tokens_created, tokens_issued, tokens_assigned)
+  SELECT smart_contract_id, COUNT(*), SUM(issued IS NOT NULL), SUM(owner_id IS NOT NULL)
+  FROM tokens WHERE smart_contract_id IS NOT NULL GROUP BY smart_contract_id;
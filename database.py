@@ -9,15 +9,64 @@ import re
 import json
 import binascii
 import os
+import random
 import getpass
 import datetime
 import events
-
-MAX_NODES = 9
+from command_notifier import command_notifier
+
+# commands.priority, higher is dispatched first; a flood of one class can't hold back a higher one
+COMMAND_PRIORITY_BLOCK_DATA = 0
+COMMAND_PRIORITY_ISSUANCE = 50
+COMMAND_PRIORITY_ERC20 = 100
+# queue_depth rows per node, writers pick one at random so concurrent posts and claims rarely share a row lock
+QUEUE_DEPTH_SHARDS = 8
+WALLET_PAGE_LIMIT = 500
+# put_blocks retries a batch that raced a concurrent writer of one of its blocks this many times in all
+PUT_BLOCKS_ATTEMPTS = 3
 
 UUID_REGEX = re.compile("[A-Fa-f0-9]{8}-[A-Fa-f0-9]{4}-[A-Fa-f0-9]{4}-[A-Fa-f0-9]{4}-[A-Fa-f0-9]{12}")
 
 
+def encode_hash(hex_string, binary_hashes):
+    """Convert a 0x prefixed hash or address to the column representation (BINARY(n) in binary mode)
+
+    Raises ValueError in binary mode for a value that is not 0x prefixed hex."""
+    if hex_string is None or not binary_hashes:
+        return hex_string
+    if not hex_string.startswith("0x"):
+        raise ValueError("Not a 0x prefixed hash: {0}".format(hex_string))
+    # binascii.Error is a ValueError, raised for odd lengths and non-hex digits
+    return binascii.unhexlify(hex_string[2:])
+
+
+def decode_hash(value):
+    """Convert a hash or address column value back to a 0x prefixed hex string"""
+    if isinstance(value, (bytes, bytearray)):
+        return "0x" + binascii.hexlify(value).decode()
+    return value
+
+
+def command_type(command_data):
+    """commands.command_type of a command dict or its JSON: the ERC20 function, get_block_data or other"""
+    if isinstance(command_data, str):
+        command_data = json.loads(command_data)
+    if "erc20_function" in command_data:
+        return command_data["erc20_function"]
+    if "get_block_data" in command_data:
+        return "get_block_data"
+    return "other"
+
+
+def add_to_queue_depth(c, node_id, count, command_type="other"):
+    """Adjusts the pending counter of node_id (None for undirected commands) and command_type on
+    cursor c, inside the caller's transaction"""
+    if count:
+        sql = "INSERT INTO queue_depth (node_id,command_type,shard,pending) VALUES (%s,%s,%s,%s) "
+        sql += "ON DUPLICATE KEY UPDATE pending=pending+VALUES(pending)"
+        c.execute(sql, (node_id or 0, command_type, random.randrange(QUEUE_DEPTH_SHARDS), count))
+
+
 def wei_to_ether(wei):
     return 1.0 * wei / 10**18
 
@@ -87,9 +136,14 @@ class Database:
         db_password = config_data['mysql_password']
         db_name = config_data['mysql_database']
         self.db = MySQLdb.connect(db_host, db_username, db_password, db_name)
+        # hashes and addresses are stored as BINARY(32)/BINARY(20) after running hash_migration.py
+        self.binary_hashes = config_data.get("binary_hashes", False)
         self.logger = logger
         self.read_only_mode = read_only_mode
 
+    def encode_hash(self, hex_string):
+        return encode_hash(hex_string, self.binary_hashes)
+
     def close(self):
         self.db.close()
 
@@ -151,25 +205,38 @@ class Database:
         return None
 
     def put_block(self, block_data):
+        """Stores a block and its transactions in one transaction.
+
+        :return: True when stored or when the block was stored already (e.g. by a node redoing an expired
+        lease), False on error, nothing is stored then"""
         try:
             sql = "INSERT INTO block_data (block_number, block_hash, block_timestamp, gas_used, gas_limit, block_size,"
             sql += "tx_count) VALUES (%s,%s,%s,%s,%s,%s,%s)"
             c = self.db.cursor()
-            c.execute(sql, (block_data.block_number, block_data.block_hash,
+            c.execute(sql, (block_data.block_number, self.encode_hash(block_data.block_hash),
                             datetime.datetime.fromtimestamp(block_data.block_timestamp),
                             block_data.gas_used, block_data.gas_limit,
                             block_data.block_size, block_data.tx_count))
-            self.db.commit()
             block_data_id = c.lastrowid
             for each_tx in block_data.transactions:
                 sql = "INSERT INTO external_transaction_ledger (sender_address_id, received_address_id,"
                 sql += "amount, transaction_hash, block_data_id, gas_used, priority) "
                 sql += "VALUES (%s,%s,%s,%s,%s,%s,%s)"
-                c.execute(sql, (each_tx.from_address, each_tx.to_address, wei_to_ether(each_tx.wei_value), each_tx.tx_hash,
-                                block_data_id, each_tx.gas, each_tx.gas_price))
+                c.execute(sql, (each_tx.from_address, each_tx.to_address, wei_to_ether(each_tx.wei_value),
+                                self.encode_hash(each_tx.tx_hash), block_data_id, each_tx.gas, each_tx.gas_price))
             self.db.commit()
             return True
+        except ValueError as e:
+            self.db.rollback()
+            if self.logger:
+                self.logger.error("Block data: %s" % (str(e),))
+            else:
+                print("Block data: %s" % (str(e),))
         except MySQLdb.Error as e:
+            self.db.rollback()
+            if e.args and e.args[0] == 1062:
+                # the block is already stored, with its transactions since both are written together
+                return True
             try:
                 error_message = "MySQL Error [%d]: %s" % (e.args[0], e.args[1])
             except IndexError:
@@ -181,6 +248,78 @@ class Database:
                 print(error_message)
         return False
 
+    def put_blocks(self, blocks):
+        """Stores blocks and their transactions in one transaction, one multi-row INSERT per table.
+
+        A block stored by a concurrent writer between the SELECT and the INSERT fails the batch on the
+        unique block_number; it is rolled back and retried, the retry finds the block stored.
+        :return: {block_number: True when stored, False when it was stored already} or None on error,
+        nothing is stored then"""
+        output = {}
+        if not blocks:
+            return output
+        for attempt in range(1, PUT_BLOCKS_ATTEMPTS + 1):
+            try:
+                output = {}
+                c = self.db.cursor()
+                block_numbers = list(set(each.block_number for each in blocks))
+                c.execute("SELECT block_number FROM block_data WHERE block_number IN (" +
+                          ",".join(["%s"] * len(block_numbers)) + ")", block_numbers)
+                stored = set(row[0] for row in c)
+                new_blocks = []
+                for each in blocks:
+                    output[each.block_number] = each.block_number not in stored
+                    if each.block_number not in stored:
+                        stored.add(each.block_number)
+                        new_blocks.append(each)
+                if new_blocks:
+                    sql = "INSERT INTO block_data (block_number, block_hash, block_timestamp, gas_used, gas_limit, "
+                    sql += "block_size,tx_count) VALUES (%s,%s,%s,%s,%s,%s,%s)"
+                    c.executemany(sql, [(each.block_number, self.encode_hash(each.block_hash),
+                                         datetime.datetime.fromtimestamp(each.block_timestamp),
+                                         each.gas_used, each.gas_limit, each.block_size, each.tx_count)
+                                        for each in new_blocks])
+                    # executemany may split a large batch into several statements, look the new ids up
+                    new_block_numbers = [each.block_number for each in new_blocks]
+                    c.execute("SELECT block_number, block_data_id FROM block_data WHERE block_number IN (" +
+                              ",".join(["%s"] * len(new_block_numbers)) + ")", new_block_numbers)
+                    block_data_ids = dict(c.fetchall())
+                    sql = "INSERT INTO external_transaction_ledger (sender_address_id, received_address_id,"
+                    sql += "amount, transaction_hash, block_data_id, gas_used, priority) "
+                    sql += "VALUES (%s,%s,%s,%s,%s,%s,%s)"
+                    txns = []
+                    for each in new_blocks:
+                        for each_tx in each.transactions:
+                            txns.append((each_tx.from_address, each_tx.to_address, wei_to_ether(each_tx.wei_value),
+                                         self.encode_hash(each_tx.tx_hash), block_data_ids[each.block_number],
+                                         each_tx.gas, each_tx.gas_price))
+                    if txns:
+                        c.executemany(sql, txns)
+                self.db.commit()
+                return output
+            except ValueError as e:
+                self.db.rollback()
+                if self.logger:
+                    self.logger.error("Block data: %s" % (str(e),))
+                else:
+                    print("Block data: %s" % (str(e),))
+                return None
+            except MySQLdb.Error as e:
+                self.db.rollback()
+                if e.args and e.args[0] == 1062 and attempt < PUT_BLOCKS_ATTEMPTS:
+                    continue
+                try:
+                    error_message = "MySQL Error [%d]: %s" % (e.args[0], e.args[1])
+                except IndexError:
+                    error_message = "MySQL Error: %s" % (str(e),)
+
+                if self.logger:
+                    self.logger.error(error_message)
+                else:
+                    print(error_message)
+                return None
+        return None
+
     def get_block(self, block_number, no_txns=False):
         try:
             sql = "SELECT block_data_id, block_hash, block_timestamp, gas_used, gas_limit, block_size, tx_count "
@@ -191,7 +330,7 @@ class Database:
             if row:
                 block_data_id = row[0]
                 block_data = {"block_number": block_number,
-                              "block_hash": row[1],
+                              "block_hash": decode_hash(row[1]),
                               "block_timestamp": row[2],
                               "gas_used": row[3],
                               "gas_limit": row[4],
@@ -210,7 +349,7 @@ class Database:
                               "to": row[1],
                               "external_contract_id": row[2],
                               "amount": ether_to_wei(row[3]),
-                              "hash": row[4],
+                              "hash": decode_hash(row[4]),
                               "gas_used": row[5],
                               "priority": row[6],
                               "usd_price": row[7]}
@@ -221,13 +360,13 @@ class Database:
                     c.execute(sql, (each_tx["from"],))
                     row = c.fetchone()
                     if row:
-                        each_tx["from"] = row[0]
+                        each_tx["from"] = decode_hash(row[0])
                     else:
                         each_tx["from"] = None
                     c.execute(sql, (each_tx["to"],))
                     row = c.fetchone()
                     if row:
-                        each_tx["to"] = row[0]
+                        each_tx["to"] = decode_hash(row[0])
                     else:
                         each_tx["to"] = None
 
@@ -468,25 +607,17 @@ class Database:
         return None
 
     def get_pending_commands(self, node_id=None):
+        """(undirected, directed for node_id) pending commands, read from the queue_depth counters"""
         try:
             c = self.db.cursor()
-            c.execute("SELECT COUNT(*) FROM commands WHERE dispatch_event_id IS NULL AND node_id is NULL")
-            row = c.fetchone()
-            undirected_commands = -1
-            if row:
-                undirected_commands = row[0]
+            c.execute("SELECT node_id, SUM(pending) FROM queue_depth WHERE node_id IN (0,%s) GROUP BY node_id",
+                      (node_id or 0,))
+            depth = {row[0]: int(row[1]) for row in c}
+            c.close()
+            undirected_commands = depth.get(0, 0)
             directed_commands = -1
             if node_id:
-                c.execute("SELECT COUNT(*) FROM commands WHERE dispatch_event_id IS NULL AND node_id=%s",
-                          (node_id,))
-                row = c.fetchone()
-                if row:
-                    directed_commands = row[0]
-                c.execute("SELECT COUNT(*) FROM commands WHERE dispatch_event_id IS NULL AND node_id > {0};".format(
-                    MAX_NODES))
-                row = c.fetchone()
-                if row:
-                    directed_commands += row[0]
+                directed_commands = depth.get(node_id, 0)
             return undirected_commands, directed_commands
         except MySQLdb.Error as e:
             try:
@@ -595,14 +726,20 @@ class Database:
     def fetch_commands(self, device_id):
         c = self.db.cursor()
         device_id_param = int(device_id)
-        sql = "SELECT command_id, node_id, command, created FROM commands WHERE node_id=%s"
+        sql = "SELECT command_id, node_id, command, created, dispatch_event_id, command_type FROM commands "
+        sql += "WHERE node_id=%s"
         commands = []
+        pending = {}
         c.execute(sql, (device_id_param,))
-        for row in c:
+        for row in c.fetchall():
             commands.append((row[0], row[2], row[3].isoformat()))
-        for each in commands:
-            sql = "DELETE FROM commands WHERE command_id={0}".format(each[0])
-            c.execute(sql)
+            if row[4] is None:
+                pending[row[5]] = pending.get(row[5], 0) + 1
+        if commands:
+            c.execute("DELETE FROM commands WHERE command_id IN (" + ",".join(["%s"] * len(commands)) + ")",
+                      [each[0] for each in commands])
+            for each_type in pending:
+                add_to_queue_depth(c, device_id_param, -pending[each_type], each_type)
         c.close()
         self.db.commit()
         return commands
@@ -622,7 +759,7 @@ WHERE smart_contracts.id=%s"""
             if row:
                 output = {"token_name": row[0],
                           "ico_tokens": row[1],
-                          "ethereum_address": row[2],
+                          "ethereum_address": decode_hash(row[2]),
                           "max_priority": row[3],
                           "token_symbol": row[4],
                           "published": row[5],
@@ -663,7 +800,7 @@ WHERE smart_contracts.id=%s"""
                     "tokens": row[2],
                     "created": row[3].isoformat(),
                     "max_priority": row[4],
-                    "eth_address": row[5],
+                    "eth_address": decode_hash(row[5]),
                     "token_symbol": row[6],
                     "owner_id": row[7],
                     "published": row[8]
@@ -695,106 +832,58 @@ WHERE smart_contracts.id=%s"""
             return user_info
         return None
 
-    def get_next_undirected_command(self):
-        sql = "SELECT command_id, command FROM commands WHERE dispatch_event_id IS NULL AND node_id IS NULL"
-        sql += " ORDER BY command_id DESC LIMIT 1"
-        try:
-            c = self.db.cursor()
-            c.execute(sql)
-            row = c.fetchone()
-            return row
-        except MySQLdb.Error as e:
-            try:
-                self.logger.error("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-            except IndexError:
-                self.logger.error("MySQL Error: %s" % (str(e),))
-        return None
-
-    def get_next_directed_command(self, node_id):
-        sql = "SELECT command_id, command FROM commands WHERE dispatch_event_id IS NULL AND node_id=%s "
-        sql += "ORDER BY created DESC LIMIT 1;"
-        # no table lock since we're only looking for one node's command
-        try:
-            # first we look for commands specifically for the node_id (top priority)
-            c = self.db.cursor()
-            c.execute(sql, (node_id,))
-            row = c.fetchone()
-            if row:
-                return row
-            # now we look for node_id values higher than 9 which indicate priority
-            sql = "SELECT command_id, command FROM commands WHERE dispatch_event_id IS NULL AND node_id > %s"
-            sql += " ORDER BY node_id DESC LIMIT 1;"
-            c.execute(sql, (MAX_NODES,))
-            row = c.fetchone()
-            if row:
-                return row
-        except MySQLdb.Error as e:
-            try:
-                self.logger.error("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-            except IndexError:
-                self.logger.error("MySQL Error: %s" % (str(e),))
-        return None
-
-    def clear_dispatch_event_id(self, command_id, clear_node_id=True):
-        if clear_node_id:
-            sql = "UPDATE commands SET dispatch_event_id=NULL WHERE command_id=%s"
-        else:
-            sql = "UPDATE commands SET dispatch_event_id=NULL, node_id=NULL WHERE command_id=%s"
-        try:
-            c = self.db.cursor()
-            c.execute(sql, (command_id,))
-            self.db.commit()
-            if c.rowcount == 1:
-                return True
-        except MySQLdb.Error as e:
-            try:
-                self.logger.error("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-            except IndexError:
-                self.logger.error("MySQL Error: %s" % (str(e),))
-        return False
+    def post_command(self, command_data, node_id=None, priority=COMMAND_PRIORITY_BLOCK_DATA, idempotency_key=None):
+        """Queues a command, returns its command_id or -1 on error.
 
-    def dispatch_directed_command(self, command_id, new_event_id):
-        sql = "UPDATE commands SET dispatch_event_id=%s WHERE command_id=%s"
+        A command posted with the idempotency_key of a command still queued or in flight is absorbed
+        by the unique index and the id of the existing command is returned."""
+        c = self.db.cursor()
         try:
-            c = self.db.cursor()
-            c.execute(sql, (new_event_id, command_id,))
-            self.db.commit()
+            new_command_type = command_type(command_data)
+            sql = "INSERT INTO commands (node_id,command,command_type,priority,directed,idempotency_key) "
+            sql += "VALUES (%s,%s,%s,%s,%s,%s) ON DUPLICATE KEY UPDATE command_id=LAST_INSERT_ID(command_id)"
+            c.execute(sql, (node_id, command_data, new_command_type, priority, node_id is not None, idempotency_key))
+            last_row_id = c.lastrowid
             if c.rowcount == 1:
-                return True
-        except MySQLdb.Error as err:
-            try:
-                self.logger.error("MySQL Error [%d]: %s" % (err.args[0], err.args[1]))
-            except IndexError:
-                self.logger.error("MySQL Error: %s" % (str(err),))
-        return False
-
-    def dispatch_command(self, command_id, node_id, new_event_id):
-        sql = "UPDATE commands SET dispatch_event_id=%s, node_id=%s WHERE command_id=%s"
-        try:
-            c = self.db.cursor()
-            c.execute(sql, (new_event_id, node_id, command_id))
+                # a new row, not an absorbed duplicate
+                add_to_queue_depth(c, node_id, 1, new_command_type)
             self.db.commit()
-            if c.rowcount == 1:
-                return True
+            # wake long-polling dispatch requests in this worker
+            command_notifier.notify()
+            return last_row_id
         except MySQLdb.Error as e:
             try:
                 self.logger.error("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
             except IndexError:
                 self.logger.error("MySQL Error: %s" % (str(e),))
-        return False
+            return -1
+
+    def post_commands(self, commands, node_id=None, priority=COMMAND_PRIORITY_BLOCK_DATA):
+        """Queues (command_data, idempotency_key) pairs with one multi-row insert per command type.
 
-    def post_command(self, command_data, node_id=None):
+        :return: number of commands queued, duplicates of queued or in-flight commands are left out,
+        or -1 on error"""
+        if not commands:
+            return 0
         c = self.db.cursor()
         try:
-            if node_id:
-                sql = "INSERT INTO commands (node_id,command) VALUES (%s,%s);"
-                c.execute(sql, (node_id, command_data,))
-            else:
-                sql = "INSERT INTO commands (command) VALUES (%s);"
-                c.execute(sql, (command_data,))
-            last_row_id = c.lastrowid
+            by_type = {}
+            for command_data, idempotency_key in commands:
+                by_type.setdefault(command_type(command_data), []).append((command_data, idempotency_key))
+            # no trailing semicolon, executemany only rewrites a bare VALUES clause into one multi-row INSERT
+            sql = "INSERT INTO commands (node_id,command,command_type,priority,directed,idempotency_key) "
+            sql += "VALUES (%s,%s,%s,%s,%s,%s) ON DUPLICATE KEY UPDATE command_id=command_id"
+            posted = 0
+            for each_type in by_type:
+                c.executemany(sql, [(node_id, command_data, each_type, priority, node_id is not None, idempotency_key)
+                                    for command_data, idempotency_key in by_type[each_type]])
+                # absorbed duplicates count 0 rows
+                add_to_queue_depth(c, node_id, c.rowcount, each_type)
+                posted += c.rowcount
             self.db.commit()
-            return last_row_id
+            if posted:
+                command_notifier.notify()
+            return posted
         except MySQLdb.Error as e:
             try:
                 self.logger.error("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
@@ -1121,43 +1210,77 @@ WHERE smart_contracts.id=%s"""
             return None
         return last_row_id, new_session_token
 
-    def view_wallet(self, user_id):
+    def view_wallet(self, user_id, after_serial=0, limit=WALLET_PAGE_LIMIT):
+        """
+        Load one page of a user's wallet, grouped per smart contract
+
+        Tokens are paged by serial (keyset), so deep pages cost the same as the first one. The
+        ledger history for every token on the page is fetched with a single IN query.
+
+        :param user_id: owner of the tokens
+        :param after_serial: last token serial of the previous page (0 for the first page)
+        :param limit: maximum number of tokens on the page
+        :return: {"contracts": [...], "next_serial": serial or None}
+        """
         try:
             c = self.db.cursor()
-            sql = "SELECT serial,ethereum_address_pool.ethereum_address,issued,smart_contract_id FROM tokens "
-            sql += " LEFT JOIN ethereum_address_pool ON ethereum_address_pool.id=tokens.eth_address WHERE owner_id=%s"
-            c.execute(sql, (user_id,))
-            all_tokens = []
-            for row in c:
-                all_tokens.append({"token_serial": row[0],
-                                   "token_eth_address": row[1],
-                                   "token_issued": row[2].isoformat(),
-                                   "smart_contract_id": row[3]})
-            sql = "SELECT txid,sender_id,receiver_id,initiated_by,timestamp FROM transaction_ledger WHERE token_id=%s"
-            for every_token in all_tokens:
-                c.execute(sql, (every_token["token_serial"],))
-                every_token["transactions"] = []
+            sql = "SELECT tokens.serial,ethereum_address_pool.ethereum_address,tokens.issued,tokens.smart_contract_id,"
+            sql += "smart_contracts.token_name,smart_contracts.token_symbol FROM tokens "
+            sql += "LEFT JOIN ethereum_address_pool ON ethereum_address_pool.id=tokens.eth_address "
+            sql += "LEFT JOIN smart_contracts ON smart_contracts.id=tokens.smart_contract_id "
+            sql += "WHERE tokens.owner_id=%s AND tokens.serial > %s ORDER BY tokens.serial ASC LIMIT %s"
+            # fetch one extra row to find out if there is another page
+            c.execute(sql, (user_id, after_serial, limit + 1))
+            rows = c.fetchall()
+            next_serial = None
+            if len(rows) > limit:
+                rows = rows[:limit]
+                next_serial = rows[-1][0]
+
+            contracts = []
+            contracts_by_id = {}
+            tokens_by_serial = {}
+            for row in rows:
+                smart_contract_id = row[3]
+                if smart_contract_id not in contracts_by_id:
+                    contract = {"smart_contract_id": smart_contract_id,
+                                "token_name": row[4],
+                                "token_symbol": row[5],
+                                "tokens": []}
+                    contracts_by_id[smart_contract_id] = contract
+                    contracts.append(contract)
+                token = {"token_serial": row[0],
+                         "token_eth_address": decode_hash(row[1]),
+                         "token_issued": row[2].isoformat() if row[2] else None,
+                         "smart_contract_id": smart_contract_id,
+                         "transactions": []}
+                contracts_by_id[smart_contract_id]["tokens"].append(token)
+                tokens_by_serial[row[0]] = token
+
+            if tokens_by_serial:
+                serials = list(tokens_by_serial.keys())
+                sql = "SELECT txid,token_id,sender_id,receiver_id,initiated_by,timestamp FROM transaction_ledger "
+                sql += "WHERE token_id IN (" + ",".join(["%s"] * len(serials)) + ") ORDER BY txid ASC"
+                c.execute(sql, serials)
                 for row in c:
-                    every_token["transactions"].append({"txid": row[0],
-                                                        "sender_id": row[1],
-                                                        "receiver_id": row[2],
-                                                        "initiated_by": row[3],
-                                                        "timestamp": row[4].isoformat()})
-            return all_tokens
+                    tokens_by_serial[row[1]]["transactions"].append({"txid": row[0],
+                                                                     "sender_id": row[2],
+                                                                     "receiver_id": row[3],
+                                                                     "initiated_by": row[4],
+                                                                     "timestamp": row[5].isoformat()})
+            c.close()
+            return {"contracts": contracts, "next_serial": next_serial}
         except MySQLdb.Error as e:
             try:
-                if e.args[0] == 1062:
-                    return -1, "E-mail address already exists in database!"
-                if self.logger:
-                    self.logger.error("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-                else:
-                    print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
+                error_message = "MySQL Error [%d]: %s" % (e.args[0], e.args[1])
             except IndexError:
-                if self.logger:
-                    self.logger.error("MySQL Error: %s" % (str(e),))
-                else:
-                    print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-            return None
+                error_message = "MySQL Error: %s" % (str(e),)
+
+            if self.logger:
+                self.logger.error(error_message)
+            else:
+                print(error_message)
+        return None
 
 
 if __name__ == "__main__":
@@ -25,4 +25,84 @@ class Database():
     def login(self,email_address,password):
         if email_address == "test_fail":
             return None
-        return (1,random_token())
\ No newline at end of file
+        return (1,random_token())
+
+# MySQL-backed fixtures for the queue and node API tests. They run against the database in
+# config.json, which should be a scratch copy like the one benchmark.py uses; every test
+# creates its own node and rows and deletes them again. Without MySQLdb or a reachable
+# server the tests are skipped.
+
+def connect_scratch_database():
+    """Connection to the config.json database, or None when MySQLdb or the server is unavailable"""
+    try:
+        import MySQLdb
+        import json
+        config_stream = open("config.json", "r")
+        config_data = json.load(config_stream)
+        config_stream.close()
+        return MySQLdb.connect(config_data["mysql_host"],
+                               config_data["mysql_user"],
+                               config_data["mysql_password"],
+                               config_data["mysql_database"])
+    except Exception:
+        return None
+
+
+def mysql_available():
+    db = connect_scratch_database()
+    if db is None:
+        return False
+    db.close()
+    return True
+
+
+class ScratchNode:
+    """An ethereum_network row with a random API key; remove() deletes it and every row it left behind"""
+    def __init__(self, db):
+        self.db = db
+        self.api_key = random_token() + random_token()
+        c = db.cursor()
+        # event_log.user_id holds node ids for node events and user ids for the rest, only newer rows are removed
+        c.execute("SELECT IFNULL(MAX(event_id),0) FROM event_log")
+        self.first_event_id = c.fetchone()[0] + 1
+        c.execute("INSERT INTO ethereum_network (node_identifier,api_key,status) VALUES (%s,%s,'Unknown')",
+                  ("test-" + self.api_key[:8], self.api_key))
+        self.node_id = c.lastrowid
+        db.commit()
+
+    def post_command(self, command, **kwargs):
+        """Posts a command directed to this node through Database.post_command, returns its command_id"""
+        import json
+        import database
+        posting = database.Database()
+        try:
+            return posting.post_command(json.dumps(command), node_id=self.node_id, **kwargs)
+        finally:
+            posting.close()
+
+    def command(self, command_id):
+        """(dispatch_event_id, attempts, completed, dead_lettered, lease_expires) of a command"""
+        c = self.db.cursor()
+        c.execute("SELECT dispatch_event_id,attempts,completed,dead_lettered,lease_expires FROM commands "
+                  "WHERE command_id=%s", (command_id,))
+        row = c.fetchone()
+        c.close()
+        self.db.commit()
+        return row
+
+    def pending(self):
+        c = self.db.cursor()
+        c.execute("SELECT IFNULL(SUM(pending),0) FROM queue_depth WHERE node_id=%s", (self.node_id,))
+        row = c.fetchone()
+        c.close()
+        self.db.commit()
+        return int(row[0])
+
+    def remove(self):
+        c = self.db.cursor()
+        c.execute("DELETE FROM event_log WHERE event_id>=%s AND user_id=%s", (self.first_event_id, self.node_id))
+        c.execute("DELETE FROM commands WHERE node_id=%s", (self.node_id,))
+        c.execute("DELETE FROM queue_depth WHERE node_id=%s", (self.node_id,))
+        c.execute("DELETE FROM command_completions WHERE node_id=%s", (self.node_id,))
+        c.execute("DELETE FROM ethereum_network WHERE id=%s", (self.node_id,))
+        self.db.commit()
@@ -5,13 +5,30 @@
 # in the short run trying to reduce the size of the database module
 
 import MySQLdb
+import MySQLdb.cursors
 import json
 import re
 import os
-from database import Database
+import threading
+from hashlib import sha256
+from collections import deque, OrderedDict
+from database import Database, encode_hash, decode_hash
 
 ETH_ADDRESS_REGEX = re.compile("^0x[0-9a-fA-F]{40}$")
 
+# refill inserts this many addresses per statement
+REFILL_BATCH_SIZE = 1000
+# seconds between pool level checks by the background refiller
+REFILL_INTERVAL = 30
+# MySQL named lock held while refilling so only one worker refills at a time
+REFILL_LOCK_NAME = "ethereum_address_pool_refill"
+# addresses claimed per round trip into this worker's prefetch buffer, eth_address_pool.claim_batch_size
+CLAIM_BATCH_SIZE = 50
+# address -> id entries kept in memory by each worker
+ADDRESS_ID_CACHE_SIZE = 100000
+# hash functions of the optional Bloom filter, its size is eth_address_pool.bloom_filter_bits (0 disables it)
+BLOOM_FILTER_HASHES = 7
+
 
 def get_new_addresses(count):
     output = []
@@ -23,6 +40,57 @@ def get_new_addresses(count):
     return output
 
 
+class AddressIdCache:
+    """Per-process LRU of address -> pool id, ids never change once a row exists"""
+    def __init__(self, size=ADDRESS_ID_CACHE_SIZE):
+        self.size = size
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, address):
+        with self._lock:
+            address_id = self._ids.get(address.lower())
+            if address_id is not None:
+                self._ids.move_to_end(address.lower())
+            return address_id
+
+    def put(self, address, address_id):
+        with self._lock:
+            self._ids[address.lower()] = address_id
+            self._ids.move_to_end(address.lower())
+            while len(self._ids) > self.size:
+                self._ids.popitem(last=False)
+
+
+class AddressBloomFilter:
+    """Addresses known to be in the pool, with false positives.
+
+    It is loaded once per process and only learns of addresses this process adds, so an address
+    added by another worker can be missing; callers must only use a miss to skip a lookup before
+    an insert that tolerates duplicates."""
+    def __init__(self, bits, hashes=BLOOM_FILTER_HASHES):
+        self.bits = bits
+        self.hashes = hashes
+        self._array = bytearray((bits + 7) // 8)
+        self._lock = threading.Lock()
+
+    def _positions(self, address):
+        digest = sha256(address.lower().encode()).digest()
+        for x in range(0, self.hashes):
+            yield int.from_bytes(digest[x * 4:x * 4 + 4], "big") % self.bits
+
+    def add(self, address):
+        with self._lock:
+            for position in self._positions(address):
+                self._array[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, address):
+        for position in self._positions(address):
+            if not self._array[position // 8] & (1 << (position % 8)):
+                return False
+        return True
+
+
 class EthAddressPoolStats:
     assigned: int
     duplicates: int
@@ -46,35 +114,73 @@ class EthAddressPoolStats:
 
 class EthereumAddressPool:
     def __init__(self, db=None, logger=None):
+        # no I/O here, the configuration and connection are loaded on first use so
+        # the pool can be created on the request path for free
         self.logger = logger
-        config_stream = open("config.json", "r")
-        config_data = json.load(config_stream)
-        config_stream.close()
-        if db:
-            if isinstance(db, Database):
-                self.db = db.db
-            else:
-                self.db = db
+        self._config = None
+        if isinstance(db, Database):
+            self._db = db.db
         else:
-            self.db = MySQLdb.connect(config_data["eth_address_pool"]["mysql_host"],
-                                      config_data["eth_address_pool"]["mysql_user"],
-                                      config_data["eth_address_pool"]["mysql_password"],
-                                      config_data["eth_address_pool"]["mysql_database"])
+            self._db = db
 
-        self.address_pool_min = config_data["eth_address_pool"]["eth_address_pool_min"]
-        self.address_pool_max = config_data["eth_address_pool"]["eth_address_pool_max"]
-        self.logger = logger
+    @property
+    def config(self):
+        if self._config is None:
+            config_stream = open("config.json", "r")
+            self._config = json.load(config_stream)
+            config_stream.close()
+        return self._config
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = MySQLdb.connect(self.config["eth_address_pool"]["mysql_host"],
+                                       self.config["eth_address_pool"]["mysql_user"],
+                                       self.config["eth_address_pool"]["mysql_password"],
+                                       self.config["eth_address_pool"]["mysql_database"])
+        return self._db
+
+    @property
+    def address_pool_min(self):
+        return self.config["eth_address_pool"]["eth_address_pool_min"]
+
+    @property
+    def address_pool_max(self):
+        return self.config["eth_address_pool"]["eth_address_pool_max"]
 
+    @property
+    def binary_hashes(self):
+        return self.config.get("binary_hashes", False)
+
+    def refill(self):
+        """Tops the pool up to eth_address_pool_max once it drops below eth_address_pool_min.
+
+        Only one worker refills at a time; when another holds the lock this returns 0
+        immediately. Returns the number of addresses added, or None on error."""
         try:
             c = self.db.cursor()
-            c.execute("SELECT COUNT(*) FROM ethereum_address_pool WHERE assigned IS NULL")
-            row = c.fetchone()
-            if row[0] < self.address_pool_min:
-                new_address_count = self.address_pool_max - row[0]
-                new_eth_addresses = get_new_addresses(new_address_count)
-                for each in new_eth_addresses:
-                    c.execute("INSERT INTO ethereum_address_pool (ethereum_address) VALUES (%s);", (each,))
-                self.db.commit()
+            c.execute("SELECT GET_LOCK(%s, 0)", (REFILL_LOCK_NAME,))
+            if not c.fetchone()[0]:
+                return 0
+            try:
+                c.execute("SELECT COUNT(*) FROM ethereum_address_pool WHERE assigned IS NULL")
+                row = c.fetchone()
+                added = 0
+                if row[0] < self.address_pool_min:
+                    new_address_count = self.address_pool_max - row[0]
+                    while added < new_address_count:
+                        new_eth_addresses = get_new_addresses(min(REFILL_BATCH_SIZE, new_address_count - added))
+                        # no trailing semicolon, executemany only rewrites a bare VALUES clause into one
+                        # multi-row INSERT
+                        c.executemany("INSERT INTO ethereum_address_pool (ethereum_address) VALUES (%s)",
+                                      [(encode_hash(each, self.binary_hashes),) for each in new_eth_addresses])
+                        self.db.commit()
+                        added += len(new_eth_addresses)
+                    if self.logger:
+                        self.logger.info("Added {0} addresses to the Ethereum address pool.".format(added))
+                return added
+            finally:
+                c.execute("DO RELEASE_LOCK(%s)", (REFILL_LOCK_NAME,))
         except MySQLdb.Error as e:
             try:
                 if self.logger:
@@ -86,14 +192,23 @@ class EthereumAddressPool:
                     self.logger.error("MySQL Error: %s" % (str(e),))
                 else:
                     print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
+        return None
 
     def get_id_for_ethereum_address(self, ethereum_address):
+        address_id = address_ids.get(ethereum_address)
+        if address_id is not None:
+            return address_id
+        try:
+            encoded_address = encode_hash(ethereum_address, self.binary_hashes)
+        except ValueError:
+            # malformed, not in the pool
+            return None
         try:
             c = self.db.cursor()
-            c.execute("SELECT ethereum_address FROM ethereum_address_pool WHERE ethereum_address=%s;",
-                      (ethereum_address,))
+            c.execute("SELECT id FROM ethereum_address_pool WHERE ethereum_address=%s;", (encoded_address,))
             row = c.fetchone()
             if row:
+                address_ids.put(ethereum_address, row[0])
                 return row[0]
         except MySQLdb.Error as e:
             try:
@@ -108,13 +223,66 @@ class EthereumAddressPool:
                     print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
         return None
 
+    def bloom_filter(self):
+        """This process' Bloom filter of pool addresses, or None while disabled or not loaded yet; never does I/O"""
+        return address_bloom_filter
+
+    def load_bloom_filter(self):
+        """Builds this process' Bloom filter from the whole pool, once, run by the refiller off the request path.
+
+        Until it is loaded lookups go to the cache and the database. An address added while the scan runs may
+        be missing from the filter, get_or_add_ethereum_address then inserts it and gets the existing id back.
+        :return: the filter, or None when disabled or on error (retried on the next pass)"""
+        global address_bloom_filter
+        bits = self.config["eth_address_pool"].get("bloom_filter_bits", 0)
+        if not bits:
+            return None
+        with bloom_filter_lock:
+            if address_bloom_filter is None:
+                new_filter = AddressBloomFilter(bits)
+                try:
+                    c = self.db.cursor(MySQLdb.cursors.SSCursor)
+                    c.execute("SELECT ethereum_address FROM ethereum_address_pool WHERE ethereum_address IS NOT NULL")
+                    for row in c:
+                        new_filter.add(decode_hash(row[0]))
+                    c.close()
+                except MySQLdb.Error as e:
+                    try:
+                        if self.logger:
+                            self.logger.error("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
+                        else:
+                            print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
+                    except IndexError:
+                        if self.logger:
+                            self.logger.error("MySQL Error: %s" % (str(e),))
+                        else:
+                            print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
+                    return None
+                address_bloom_filter = new_filter
+        return address_bloom_filter
+
+    def get_or_add_ethereum_address(self, ethereum_address):
+        """Pool id of an address seen on chain, adding it when new.
+
+        Cached addresses cost no round trip; with the Bloom filter enabled, addresses it has
+        never seen go straight to the insert instead of a lookup first."""
+        address_id = address_ids.get(ethereum_address)
+        if address_id is not None:
+            return address_id
+        known_addresses = self.bloom_filter()
+        if known_addresses is None or ethereum_address in known_addresses:
+            address_id = self.get_id_for_ethereum_address(ethereum_address)
+            if address_id is not None:
+                return address_id
+        return self.add_new_ethereum_address(ethereum_address)
+
     def get_address_pool(self):
         output = []
         try:
             c = self.db.cursor()
             c.execute("SELECT id, ethereum_address FROM ethereum_address_pool WHERE assigned IS NULL")
             for row in c:
-                output.append((row[0], row[1]))
+                output.append((row[0], decode_hash(row[1])))
             c.close()
         except MySQLdb.Error as e:
             try:
@@ -131,14 +299,20 @@ class EthereumAddressPool:
         return output
 
     def add_new_ethereum_address(self, new_address):
-        self.logger.info("Adding new address %s to Ethereum pool." % (new_address,))
+        if self.logger:
+            self.logger.info("Adding new address %s to Ethereum pool." % (new_address,))
         if not ETH_ADDRESS_REGEX.match(new_address):
             raise TypeError
         try:
             c = self.db.cursor()
-            c.execute("INSERT INTO ethereum_address_pool (ethereum_address,assigned) VALUES (%s,NOW());",
-                      (new_address,))
+            # an address already in the pool keeps its row, LAST_INSERT_ID(id) hands back the existing id
+            sql = "INSERT INTO ethereum_address_pool (ethereum_address,assigned) VALUES (%s,NOW()) "
+            sql += "ON DUPLICATE KEY UPDATE id=LAST_INSERT_ID(id), assigned=IFNULL(assigned, NOW());"
+            c.execute(sql, (encode_hash(new_address, self.binary_hashes),))
             self.db.commit()
+            address_ids.put(new_address, c.lastrowid)
+            if address_bloom_filter is not None:
+                address_bloom_filter.add(new_address)
             return c.lastrowid
         except MySQLdb.Error as e:
             try:
@@ -153,28 +327,31 @@ class EthereumAddressPool:
                     print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
         return None
 
-    def assign_new_ethereum_address(self):
+    @property
+    def claim_batch_size(self):
+        return self.config["eth_address_pool"].get("claim_batch_size", CLAIM_BATCH_SIZE)
+
+    def claim_addresses(self, count, commit=True):
+        """Atomically marks up to count free addresses assigned and returns them as (id, address) tuples.
+
+        Rows locked by a concurrent claim are skipped rather than waited on, so workers never
+        hand out the same address. With commit=False the claim joins the caller's transaction.
+        Returns None on error."""
         try:
             c = self.db.cursor()
             sql = "SELECT id, ethereum_address FROM ethereum_address_pool"
-            sql += " WHERE assigned IS NULL ORDER BY id DESC LIMIT 1;"
-            c.execute(sql)
-            row = c.fetchone()
-            if row:
-                c.execute("UPDATE ethereum_address_pool SET assigned=NOW() WHERE id=%s", (row[0],))
+            sql += " WHERE assigned IS NULL ORDER BY id DESC LIMIT %s FOR UPDATE SKIP LOCKED"
+            c.execute(sql, (count,))
+            rows = c.fetchall()
+            if rows:
+                sql = "UPDATE ethereum_address_pool SET assigned=NOW() WHERE id IN ("
+                sql += ",".join(["%s"] * len(rows)) + ")"
+                c.execute(sql, [row[0] for row in rows])
+            if commit:
                 self.db.commit()
-                eth_address_id = row[0]
-                eth_address = row[1]
-                c.execute("SELECT COUNT(*) FROM ethereum_address_pool WHERE assigned IS NULL")
-                row = c.fetchone()
-                if row[0] < self.address_pool_min:
-                    new_address_count = self.address_pool_max - row[0]
-                    new_eth_addresses = get_new_addresses(new_address_count)
-                    for each in new_eth_addresses:
-                        c.execute("INSERT INTO ethereum_address_pool (ethereum_address) VALUES (%s);", (each,))
-                    self.db.commit()
-                return eth_address_id, eth_address
+            return [(row[0], decode_hash(row[1])) for row in rows]
         except MySQLdb.Error as e:
+            self.db.rollback()
             try:
                 if self.logger:
                     self.logger.error("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
@@ -186,3 +363,86 @@ class EthereumAddressPool:
                 else:
                     print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
         return None
+
+    def assign_new_ethereum_addresses(self, count):
+        """Hands out count addresses, from this worker's prefetch buffer first.
+
+        The buffer is refilled on the worker's own claim connection, never the caller's, so the
+        caller's open transaction is neither committed here nor able to roll back a prefetch.
+        Returns fewer than count when the pool runs dry, or None on error."""
+        global claim_pool
+        with claim_lock:
+            output = []
+            while claimed_addresses and len(output) < count:
+                output.append(claimed_addresses.popleft())
+            shortfall = count - len(output)
+            if shortfall > 0:
+                # claim the shortfall plus a batch to serve the next callers from memory
+                if claim_pool is None:
+                    claim_pool = EthereumAddressPool(logger=self.logger)
+                new_addresses = claim_pool.claim_addresses(shortfall + self.claim_batch_size)
+                if new_addresses is None:
+                    # reconnect on the next claim
+                    claim_pool = None
+                    claimed_addresses.extendleft(reversed(output))
+                    return None
+                output.extend(new_addresses[:shortfall])
+                claimed_addresses.extend(new_addresses[shortfall:])
+        if len(output) < count and refiller:
+            # pool ran dry between refiller passes
+            refiller.wake()
+        return output
+
+    def assign_new_ethereum_address(self):
+        output = self.assign_new_ethereum_addresses(1)
+        if output:
+            return output[0]
+        return None
+
+
+class AddressPoolRefiller(threading.Thread):
+    """Daemon thread that keeps the address pool topped up off the request path"""
+
+    def __init__(self, logger=None, interval=REFILL_INTERVAL):
+        threading.Thread.__init__(self, name="address-pool-refiller", daemon=True)
+        self.logger = logger
+        self.interval = interval
+        self.wakeup = threading.Event()
+
+    def wake(self):
+        self.wakeup.set()
+
+    def run(self):
+        # the refiller owns its connection, named locks are held per connection
+        pool = EthereumAddressPool(logger=self.logger)
+        while True:
+            if address_bloom_filter is None:
+                pool.load_bloom_filter()
+            if pool.refill() is None:
+                # reconnect on the next pass
+                pool = EthereumAddressPool(logger=self.logger)
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+
+refiller = None
+
+# addresses already marked assigned in the database and waiting to be handed out by this worker;
+# an address left here when the worker exits is never used, which only costs a pool slot
+claimed_addresses = deque()
+claim_lock = threading.Lock()
+# the worker's own connection for filling claimed_addresses, only used under claim_lock
+claim_pool = None
+
+address_ids = AddressIdCache()
+address_bloom_filter = None
+bloom_filter_lock = threading.Lock()
+
+
+def start_refiller(logger=None):
+    """Starts this worker's background refiller, once"""
+    global refiller
+    if refiller is None:
+        refiller = AddressPoolRefiller(logger)
+        refiller.start()
+    return refiller
@@ -8,29 +8,15 @@
 # to list all registered nodes
 #   python ethereum_node.py list-nodes
 
-# TODO: eventually split these functions between ethereum_address_pool.py and ethereum_node.py
-# in an effort to reduce the size of the database module
-
 import MySQLdb
 import json
 import datetime
 import os
 import sys
 import pprint
-import re
 import events
-
-ETH_ADDRESS_REGEX = re.compile("^0x[0-9a-fA-F]{40}$")
-
-
-def get_new_addresses(count):
-    output = []
-    for x in range(0, count):
-        new_address = "0x"
-        rng_out = os.urandom(20)
-        new_address += rng_out.hex()
-        output.append(new_address)
-    return output
+from database import Database
+from ethereum_address_pool import EthereumAddressPool
 
 
 def generate_api_key():
@@ -40,69 +26,38 @@ def generate_api_key():
 
 class EthereumNode:
     def __init__(self, ip_addr=None, logger=None, db=None):
+        # no I/O here, the configuration and connection are loaded on first use
         self.ip_addr = ip_addr
         self.logger = logger
-        config_stream = open("config.json", "r")
-        config_data = json.load(config_stream)
-        config_stream.close()
-        if db:
-            if db.db:
-                self.db = db.db
-            else:
-                self.db = db
+        self._config = None
+        if isinstance(db, Database):
+            self._db = db.db
         else:
-            self.db = MySQLdb.connect(config_data["mysql_host"],
-                                      config_data["mysql_user"],
-                                      config_data["mysql_password"],
-                                      config_data["mysql_database"])
-
-        self.wallet_address = config_data["wallet_address"]
-        self.address_pool_min = config_data["eth_address_pool_min"]
-        self.address_pool_max = config_data["eth_address_pool_max"]
-        self.logger = logger
-
-        try:
-            c = self.db.cursor()
-            c.execute("SELECT COUNT(*) FROM ethereum_address_pool WHERE assigned IS NULL")
-            row = c.fetchone()
-            if row[0] < self.address_pool_min:
-                new_address_count = self.address_pool_max - row[0]
-                new_eth_addresses = get_new_addresses(new_address_count)
-                for each in new_eth_addresses:
-                    c.execute("INSERT INTO ethereum_address_pool (ethereum_address) VALUES (%s);", (each,))
-                self.db.commit()
-        except MySQLdb.Error as e:
-            try:
-                if self.logger:
-                    self.logger.error("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-                else:
-                    print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-            except IndexError:
-                if self.logger:
-                    self.logger.error("MySQL Error: %s" % (str(e),))
-                else:
-                    print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
+            self._db = db
+
+    @property
+    def config(self):
+        if self._config is None:
+            config_stream = open("config.json", "r")
+            self._config = json.load(config_stream)
+            config_stream.close()
+        return self._config
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = MySQLdb.connect(self.config["mysql_host"],
+                                       self.config["mysql_user"],
+                                       self.config["mysql_password"],
+                                       self.config["mysql_database"])
+        return self._db
+
+    @property
+    def wallet_address(self):
+        return self.config["wallet_address"]
 
     def get_id_for_ethereum_address(self, ethereum_address):
-        try:
-            c = self.db.cursor()
-            c.execute("SELECT ethereum_address FROM ethereum_address_pool WHERE ethereum_address=%s;",
-                      (ethereum_address,))
-            row = c.fetchone()
-            if row:
-                return row[0]
-        except MySQLdb.Error as e:
-            try:
-                if self.logger:
-                    self.logger.error("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-                else:
-                    print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-            except IndexError:
-                if self.logger:
-                    self.logger.error("MySQL Error: %s" % (str(e),))
-                else:
-                    print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-        return None
+        return EthereumAddressPool(self.db, self.logger).get_id_for_ethereum_address(ethereum_address)
 
     def add_ethereum_node(self, node_identifier):
         c = self.db.cursor()
@@ -121,83 +76,13 @@ class EthereumNode:
         return None
 
     def get_address_pool(self):
-        output = []
-        try:
-            c = self.db.cursor()
-            c.execute("SELECT id, ethereum_address FROM ethereum_address_pool WHERE assigned IS NULL")
-            for row in c:
-                output.append((row[0], row[1]))
-            c.close()
-        except MySQLdb.Error as e:
-            try:
-                if self.logger:
-                    self.logger.error("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-                else:
-                    print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-            except IndexError:
-                if self.logger:
-                    self.logger.error("MySQL Error: %s" % (str(e),))
-                else:
-                    print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-            return None
-        return output
+        return EthereumAddressPool(self.db, self.logger).get_address_pool()
 
     def add_new_ethereum_address(self, new_address):
-        self.logger.info("Adding new address {0} to Ethereum pool.".format(new_address))
-        if not ETH_ADDRESS_REGEX.match(new_address):
-            raise TypeError
-        try:
-            c = self.db.cursor()
-            c.execute("INSERT INTO ethereum_address_pool (ethereum_address,assigned) VALUES (%s,NOW());",
-                      (new_address,))
-            self.db.commit()
-            return c.lastrowid
-        except MySQLdb.Error as e:
-            try:
-                if self.logger:
-                    self.logger.error("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-                else:
-                    print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-            except IndexError:
-                if self.logger:
-                    self.logger.error("MySQL Error: %s" % (str(e),))
-                else:
-                    print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-        return None
+        return EthereumAddressPool(self.db, self.logger).add_new_ethereum_address(new_address)
 
     def assign_new_ethereum_address(self):
-        try:
-            c = self.db.cursor()
-            sql = "SELECT id, ethereum_address FROM ethereum_address_pool"
-            sql += " WHERE assigned IS NULL ORDER BY id DESC LIMIT 1;"
-            c.execute(sql)
-            row = c.fetchone()
-            if row:
-                c.execute("UPDATE ethereum_address_pool SET assigned=NOW() WHERE id=%s", (row[0],))
-                self.db.commit()
-                eth_address_id = row[0]
-                eth_address = row[1]
-                c.execute("SELECT COUNT(*) FROM ethereum_address_pool WHERE assigned IS NULL")
-                row = c.fetchone()
-                if row[0] < self.address_pool_min:
-                    new_address_count = self.address_pool_max - row[0]
-                    new_eth_addresses = get_new_addresses(new_address_count)
-                    for each in new_eth_addresses:
-                        c.execute("INSERT INTO ethereum_address_pool (ethereum_address) VALUES (%s);", (each,))
-                    self.db.commit()
-                return eth_address_id, eth_address
-        except MySQLdb.Error as e:
-            try:
-                if self.logger:
-                    self.logger.error("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-                else:
-                    print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-            except IndexError:
-                if self.logger:
-                    self.logger.error("MySQL Error: %s" % (str(e),))
-                else:
-                    print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-        return None
+        return EthereumAddressPool(self.db, self.logger).assign_new_ethereum_address()
 
     def remove_ethereum_node(self, node_id):
         try:
@@ -298,6 +298,39 @@ class Event:
         else:
             raise InvalidEventException
 
+    def log_events(self, user_id, metadata_list, commit=True):
+        """Logs one event of this type per metadata with a single multi-row INSERT.
+
+        With commit=False the rows join the caller's transaction. Returns the number logged or None on error."""
+        if self.event_type_id > 0:
+            rows = []
+            for metadata in metadata_list:
+                if type(metadata) is not str:
+                    metadata = json.dumps(metadata)
+                rows.append((self.event_type_id, user_id, metadata))
+            if not rows:
+                return 0
+            c = self.db.cursor()
+            sql = "INSERT INTO event_log (event_type_id, user_id, event_data) VALUES (%s,%s,%s)"
+            try:
+                c.executemany(sql, rows)
+                if commit:
+                    self.db.commit()
+                return len(rows)
+            except MySQLdb.Error as e:
+                try:
+                    error_message = "MySQL Error [%d]: %s" % (e.args[0], e.args[1])
+                except IndexError:
+                    error_message = "MySQL Error: %s" % (str(e),)
+
+                if self.logger:
+                    self.logger.error(error_message)
+                else:
+                    print(error_message)
+                return None
+        else:
+            raise InvalidEventException
+
 
 class NodeUpdateEvent(Event):
     def __init__(self,
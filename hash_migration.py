@@ -0,0 +1,230 @@
+# online migration of hash and address columns from CHAR(n) hex strings to BINARY(n)
+#
+# Each column is migrated through a shadow <column>_bin column kept in sync by triggers
+# while existing rows are backfilled in small primary key chunks, so the live tables
+# are never locked for longer than a single chunk:
+#   python hash_migration.py prepare      adds shadow columns and sync triggers
+#   python hash_migration.py backfill     converts existing rows in chunks
+#   python hash_migration.py index        builds the indexes on the shadow columns
+#   python hash_migration.py verify       counts rows where the shadow column disagrees
+#   python hash_migration.py cutover      swaps the shadow columns in (maintenance window)
+#   python hash_migration.py benchmark    reports index sizes and lookup latency
+#
+# After cutover set "binary_hashes": true in config.json and restart the workers.
+
+import MySQLdb
+import json
+import sys
+import time
+import pprint
+
+BACKFILL_CHUNK_SIZE = 5000
+BENCHMARK_SAMPLE_SIZE = 1000
+
+# (table, primary key, column, binary width, index on column, unique index)
+HASH_COLUMNS = [
+    ("block_data", "block_data_id", "block_hash", 32, "block_data_block_hash_uindex", True),
+    ("external_transaction_ledger", "txid", "transaction_hash", 32,
+     "external_transaction_ledger_transaction_hash_index", False),
+    ("ethereum_address_pool", "id", "ethereum_address", 20, "ethereum_address_pool_ethereum_address_uindex", True),
+]
+
+
+class HashMigration:
+    def __init__(self, logger=None):
+        self.logger = logger
+        config_stream = open("config.json", "r")
+        config_data = json.load(config_stream)
+        config_stream.close()
+        self.db = MySQLdb.connect(config_data["mysql_host"],
+                                  config_data["mysql_user"],
+                                  config_data["mysql_password"],
+                                  config_data["mysql_database"])
+
+    def log_error(self, e):
+        try:
+            msg = "MySQL Error [{0}]: {1}".format(e.args[0], e.args[1])
+        except IndexError:
+            msg = "MySQL Error: " + str(e)
+        if self.logger:
+            self.logger.error(msg)
+        else:
+            print(msg)
+
+    def log_info(self, msg):
+        if self.logger:
+            self.logger.info(msg)
+        else:
+            print(msg)
+
+    def column_exists(self, table, column):
+        c = self.db.cursor()
+        c.execute("SELECT COUNT(*) FROM information_schema.columns WHERE table_schema=DATABASE() "
+                  "AND table_name=%s AND column_name=%s", (table, column))
+        return c.fetchone()[0] > 0
+
+    def prepare(self):
+        try:
+            c = self.db.cursor()
+            for table, pk, column, width, index, unique in HASH_COLUMNS:
+                if self.column_exists(table, column + "_bin"):
+                    continue
+                c.execute("ALTER TABLE {0} ADD COLUMN {1}_bin BINARY({2}) DEFAULT NULL, "
+                          "ALGORITHM=INPLACE, LOCK=NONE".format(table, column, width))
+                for event in ("INSERT", "UPDATE"):
+                    sql = "CREATE TRIGGER {0}_{1}_bin_{2} BEFORE {3} ON {0} FOR EACH ROW "
+                    sql += "SET NEW.{1}_bin = UNHEX(SUBSTRING(NEW.{1}, 3))"
+                    c.execute(sql.format(table, column, event.lower(), event))
+                self.log_info("Added {0}.{1}_bin and sync triggers".format(table, column))
+            return True
+        except MySQLdb.Error as e:
+            self.log_error(e)
+        return False
+
+    def backfill(self, chunk_size=BACKFILL_CHUNK_SIZE):
+        try:
+            c = self.db.cursor()
+            for table, pk, column, width, index, unique in HASH_COLUMNS:
+                c.execute("SELECT MAX({0}) FROM {1}".format(pk, table))
+                max_id = c.fetchone()[0] or 0
+                converted = 0
+                last_id = 0
+                while last_id < max_id:
+                    sql = "UPDATE {0} SET {1}_bin = UNHEX(SUBSTRING({1}, 3)) "
+                    sql += "WHERE {2} > %s AND {2} <= %s AND {1} IS NOT NULL AND {1}_bin IS NULL"
+                    c.execute(sql.format(table, column, pk), (last_id, last_id + chunk_size))
+                    self.db.commit()
+                    converted += c.rowcount
+                    last_id += chunk_size
+                self.log_info("Backfilled {0} rows of {1}.{2}".format(converted, table, column))
+            return True
+        except MySQLdb.Error as e:
+            self.log_error(e)
+        return False
+
+    def index(self):
+        try:
+            c = self.db.cursor()
+            for table, pk, column, width, index, unique in HASH_COLUMNS:
+                sql = "ALTER TABLE {0} ADD {1}INDEX {2}_bin ({3}_bin), ALGORITHM=INPLACE, LOCK=NONE"
+                c.execute(sql.format(table, "UNIQUE " if unique else "", index, column))
+                self.log_info("Indexed {0}.{1}_bin".format(table, column))
+            return True
+        except MySQLdb.Error as e:
+            self.log_error(e)
+        return False
+
+    def verify(self):
+        output = {}
+        try:
+            c = self.db.cursor()
+            for table, pk, column, width, index, unique in HASH_COLUMNS:
+                sql = "SELECT COUNT(*) FROM {0} WHERE {1} IS NOT NULL "
+                sql += "AND ({1}_bin IS NULL OR {1}_bin <> UNHEX(SUBSTRING({1}, 3)))"
+                c.execute(sql.format(table, column))
+                output[table + "." + column] = c.fetchone()[0]
+            return output
+        except MySQLdb.Error as e:
+            self.log_error(e)
+        return None
+
+    def cutover(self):
+        mismatches = self.verify()
+        if mismatches is None or any(mismatches.values()):
+            self.log_info("Refusing to cut over, shadow columns are out of sync: {0}".format(mismatches))
+            return False
+        try:
+            c = self.db.cursor()
+            for table, pk, column, width, index, unique in HASH_COLUMNS:
+                for event in ("insert", "update"):
+                    c.execute("DROP TRIGGER IF EXISTS {0}_{1}_bin_{2}".format(table, column, event))
+                sql = "ALTER TABLE {0} DROP INDEX {2}, DROP COLUMN {1}, "
+                sql += "CHANGE COLUMN {1}_bin {1} BINARY({3}) DEFAULT NULL, RENAME INDEX {2}_bin TO {2}"
+                c.execute(sql.format(table, column, index, width))
+                self.log_info("Cut over {0}.{1} to BINARY({2})".format(table, column, width))
+            return True
+        except MySQLdb.Error as e:
+            self.log_error(e)
+        return False
+
+    def benchmark(self, sample_size=BENCHMARK_SAMPLE_SIZE):
+        output = {}
+        try:
+            c = self.db.cursor()
+            c.execute("SELECT @@innodb_page_size")
+            page_size = c.fetchone()[0]
+            for table, pk, column, width, index, unique in HASH_COLUMNS:
+                c.execute("ANALYZE TABLE {0}".format(table))
+                c.fetchall()
+                result = {}
+                columns = [(column, index)]
+                if self.column_exists(table, column + "_bin"):
+                    columns.append((column + "_bin", index + "_bin"))
+                for each_column, each_index in columns:
+                    sql = "SELECT stat_value FROM mysql.innodb_index_stats WHERE database_name=DATABASE() "
+                    sql += "AND table_name=%s AND index_name=%s AND stat_name='size'"
+                    c.execute(sql, (table, each_index))
+                    row = c.fetchone()
+                    index_bytes = row[0] * page_size if row else None
+
+                    sql = "SELECT {0} FROM {1} WHERE {0} IS NOT NULL ORDER BY RAND() LIMIT %s"
+                    c.execute(sql.format(each_column, table), (sample_size,))
+                    samples = [row[0] for row in c.fetchall()]
+                    started = time.perf_counter()
+                    for each in samples:
+                        c.execute("SELECT {0} FROM {1} WHERE {2}=%s".format(pk, table, each_column), (each,))
+                        c.fetchall()
+                    elapsed = time.perf_counter() - started
+                    result[each_column] = {
+                        "index_bytes": index_bytes,
+                        "lookups": len(samples),
+                        "mean_lookup_ms": elapsed / len(samples) * 1000.0 if samples else None
+                    }
+                output[table] = result
+            return output
+        except MySQLdb.Error as e:
+            self.log_error(e)
+        return None
+
+
+if __name__ == "__main__":
+    HELP = """python hash_migration.py command
+
+        prepare
+        backfill [chunk size]
+        index
+        verify
+        cutover
+        benchmark [sample size]
+
+        python hash_migration.py prepare
+        python hash_migration.py backfill 10000
+        python hash_migration.py benchmark 500
+"""
+    if len(sys.argv) < 2:
+        print(HELP)
+    else:
+        migration = HashMigration()
+        command = sys.argv[1]
+        if command == "prepare":
+            migration.prepare()
+        elif command == "backfill":
+            if len(sys.argv) > 2:
+                migration.backfill(int(sys.argv[2]))
+            else:
+                migration.backfill()
+        elif command == "index":
+            migration.index()
+        elif command == "verify":
+            pprint.pprint(migration.verify())
+        elif command == "cutover":
+            if migration.cutover():
+                print("Set \"binary_hashes\": true in config.json and restart the application.")
+        elif command == "benchmark":
+            if len(sys.argv) > 2:
+                pprint.pprint(migration.benchmark(int(sys.argv[2])))
+            else:
+                pprint.pprint(migration.benchmark())
+        else:
+            print("Unknown command.\n\n")
+            print(HELP)
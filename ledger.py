@@ -17,13 +17,14 @@ class TransactionLedger:
     def get_owned_token_count(self):
         if self.user_id < 1:
             raise ValueError
-        sql = "SELECT COUNT(*) FROM tokens WHERE owner_id=%s"
+        # summed from the per-contract token_holdings counters, see smart_contract.add_to_token_holdings
+        sql = "SELECT IFNULL(SUM(tokens),0) FROM token_holdings WHERE owner_id=%s"
         try:
             c = self._db.cursor()
             c.execute(sql, (self.user_id,))
             row = c.fetchone()
             if row:
-                return row[0]
+                return int(row[0])
         except MySQLdb.Error as e:
             try:
                 if self.logger:
@@ -5,12 +5,71 @@ from werkzeug.exceptions import abort
 import database
 import events
 import json
-from smart_contract import SmartContract
+from smart_contract import SmartContractRepository
+from command_queue import CommandQueue, DISPATCH_BATCH_LIMIT, LONG_POLL_TIMEOUT
 from charting import Charting
 from block_data import BlockDataManager, BlockData
 
 node_api_blueprint = Blueprint('node_api', __name__, url_prefix="/node_api")
 
+# command outputs accepted by one command_outputs POST
+OUTPUT_BATCH_LIMIT = 100
+
+
+def command_output_events(db, node_id, ip_addr, json_data, blocks):
+    """Applies one command output from a node and returns the events to log for it, [(event type, event data)].
+
+    The output's input is decoded once; block data is appended to blocks for the caller to store. Contract
+    addresses (publish) and issue results (issue_tokens) are written and committed here, straight away."""
+    event_data = {}
+    if json_data["success"] is True:
+        event_data["error"] = False
+        event_data["command_id"] = json_data["command_id"]
+        event_data["input"] = json_data["input"]
+        event_data["ip_address"] = ip_addr
+        output_events = []
+        command_output = json.loads(event_data["input"])
+        if "block_number" in command_output:
+            blocks.append(BlockData(json_data=command_output))
+        elif "erc20_function" in command_output:
+            erc20_function = command_output["erc20_function"]
+            if erc20_function == "publish":
+                event_data["contract_address"] = command_output["new_contract_address"]
+                event_data["token_id"] = command_output["token_id"]
+                contracts = SmartContractRepository(db, current_app.logger)
+                if contracts.set_contract_address(event_data["token_id"], event_data["contract_address"]):
+                    output_events.append(("ERC20 Token Published", event_data))
+            elif erc20_function == "burn":
+                event_data["contract_address"] = command_output["contract_address"]
+                event_data["token_id"] = command_output["token_id"]
+                event_data["tokens"] = command_output["tokens"]
+                event_data["gas_price"] = command_output["gas_price"]
+                output_events.append(("ERC20 Token Burned", event_data))
+            elif erc20_function == "transfer":
+                event_data["contract_address"] = command_output["contract_address"]
+                event_data["token_id"] = command_output["token_id"]
+                event_data["tokens"] = command_output["tokens"]
+                event_data["gas_price"] = command_output["gas_price"]
+                event_data["address"] = command_output["address"]
+                output_events.append(("ERC20 Token External Transfer", event_data))
+            elif erc20_function == "issue_tokens":
+                # one coalesced mining command, one result per token address
+                event_data["token_id"] = command_output["token_id"]
+                results = command_output["results"]
+                contracts = SmartContractRepository(db, current_app.logger)
+                event_data["issued"] = contracts.record_issue_results(event_data["token_id"], results)
+                event_data["failed"] = [each["eth_address"] for each in results if not each.get("success")]
+                output_events.append(("ERC20 Token Issued", event_data))
+            elif erc20_function == "total_supply":
+                event_data["total_supply"] = json_data["total_supply"]
+        output_events.append(("Ethereum Node Command Output", event_data))
+        return output_events
+    event_data["error"] = True
+    event_data["command_id"] = json_data["command_id"]
+    event_data["error_message"] = json_data["error_message"]
+    event_data["ip_address"] = ip_addr
+    return [("Ethereum Node Command Failed", event_data)]
+
 
 @node_api_blueprint.route('/command_output/<api_key>', methods=["POST"])
 def command_output(api_key):
@@ -20,87 +79,108 @@ def command_output(api_key):
     if node_id:
         json_data = request.get_json(force=True)
         if json_data:
-            event_data = {}
-            if json_data["success"] is True:
-                event_data["error"] = False
-                event_data["command_id"] = json_data["command_id"]
-                event_data["input"] = json_data["input"]
-                event_data["ip_address"] = ip_addr
-                command_output = json.loads(event_data["input"])
-                if "block_number" in command_output:
-                    block_data = BlockData(json_data=event_data["input"])
-                    manager = BlockDataManager(db, current_app.logger)
-                    manager.put_block(block_data)
-                elif "erc20_function" in command_output:
-                    erc20_function = command_output["erc20_function"]
-                    if erc20_function == "publish":
-                        event_data["contract_address"] = command_output["new_contract_address"]
-                        event_data["token_id"] = command_output["token_id"]
-                        sc = SmartContract(smart_token_id=event_data["token_id"], logger=current_app.logger)
-                        if sc.smart_contract_id > -1 and sc.set_contract_address(event_data["contract_address"]):
-                            publish_event = events.Event("ERC20 Token Published", db, current_app.logger)
-                            publish_event.log_event(node_id, event_data)
-                    elif erc20_function == "burn":
-                        event_data["contract_address"] = command_output["contract_address"]
-                        event_data["token_id"] = command_output["token_id"]
-                        event_data["tokens"] = command_output["tokens"]
-                        event_data["gas_price"] = command_output["gas_price"]
-                        burn_function = events.Event("ERC20 Token Burned", db, current_app.logger)
-                        burn_function.log_event(node_id, event_data)
-                    elif erc20_function == "transfer":
-                        event_data["contract_address"] = command_output["contract_address"]
-                        event_data["token_id"] = command_output["token_id"]
-                        event_data["tokens"] = command_output["tokens"]
-                        event_data["gas_price"] = command_output["gas_price"]
-                        event_data["address"] = command_output["address"]
-                        transfer_function = events.Event("ERC20 Token External Transfer", db, current_app.logger)
-                        transfer_function.log_event(node_id, event_data)
-                    elif erc20_function == "total_supply":
-                        event_data["total_supply"] = json_data["total_supply"]
-                new_event = events.Event("Ethereum Node Command Output", db, current_app.logger)
-                new_event.log_event(node_id, event_data)
+            blocks = []
+            output_events = command_output_events(db, node_id, ip_addr, json_data, blocks)
+            if blocks and not BlockDataManager(db, current_app.logger).put_block(blocks[0]):
+                # the block was not stored, the command goes back in the queue to be redone
+                CommandQueue(db, current_app.logger).fail_command(output_events[-1][1]["command_id"], node_id)
+                abort(500)
+            for event_type, event_data in output_events:
+                events.Event(event_type, db, current_app.logger).log_event(node_id, event_data)
+            event_data = output_events[-1][1]
+            if event_data["error"]:
+                # back in the queue for another attempt, dead-lettered once it is out of attempts
+                CommandQueue(db, current_app.logger).fail_command(event_data["command_id"], node_id)
             else:
-                event_data["error"] = True
-                event_data["command_id"] = json_data["command_id"]
-                event_data["error_message"] = json_data["error_message"]
-                event_data["ip_address"] = ip_addr
-                # mark command undispatched
-                # db.clear_dispatch_event_id(event_data["command_id"])
-                # log error event
-                new_event = events.Event("Ethereum Node Command Failed", db, current_app.logger)
-                new_event.log_event(node_id, event_data)
+                CommandQueue(db, current_app.logger).complete_command(event_data["command_id"], node_id)
             return Response(json.dumps({"success": event_data["error"]}))
         abort(500)
     abort(403)
 
 
+@node_api_blueprint.route('/command_outputs/<api_key>', methods=["POST"])
+def command_outputs(api_key):
+    """A batch of command outputs, e.g. after a block data backfill: a JSON array of command_output bodies.
+
+    Blocks are stored together in one transaction and every output event is logged in another, the
+    contract address and issue result writes of publish and issue_tokens outputs are committed on their
+    own before either. Responds with a status per output, in order: completed, failed (the node's
+    failure, requeued), invalid or error (its block, or the events of a block output, could not be
+    stored; requeued). Only block outputs are requeued for a storage error, other outputs carry on-chain
+    work already done and are completed, their events logged one at a time if the batch insert failed."""
+    db = database.Database(current_app.logger)
+    ip_addr = request.access_route[-1]
+    node_id = db.validate_api_key(api_key)
+    if node_id:
+        json_data = request.get_json(force=True)
+        if type(json_data) is not list or len(json_data) > OUTPUT_BATCH_LIMIT:
+            abort(400)
+        results = []
+        blocks = []
+        output_events = {}
+        for each in json_data:
+            item_blocks = []
+            try:
+                item_events = command_output_events(db, node_id, ip_addr, each, item_blocks)
+            except (KeyError, TypeError, ValueError):
+                results.append({"command_id": each.get("command_id") if type(each) is dict else None,
+                                "status": "invalid"})
+                continue
+            event_data = item_events[-1][1]
+            results.append({"command_id": event_data["command_id"],
+                            "status": "failed" if event_data["error"] else "completed",
+                            "blocks": item_blocks,
+                            "events": item_events})
+            blocks.extend(item_blocks)
+        if blocks and BlockDataManager(db, current_app.logger).put_blocks(blocks) is None:
+            for each in results:
+                if each.get("blocks"):
+                    each["status"] = "error"
+        for each in results:
+            if each["status"] != "error":
+                for event_type, event_data in each.get("events", []):
+                    output_events.setdefault(event_type, []).append(event_data)
+        # event types are looked up (or created) before the batch transaction starts
+        event_types = [events.Event(event_type, db, current_app.logger) for event_type in output_events]
+        logged = True
+        for event_type in event_types:
+            if event_type.log_events(node_id, output_events[event_type.event_type], commit=False) is None:
+                logged = False
+                break
+        if logged:
+            db.db.commit()
+        else:
+            db.db.rollback()
+            # block data is only read from the chain, those commands are redone. The others may have
+            # published a contract or mined tokens already, their events are logged one by one instead
+            for each in results:
+                if each["status"] == "completed" and each.get("blocks"):
+                    each["status"] = "error"
+                elif each["status"] in ("completed", "failed"):
+                    for event_type, event_data in each["events"]:
+                        events.Event(event_type, db, current_app.logger).log_event(node_id, event_data)
+        queue = CommandQueue(db, current_app.logger)
+        for each in results:
+            if each["status"] == "completed":
+                queue.complete_command(each["command_id"], node_id)
+            elif each["status"] in ("failed", "error"):
+                queue.fail_command(each["command_id"], node_id)
+            each.pop("blocks", None)
+            each.pop("events", None)
+        return Response(json.dumps({"results": results}), mimetype="application/json")
+    abort(403)
+
+
 @node_api_blueprint.route("/dispatch_directed_command/<api_key>")
 def dispatch_directed_command(api_key):
     db = database.Database(current_app.logger)
     ip_addr = request.access_route[-1]
     node_id = db.validate_api_key(api_key)
     if node_id:
-        next_command = db.get_next_directed_command(node_id)
-        if next_command:
-            command_id = next_command[0]
-            command_data = json.loads(next_command[1])
-
-            new_event = events.Event("Ethereum Node Command Dispatch", db, current_app.logger)
-            event_data = {"ip_address": ip_addr,
-                          "node_id": node_id,
-                          "command": json.dumps(command_data),
-                          "command_id": command_id}
-            new_event_id = new_event.log_event(node_id,
-                                               json.dumps(event_data))
-            command_data["command_id"] = command_id
-            command_data["event_id"] = new_event_id
-            command_data["directed"] = True
-            if db.dispatch_directed_command(command_id, new_event_id):
-                return Response(json.dumps({"result": "OK",
-                                            "command_data": command_data}))
-            else:
-                return Response(json.dumps({"result": "Error",
-                                            "error_message": "Could not dispatch command {0}".format(command_id)}))
+        command_data = CommandQueue(db, current_app.logger).claim_command(node_id, ip_addr, directed=True)
+        if command_data:
+            return Response(json.dumps({"result": "OK",
+                                        "command_data": command_data}))
         else:
             return Response(json.dumps({"result": "Error",
                                         "error_message": "Could not fetch next directed command"}))
@@ -115,29 +195,10 @@ def dispatch_undirected_command(api_key):
     ip_addr = request.access_route[-1]
     node_id = db.validate_api_key(api_key)
     if node_id:
-        next_command = db.get_next_undirected_command()
-        if next_command:
-            command_id = next_command[0]
-            command_data = json.loads(next_command[1])
-
-            new_event = events.Event("Ethereum Node Command Dispatch", db, current_app.logger)
-            event_data = {"ip_address": ip_addr,
-                          "node_id": node_id,
-                          "command": json.dumps(command_data),
-                          "command_id": command_id}
-            new_event_id = new_event.log_event(node_id,
-                                               json.dumps(event_data))
-            command_data["command_id"] = command_id
-            command_data["event_id"] = new_event_id
-            command_data["directed"] = False
-            if db.dispatch_command(command_id,
-                                   node_id,
-                                   new_event_id):
-                return Response(json.dumps({"result": "OK",
-                                            "command_data": command_data}))
-            else:
-                return Response(json.dumps({"result": "Error",
-                                            "error_msg": "Could not dispatch command {0}".format(command_id)}))
+        command_data = CommandQueue(db, current_app.logger).claim_command(node_id, ip_addr)
+        if command_data:
+            return Response(json.dumps({"result": "OK",
+                                        "command_data": command_data}))
         else:
             return Response(json.dumps({"result": "Error",
                                         "error_msg": "Could not fetch next undirected command"}))
@@ -146,6 +207,52 @@ def dispatch_undirected_command(api_key):
                                     "error_msg": "Invalid API key"}))
 
 
+@node_api_blueprint.route("/dispatch_commands/<api_key>")
+def dispatch_commands(api_key):
+    """Claims up to ?limit= commands (capped at DISPATCH_BATCH_LIMIT) in one round trip,
+    the node's directed commands with ?directed=1, otherwise undirected ones"""
+    db = database.Database(current_app.logger)
+    ip_addr = request.access_route[-1]
+    node_id = db.validate_api_key(api_key)
+    if node_id:
+        limit = request.args.get("limit", DISPATCH_BATCH_LIMIT, type=int)
+        directed = request.args.get("directed", 0, type=int) == 1
+        commands = CommandQueue(db, current_app.logger).claim_commands(node_id, ip_addr, directed, limit)
+        if commands is not None:
+            return Response(json.dumps({"result": "OK",
+                                        "commands": commands}))
+        else:
+            return Response(json.dumps({"result": "Error",
+                                        "error_message": "Could not claim commands"}))
+    else:
+        return Response(json.dumps({"result": "Error",
+                                    "error_message": "Invalid API key"}))
+
+
+@node_api_blueprint.route("/wait_for_commands/<api_key>")
+def wait_for_commands(api_key):
+    """Long-poll variant of dispatch_commands: held open up to ?timeout= seconds (at most
+    LONG_POLL_TIMEOUT) until there is something to claim, answers with an empty list otherwise"""
+    db = database.Database(current_app.logger)
+    ip_addr = request.access_route[-1]
+    node_id = db.validate_api_key(api_key)
+    if node_id:
+        limit = request.args.get("limit", DISPATCH_BATCH_LIMIT, type=int)
+        directed = request.args.get("directed", 0, type=int) == 1
+        timeout = request.args.get("timeout", LONG_POLL_TIMEOUT, type=int)
+        commands = CommandQueue(db, current_app.logger).wait_for_commands(node_id, ip_addr, directed, limit, timeout)
+        db.close()
+        if commands is not None:
+            return Response(json.dumps({"result": "OK",
+                                        "commands": commands}))
+        else:
+            return Response(json.dumps({"result": "Error",
+                                        "error_message": "Could not claim commands"}))
+    else:
+        return Response(json.dumps({"result": "Error",
+                                    "error_message": "Invalid API key"}))
+
+
 @node_api_blueprint.route('/update/<api_key>', methods=["GET", "POST"])
 def node_api_update(api_key):
     db = database.Database()
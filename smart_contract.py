@@ -1,157 +1,264 @@
 import MySQLdb
-import json
-from ethereum_node import EthereumNode
+import MySQLdb.cursors
 from ethereum_address_pool import EthereumAddressPool
+from database import Database, encode_hash, decode_hash
 from flask import render_template
+import os
 import re
+import sys
+import threading
+from hashlib import sha256
+from collections import OrderedDict
 
 ETH_ADDRESS_REGEX = re.compile("^0x[0-9a-fA-F]{40}$")
 
+SMART_CONTRACT_COLUMNS = "smart_contracts.id,token_name,tokens,smart_contracts.created,max_priority,"
+SMART_CONTRACT_COLUMNS += "ethereum_address_pool.ethereum_address,token_symbol,owner_id,published,publish_requested "
+SMART_CONTRACT_COLUMNS += "FROM smart_contracts LEFT JOIN ethereum_address_pool "
+SMART_CONTRACT_COLUMNS += "ON smart_contracts.eth_address=ethereum_address_pool.id"
+
+TOKEN_COLUMNS = "serial,ethereum_address_pool.ethereum_address,owner_id,issued,tokens.created FROM tokens "
+TOKEN_COLUMNS += "LEFT JOIN ethereum_address_pool ON tokens.eth_address=ethereum_address_pool.id"
+
+TOKEN_PAGE_LIMIT = 500
+# contracts whose owner and source hash are kept per process for conditional view-source requests
+SOURCE_ETAG_CACHE_SIZE = 10000
+
+
+def new_claim_marker():
+    """Random tag written to the tokens moved by one assign/unassign, their ledger rows are selected by it"""
+    return int.from_bytes(os.urandom(8), "big")
+
+
+def source_hash(solidity_source):
+    """Content hash stored with the source, the same value as SHA2(solidity_source, 256) in MySQL"""
+    return sha256(solidity_source.encode("utf-8")).hexdigest()
+
+
+class SourceETagCache:
+    """Per-process LRU of smart contract id -> (owner_id, source_hash), neither changes after creation"""
+    def __init__(self, size=SOURCE_ETAG_CACHE_SIZE):
+        self.size = size
+        self._tags = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, smart_contract_id):
+        with self._lock:
+            tag = self._tags.get(smart_contract_id)
+            if tag is not None:
+                self._tags.move_to_end(smart_contract_id)
+            return tag
+
+    def put(self, smart_contract_id, tag):
+        with self._lock:
+            self._tags[smart_contract_id] = tag
+            self._tags.move_to_end(smart_contract_id)
+            while len(self._tags) > self.size:
+                self._tags.popitem(last=False)
+
+
+source_etags = SourceETagCache()
+
+
+def token_record(row, smart_contract_id):
+    return {
+        "serial": row[0],
+        "eth_address": decode_hash(row[1]),
+        "owner_id": row[2],
+        "issued": row[3],
+        "created": row[4],
+        "token_id": smart_contract_id
+    }
+
+
+def add_to_token_supply(c, smart_contract_id, created=0, issued=0, assigned=0):
+    """Adjusts a contract's token_supply counters on cursor c, inside the caller's transaction"""
+    sql = "INSERT INTO token_supply (smart_contract_id,tokens_created,tokens_issued,tokens_assigned) "
+    sql += "VALUES (%s,%s,%s,%s) ON DUPLICATE KEY UPDATE tokens_created=tokens_created+VALUES(tokens_created),"
+    sql += "tokens_issued=tokens_issued+VALUES(tokens_issued),tokens_assigned=tokens_assigned+VALUES(tokens_assigned)"
+    c.execute(sql, (smart_contract_id, created, issued, assigned))
+
+
+def add_to_token_holdings(c, smart_contract_id, owner_id, tokens):
+    """Adjusts owner_id's token_holdings counter for a contract on cursor c, inside the caller's transaction"""
+    sql = "INSERT INTO token_holdings (owner_id,smart_contract_id,tokens) VALUES (%s,%s,%s) "
+    sql += "ON DUPLICATE KEY UPDATE tokens=tokens+VALUES(tokens)"
+    c.execute(sql, (owner_id, smart_contract_id, tokens))
+
 
 def token_symbol_decorator(symbol):
     return " = \"" + symbol.upper() + "\""
 
 
-class SmartContract:
-    def __init__(self,
-                 eth_address=None,
-                 logger=None,
-                 token_name=None,
-                 token_count=-1,
-                 token_symbol=None,
-                 max_priority=10,
-                 owner_id=None,
-                 smart_token_id=None):
-        self.tokens = token_count
-        self.eth_node = EthereumNode()
-        self.contract_address = eth_address
-        self.smart_contract_id = -1
-        self.max_priority = max_priority
-        self.token_name = token_name
-        self.token_symbol = token_symbol
-        self.created = None
+def smart_contract_record(row):
+    return {
+        "token_id": row[0],
+        "token_name": row[1],
+        "tokens": row[2],
+        "created": row[3],
+        "max_priority": row[4],
+        "eth_address": decode_hash(row[5]),
+        "token_symbol": row[6],
+        "owner_id": row[7],
+        "published": row[8],
+        "publish_requested": row[9],
+        # publish sent to the network, contract address not confirmed yet
+        "pending": row[9] is not None and row[5] is None
+    }
+
+
+class SmartContractRepository:
+    """Loads smart contracts as plain records and runs token operations against them by id.
+
+    Every call shares the connection the repository was created with; nothing is read or
+    rendered until a method is called."""
+    def __init__(self, db, logger=None):
+        if isinstance(db, Database):
+            self.db = db.db
+        else:
+            self.db = db
         self.logger = logger
-        self.config_data = json.load(open("config.json", "r"))
-        self.db = MySQLdb.connect(self.config_data["mysql_host"],
-                                  self.config_data["mysql_user"],
-                                  self.config_data["mysql_password"],
-                                  self.config_data["mysql_database"])
-
-        if token_name and token_count > 0 and token_symbol:
-            try:
-                c = self.db.cursor()
-                token_count_string = "{0}".format(token_count)
-                new_smart_contract = render_template("erc20_token.sol",
-                                                     ico_name=token_name,
-                                                     ico_symbol=token_symbol_decorator(token_symbol),
-                                                     total_supply=token_count_string,
-                                                     owner_id=None)
-                sql = "INSERT INTO smart_contracts (token_name,tokens,max_priority,"
-                sql += "solidity_source,token_symbol,owner_id) VALUES (%s,%s,%s,%s,%s,%s)"
-                c.execute(sql,(self.token_name,
-                               self.tokens,
-                               self.max_priority,
-                               new_smart_contract,
-                               token_symbol,
-                               owner_id))
-                self.db.commit()
-                new_row_id = c.lastrowid
-                self.smart_contract_id = new_row_id
-                self.solidity_code = new_smart_contract
-                c.close()
-            except MySQLdb.Error as e:
-                try:
-                    if self.logger:
-                        self.logger.error("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-                    else:
-                        print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-                except IndexError:
-                    if self.logger:
-                        self.logger.error("MySQL Error: %s" % (str(e),))
-                    else:
-                        print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-        elif smart_token_id:
-            try:
-                c = self.db.cursor()
-                sql = "SELECT id, token_name, tokens, max_priority, created, token_symbol, solidity_source FROM smart_contracts"
-                sql += " WHERE id=%s"
-                c.execute(sql, (smart_token_id,))
-                inner_row = c.fetchone()
-                if inner_row:
-                    self.smart_contract_id = inner_row[0]
-                    self.token_name = inner_row[1]
-                    self.tokens = inner_row[2]
-                    self.max_priority = inner_row[3]
-                    self.created = inner_row[4]
-                    self.token_symbol = inner_row[5]
-                    self.solidity_code = inner_row[6]
-            except MySQLdb.Error as e:
-                try:
-                    if self.logger:
-                        self.logger.error("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-                    else:
-                        print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-                except IndexError:
-                    if self.logger:
-                        self.logger.error("MySQL Error: %s" % (str(e),))
-                    else:
-                        print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
+
+    def log_error(self, e):
+        try:
+            msg = "MySQL Error [%d]: %s" % (e.args[0], e.args[1])
+        except IndexError:
+            msg = "MySQL Error: %s" % (str(e),)
+        if self.logger:
+            self.logger.error(msg)
         else:
-            try:
-                c = self.db.cursor()
-                c.execute("SELECT id FROM ethereum_address_pool WHERE ethereum_address=%s", (eth_address,))
-                row = c.fetchone()
-                if row:
-                    sql = "SELECT id, token_name, tokens, max_priority, created, token_symbol, solidity_source FROM smart_contracts"
-                    sql += " WHERE eth_address=%s"
-                    c.execute(sql, (row[0],))
-                    inner_row = c.fetchone()
-                    if inner_row:
-                        self.smart_contract_id = inner_row[0]
-                        self.token_name = inner_row[1]
-                        self.tokens = inner_row[2]
-                        self.max_priority = inner_row[3]
-                        self.created = inner_row[4]
-                        self.token_symbol = inner_row[5]
-                        self.solidity_code = inner_row[6]
-                c.close()
-            except MySQLdb.Error as e:
-                try:
-                    if self.logger:
-                        self.logger.error("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-                    else:
-                        print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-                except IndexError:
-                    if self.logger:
-                        self.logger.error("MySQL Error: %s" % (str(e),))
-                    else:
-                        print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-
-    def list_owned_tokens_for_user_id(self, user_id):
+            print(msg)
+
+    def get(self, smart_contract_id):
+        contracts = self.get_many([smart_contract_id])
+        if contracts:
+            return contracts[0]
+        return None
+
+    def get_many(self, smart_contract_ids):
+        """Records for smart_contract_ids in one query, in id order; unknown ids are left out"""
+        if not smart_contract_ids:
+            return []
+        sql = "SELECT " + SMART_CONTRACT_COLUMNS + " WHERE smart_contracts.id IN ("
+        sql += ",".join(["%s"] * len(smart_contract_ids)) + ") ORDER BY smart_contracts.id"
+        try:
+            c = self.db.cursor()
+            c.execute(sql, list(smart_contract_ids))
+            output = [smart_contract_record(row) for row in c]
+            c.close()
+            return output
+        except MySQLdb.Error as e:
+            self.log_error(e)
+        return None
+
+    def list_for_user(self, user_id, managed_ids=()):
+        """Contracts owned by user_id plus those in managed_ids, with their pending status, in one query"""
+        sql = "SELECT " + SMART_CONTRACT_COLUMNS + " WHERE smart_contracts.owner_id=%s"
+        if managed_ids:
+            sql += " OR smart_contracts.id IN (" + ",".join(["%s"] * len(managed_ids)) + ")"
+        try:
+            c = self.db.cursor()
+            c.execute(sql + " ORDER BY smart_contracts.id", [user_id] + list(managed_ids))
+            output = [smart_contract_record(row) for row in c]
+            c.close()
+            return output
+        except MySQLdb.Error as e:
+            self.log_error(e)
+        return None
+
+    def get_by_address(self, eth_address):
+        eth_address_id = EthereumAddressPool(self.db, self.logger).get_id_for_ethereum_address(eth_address)
+        if eth_address_id is None:
+            return None
+        try:
+            c = self.db.cursor()
+            c.execute("SELECT " + SMART_CONTRACT_COLUMNS + " WHERE smart_contracts.eth_address=%s",
+                      (eth_address_id,))
+            row = c.fetchone()
+            c.close()
+            if row:
+                return smart_contract_record(row)
+        except MySQLdb.Error as e:
+            self.log_error(e)
+        return None
+
+    def get_solidity_source(self, smart_contract_id):
+        try:
+            c = self.db.cursor()
+            c.execute("SELECT solidity_source FROM smart_contracts WHERE id=%s", (smart_contract_id,))
+            row = c.fetchone()
+            c.close()
+            if row:
+                return row[0]
+        except MySQLdb.Error as e:
+            self.log_error(e)
+        return None
+
+    def get_source_etag(self, smart_contract_id):
+        """(owner_id, source_hash) of a contract, read once per process and then served from memory.
+
+        Contracts created before source hashes were stored have a None hash, those are not cached
+        so a backfilled hash is picked up."""
+        tag = source_etags.get(smart_contract_id)
+        if tag is not None:
+            return tag
+        try:
+            c = self.db.cursor()
+            c.execute("SELECT owner_id,source_hash FROM smart_contracts WHERE id=%s", (smart_contract_id,))
+            row = c.fetchone()
+            c.close()
+            if row:
+                tag = (row[0], row[1] or None)
+                if tag[1]:
+                    source_etags.put(smart_contract_id, tag)
+                return tag
+        except MySQLdb.Error as e:
+            self.log_error(e)
+        return None
+
+    def create(self, token_name, token_symbol, token_count, owner_id=None, max_priority=10):
+        """Renders the ERC20 source and stores a new contract, returns its id or None"""
+        if not (token_name and token_count > 0 and token_symbol):
+            return None
+        new_smart_contract = render_template("erc20_token.sol",
+                                             ico_name=token_name,
+                                             ico_symbol=token_symbol_decorator(token_symbol),
+                                             total_supply="{0}".format(token_count),
+                                             owner_id=None)
+        sql = "INSERT INTO smart_contracts (token_name,tokens,max_priority,"
+        sql += "solidity_source,source_hash,token_symbol,owner_id) VALUES (%s,%s,%s,%s,%s,%s,%s)"
+        try:
+            c = self.db.cursor()
+            c.execute(sql, (token_name,
+                            token_count,
+                            max_priority,
+                            new_smart_contract,
+                            source_hash(new_smart_contract),
+                            token_symbol,
+                            owner_id))
+            self.db.commit()
+            c.close()
+            return c.lastrowid
+        except MySQLdb.Error as e:
+            self.log_error(e)
+        return None
+
+    def list_owned_tokens_for_user_id(self, smart_contract_id, user_id):
         output = []
         sql = "SELECT serial, ethereum_address_pool.ethereum_address, issued "
         sql += "FROM tokens LEFT JOIN ethereum_address_pool ON tokens.eth_address = ethereum_address_pool.id "
         sql += "WHERE smart_contract_id=%s AND owner_id=%s"
         try:
             c = self.db.cursor()
-            c.execute(sql, (self.smart_contract_id,user_id))
+            c.execute(sql, (smart_contract_id, user_id))
             for row in c:
-                output.append({"serial": row[0], "eth_address": row[1], "issued": row[2]})
+                output.append({"serial": row[0], "eth_address": decode_hash(row[1]), "issued": row[2]})
             c.close()
         except MySQLdb.Error as e:
-            try:
-                if self.logger:
-                    self.logger.error("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-                else:
-                    print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-            except IndexError:
-                if self.logger:
-                    self.logger.error("MySQL Error: %s" % (str(e),))
-                else:
-                    print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
+            self.log_error(e)
         return output
 
-    def set_contract_address(self, contract_address):
+    def set_contract_address(self, smart_contract_id, contract_address):
         eth_address_pool = EthereumAddressPool(self.db, self.logger)
         new_eth_address = eth_address_pool.add_new_ethereum_address(contract_address)
         if new_eth_address is None:
@@ -159,145 +266,153 @@ class SmartContract:
         try:
             c = self.db.cursor()
             sql = "UPDATE smart_contracts SET eth_address=%s,published=NOW() WHERE id=%s"
-            c.execute(sql, (new_eth_address, self.smart_contract_id,))
+            c.execute(sql, (new_eth_address, smart_contract_id,))
             self.db.commit()
-            return c.lastrowid
+            return c.rowcount == 1
         except MySQLdb.Error as e:
-            try:
-                if self.logger:
-                    self.logger.error("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-                else:
-                    print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-            except IndexError:
-                if self.logger:
-                    self.logger.error("MySQL Error: %s" % (str(e),))
-                else:
-                    print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
+            self.log_error(e)
         return False
 
-    def get_issued_token_count(self):
+    def get_token_supply(self, smart_contract_ids):
+        """token_supply counters per contract for all of smart_contract_ids in one query"""
+        output = {each: {"created": 0, "issued": 0, "assigned": 0, "unassigned": 0} for each in smart_contract_ids}
+        if not smart_contract_ids:
+            return output
+        sql = "SELECT smart_contract_id,tokens_created,tokens_issued,tokens_assigned FROM token_supply "
+        sql += "WHERE smart_contract_id IN (" + ",".join(["%s"] * len(smart_contract_ids)) + ")"
         try:
             c = self.db.cursor()
-            c.execute("SELECT COUNT(*) FROM tokens WHERE smart_contract_id=%s AND issued IS NOT NULL;",
-                      (self.smart_contract_id,))
-            row = c.fetchone()
-            if row:
-                return row[0]
+            c.execute(sql, list(smart_contract_ids))
+            for row in c:
+                output[row[0]] = {"created": row[1],
+                                  "issued": row[2],
+                                  "assigned": row[3],
+                                  "unassigned": row[1] - row[3]}
+            c.close()
         except MySQLdb.Error as e:
-            try:
-                if self.logger:
-                    self.logger.error("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-                else:
-                    print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-            except IndexError:
-                if self.logger:
-                    self.logger.error("MySQL Error: %s" % (str(e),))
-                else:
-                    print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-        return 0
+            self.log_error(e)
+        return output
 
-    def issue_token(self, token_address):
-        if self.smart_contract_id > 0:
-            if not ETH_ADDRESS_REGEX.match(token_address):
-                raise ValueError
-            try:
-                c = self.db.cursor()
-                c.execute("INSERT INTO tokens (eth_address,smart_contract_id) VALUES (%s,%s)",
-                          (token_address, self.smart_contract_id))
-                self.db.commit()
-                c.close()
-                return c.lastrowid
-            except MySQLdb.Error as e:
-                try:
-                    if self.logger:
-                        self.logger.error("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-                    else:
-                        print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-                except IndexError:
-                    if self.logger:
-                        self.logger.error("MySQL Error: %s" % (str(e),))
-                    else:
-                        print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
+    def get_issued_token_count(self, smart_contract_id):
+        return self.get_token_supply([smart_contract_id])[smart_contract_id]["issued"]
+
+    def get_issued_token_counts(self, smart_contract_ids):
+        """Issued token count per contract for all of smart_contract_ids in one query"""
+        supply = self.get_token_supply(smart_contract_ids)
+        return {each: supply[each]["issued"] for each in smart_contract_ids}
+
+    def rebuild_token_supply(self, smart_contract_id=None):
+        """Recounts token_supply and token_holdings from tokens for one contract or all, True on success"""
+        sql = "INSERT INTO token_supply (smart_contract_id,tokens_created,tokens_issued,tokens_assigned) "
+        sql += "SELECT smart_contract_id,COUNT(*),SUM(issued IS NOT NULL),SUM(owner_id IS NOT NULL) FROM tokens "
+        holdings_sql = "INSERT INTO token_holdings (owner_id,smart_contract_id,tokens) "
+        holdings_sql += "SELECT owner_id,smart_contract_id,COUNT(*) FROM tokens WHERE owner_id IS NOT NULL "
+        try:
+            c = self.db.cursor()
+            if smart_contract_id:
+                c.execute("DELETE FROM token_supply WHERE smart_contract_id=%s", (smart_contract_id,))
+                c.execute(sql + "WHERE smart_contract_id=%s GROUP BY smart_contract_id", (smart_contract_id,))
+                c.execute("DELETE FROM token_holdings WHERE smart_contract_id=%s", (smart_contract_id,))
+                c.execute(holdings_sql + "AND smart_contract_id=%s GROUP BY owner_id,smart_contract_id",
+                          (smart_contract_id,))
+            else:
+                c.execute("DELETE FROM token_supply")
+                c.execute(sql + "WHERE smart_contract_id IS NOT NULL GROUP BY smart_contract_id")
+                c.execute("DELETE FROM token_holdings")
+                c.execute(holdings_sql + "AND smart_contract_id IS NOT NULL GROUP BY owner_id,smart_contract_id")
+            self.db.commit()
+            c.close()
+            return True
+        except MySQLdb.Error as e:
+            self.db.rollback()
+            self.log_error(e)
+        return False
+
+    def issue_token(self, smart_contract_id, token_address):
+        if not ETH_ADDRESS_REGEX.match(token_address):
+            raise ValueError
+        eth_address_id = EthereumAddressPool(self.db, self.logger).add_new_ethereum_address(token_address)
+        if eth_address_id is None:
+            return None
+        try:
+            c = self.db.cursor()
+            c.execute("INSERT INTO tokens (eth_address,smart_contract_id) VALUES (%s,%s)",
+                      (eth_address_id, smart_contract_id))
+            serial = c.lastrowid
+            add_to_token_supply(c, smart_contract_id, created=1)
+            self.db.commit()
+            c.close()
+            return serial
+        except MySQLdb.Error as e:
+            self.db.rollback()
+            self.log_error(e)
         return None
 
-    def issue_tokens(self, tokens):
-        if self.smart_contract_id > 0:
-            try:
-                c = self.db.cursor()
-                for x in range(0, tokens):
-                    eth_address = self.eth_node.assign_new_ethereum_address()
-                    c.execute("INSERT INTO tokens (eth_address,smart_contract_id) VALUES (%s,%s);",
-                              (eth_address, self.smart_contract_id))
-                    command_data = {"issue-token": {"eth_address": eth_address,
-                                                    "smart_contract_id": self.smart_contract_id}}
-                    c.execute("INSERT INTO commands (command) VALUES (%s);", (json.dumps(command_data),))
-                self.db.commit()
-                c.close()
-                return tokens
-            except MySQLdb.Error as e:
-                try:
-                    if self.logger:
-                        self.logger.error("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-                    else:
-                        print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-                except IndexError:
-                    if self.logger:
-                        self.logger.error("MySQL Error: %s" % (str(e),))
-                    else:
-                        print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-                return 0
-        return -1
-
-    def unassign_tokens_from_user_id(self, user_id, tokens):
+    def record_issue_results(self, smart_contract_id, results):
+        """Marks the tokens a node reported as mined issued, in one statement.
+
+        results is the per-address list from an issue_tokens command output; returns the
+        number of tokens marked, or None on error."""
+        issued_addresses = [each["eth_address"] for each in results
+                            if each.get("success") and ETH_ADDRESS_REGEX.match(each.get("eth_address", ""))]
+        if not issued_addresses:
+            return 0
+        eth_address_pool = EthereumAddressPool(self.db, self.logger)
+        sql = "UPDATE tokens INNER JOIN ethereum_address_pool ON tokens.eth_address=ethereum_address_pool.id "
+        sql += "SET tokens.issued=NOW() WHERE tokens.smart_contract_id=%s AND tokens.issued IS NULL "
+        sql += "AND ethereum_address_pool.ethereum_address IN (" + ",".join(["%s"] * len(issued_addresses)) + ")"
         try:
             c = self.db.cursor()
-            counter = 0
-            c.execute("SELECT serial FROM tokens WHERE owner_id=%s AND smart_contract_id=%s LIMIT %s",
-                      (user_id, self.smart_contract_id, tokens))
-            for row in c:
-                c.execute("UPDATE tokens SET owner_id=NULL WHERE serial=%s", (row[0],))
-                c.execute("INSERT INTO transaction_ledger (token_id,sender_id,initiated_by) VALUES (%s,%s,%s)",
-                          (row[0], user_id, user_id))
-                counter += 1
+            c.execute(sql, [smart_contract_id] + [encode_hash(each, eth_address_pool.binary_hashes)
+                                                  for each in issued_addresses])
+            issued_tokens = c.rowcount
+            add_to_token_supply(c, smart_contract_id, issued=issued_tokens)
+            self.db.commit()
+            return issued_tokens
+        except MySQLdb.Error as e:
+            self.db.rollback()
+            self.log_error(e)
+        return None
+
+    def unassign_tokens_from_user_id(self, smart_contract_id, user_id, tokens):
+        """Returns up to tokens of user_id's tokens to the unassigned supply, returns the count moved"""
+        claim_marker = new_claim_marker()
+        try:
+            c = self.db.cursor()
+            sql = "UPDATE tokens SET owner_id=NULL,claim_marker=%s WHERE smart_contract_id=%s AND owner_id=%s "
+            sql += "ORDER BY serial LIMIT %s"
+            c.execute(sql, (claim_marker, smart_contract_id, user_id, tokens))
+            counter = c.rowcount
+            sql = "INSERT INTO transaction_ledger (token_id,sender_id,initiated_by) "
+            sql += "SELECT serial,%s,%s FROM tokens WHERE claim_marker=%s"
+            c.execute(sql, (user_id, user_id, claim_marker))
+            add_to_token_supply(c, smart_contract_id, assigned=-counter)
+            add_to_token_holdings(c, smart_contract_id, user_id, -counter)
             self.db.commit()
             c.close()
             return counter
         except MySQLdb.Error as e:
-            try:
-                if self.logger:
-                    self.logger.error("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-                else:
-                    print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-            except IndexError:
-                if self.logger:
-                    self.logger.error("MySQL Error: %s" % (str(e),))
-                else:
-                    print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
+            self.db.rollback()
+            self.log_error(e)
         return 0
 
-    def get_token_count_for_user_id(self, user_id):
+    def get_token_count_for_user_id(self, smart_contract_id, user_id):
+        """user_id's tokens of a contract, read from the token_holdings counter"""
         try:
             c = self.db.cursor()
-            c.execute("SELECT COUNT(*) FROM tokens WHERE smart_contract_id=%s AND owner_id=%s",
-                      (self.smart_contract_id, user_id))
+            c.execute("SELECT tokens FROM token_holdings WHERE owner_id=%s AND smart_contract_id=%s",
+                      (user_id, smart_contract_id))
             row = c.fetchone()
             c.close()
             if row:
                 return row[0]
         except MySQLdb.Error as e:
-            try:
-                if self.logger:
-                    self.logger.error("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-                else:
-                    print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-            except IndexError:
-                if self.logger:
-                    self.logger.error("MySQL Error: %s" % (str(e),))
-                else:
-                    print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
+            self.log_error(e)
         return 0
 
-    def assign_tokens_to_user_id(self,user_id,tokens):
+    def assign_tokens_to_user_id(self, smart_contract_id, user_id, tokens):
+        """Moves up to tokens unassigned tokens to user_id, returns the count moved"""
+        claim_marker = new_claim_marker()
         try:
             c = self.db.cursor()
             c.execute("SELECT user_id FROM users WHERE email_address='admin';")
@@ -306,103 +421,95 @@ class SmartContract:
             if row:
                 admin_user_id = row[0]
             if admin_user_id > 0:
-                assigned_tokens = 0
-                c.execute("SELECT serial FROM tokens WHERE smart_contract_id=%s AND owner_id IS NULL LIMIT %s",
-                          (self.smart_contract_id, tokens))
-                for row in c:
-                    token_id = row[0]
-                    c.execute("UPDATE tokens SET owner_id=%s WHERE serial=%s;", (user_id, token_id,))
-                    c.execute("INSERT INTO transaction_ledger (token_id,receiver_id,initiated_by) VALUES (%s,%s,%s)",
-                              (token_id, user_id, admin_user_id))
-                    assigned_tokens += 1
-                c.close()
+                sql = "UPDATE tokens SET owner_id=%s,claim_marker=%s WHERE smart_contract_id=%s AND owner_id IS NULL "
+                sql += "ORDER BY serial LIMIT %s"
+                c.execute(sql, (user_id, claim_marker, smart_contract_id, tokens))
+                assigned_tokens = c.rowcount
+                sql = "INSERT INTO transaction_ledger (token_id,receiver_id,initiated_by) "
+                sql += "SELECT serial,%s,%s FROM tokens WHERE claim_marker=%s"
+                c.execute(sql, (user_id, admin_user_id, claim_marker))
+                add_to_token_supply(c, smart_contract_id, assigned=assigned_tokens)
+                add_to_token_holdings(c, smart_contract_id, user_id, assigned_tokens)
                 self.db.commit()
+                c.close()
                 return assigned_tokens
         except MySQLdb.Error as e:
-            try:
-                if self.logger:
-                    self.logger.error("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-                else:
-                    print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-            except IndexError:
-                if self.logger:
-                    self.logger.error("MySQL Error: %s" % (str(e),))
-                else:
-                    print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
+            self.db.rollback()
+            self.log_error(e)
         return 0
 
-    def publish_smart_contract(self):
-        if self.smart_contract_id > 0:
-            sql = "UPDATE smart_contracts SET published=NOW() WHERE id=%s"
-            try:
-                c = self.db.cursor()
-                c.execute(sql,(self.smart_contract_id,))
-                self.db.commit()
-                c.close()
-                return True
-            except MySQLdb.Error as e:
-                try:
-                    if self.logger:
-                        self.logger.error("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-                    else:
-                        print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-                except IndexError:
-                    if self.logger:
-                        self.logger.error("MySQL Error: %s" % (str(e),))
-                    else:
-                        print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
+    def publish_smart_contract(self, smart_contract_id):
+        """Records that the contract's publish command was sent, published is set once its address is confirmed"""
+        sql = "UPDATE smart_contracts SET publish_requested=NOW() WHERE id=%s AND publish_requested IS NULL"
+        try:
+            c = self.db.cursor()
+            c.execute(sql, (smart_contract_id,))
+            self.db.commit()
+            c.close()
+            return True
+        except MySQLdb.Error as e:
+            self.log_error(e)
         return False
 
-    def list_all_issued_tokens(self, token_id):
+    def list_issued_tokens(self, smart_contract_id, after_serial=0, limit=TOKEN_PAGE_LIMIT):
+        """One keyset page of a contract's tokens in serial order.
+
+        :return: {"tokens": [...], "next_serial": serial to pass as after_serial for the next page, or None}
+        or None on error"""
+        sql = "SELECT " + TOKEN_COLUMNS + " WHERE smart_contract_id=%s AND serial>%s ORDER BY serial LIMIT %s"
         try:
             c = self.db.cursor()
-            sql = "SELECT serial, ethereum_address_pool.ethereum_address, owner_id, issued, created FROM tokens "
-            sql += "INNER JOIN ethereum_address_pool ON tokens.eth_address=ethereum_address_pool.id "
-            sql += "WHERE smart_contract_id=%s;"
-            c.execute(sql, (token_id,))
-            output = []
-            for row in c:
-                token = {
-                    "serial": row[0],
-                    "eth_address": row[1],
-                    "owner_id": row[2],
-                    "issued": row[3],
-                    "created": row[4],
-                    "token_id": token_id
-                }
-                output.append(token)
-            return output
+            c.execute(sql, (smart_contract_id, after_serial, limit + 1))
+            output = [token_record(row, smart_contract_id) for row in c.fetchall()]
+            c.close()
+            next_serial = None
+            if len(output) > limit:
+                output = output[:limit]
+                next_serial = output[-1]["serial"]
+            return {"tokens": output, "next_serial": next_serial}
         except MySQLdb.Error as e:
-            try:
-                if self.logger:
-                    self.logger.error("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-                else:
-                    print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-            except IndexError:
-                if self.logger:
-                    self.logger.error("MySQL Error: %s" % (str(e),))
-                else:
-                    print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
+            self.log_error(e)
         return None
 
-    def get_unassigned_token_count(self):
+    def stream_issued_tokens(self, smart_contract_id):
+        """Generator over all of a contract's tokens in serial order, read through a server-side cursor.
+
+        Rows are fetched as the generator is consumed, so memory stays flat for any contract size.
+        The connection can't run other queries until the generator is exhausted or closed."""
+        c = self.db.cursor(MySQLdb.cursors.SSCursor)
         try:
-            c = self.db.cursor()
-            c.execute("SELECT COUNT(*) FROM tokens WHERE smart_contract_id=%s AND owner_id IS NULL",
-                      (self.smart_contract_id,))
-            row = c.fetchone()
-            c.close()
-            if row:
-                return row[0]
+            c.execute("SELECT " + TOKEN_COLUMNS + " WHERE smart_contract_id=%s ORDER BY serial", (smart_contract_id,))
+            for row in c:
+                yield token_record(row, smart_contract_id)
         except MySQLdb.Error as e:
-            try:
-                if self.logger:
-                    self.logger.error("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-                else:
-                    print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-            except IndexError:
-                if self.logger:
-                    self.logger.error("MySQL Error: %s" % (str(e),))
-                else:
-                    print("MySQL Error [%d]: %s" % (e.args[0], e.args[1]))
-        return 0
+            self.log_error(e)
+        finally:
+            c.close()
+
+    def get_unassigned_token_count(self, smart_contract_id):
+        return self.get_token_supply([smart_contract_id])[smart_contract_id]["unassigned"]
+
+
+if __name__ == "__main__":
+    HELP = """python smart_contract.py command [argument]
+
+        rebuild-supply [smart_contract_id]     recounts token_supply and token_holdings
+
+        python smart_contract.py rebuild-supply
+        python smart_contract.py rebuild-supply 3
+"""
+    if len(sys.argv) < 2:
+        print(HELP)
+    else:
+        contracts = SmartContractRepository(Database())
+        command = sys.argv[1]
+        if command == "rebuild-supply":
+            if len(sys.argv) > 2:
+                success = contracts.rebuild_token_supply(int(sys.argv[2]))
+            else:
+                success = contracts.rebuild_token_supply()
+            if success:
+                print("Rebuilt token supply counters.")
+        else:
+            print("Unknown command.\n\n")
+            print(HELP)
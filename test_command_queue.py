@@ -0,0 +1,151 @@
+# command queue state machine: claim -> complete / fail -> reap -> dead-letter
+#
+#   python -m pytest -q test_command_queue.py
+#
+# needs MySQL, see database_test_harness.py; skipped without it
+
+import unittest
+import threading
+import tempfile
+import gzip
+import json
+import os
+import database_test_harness
+
+if not database_test_harness.mysql_available():
+    raise unittest.SkipTest("MySQL scratch database not available")
+
+from command_queue import CommandQueue, MAX_ATTEMPTS
+
+
+class CommandQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.db = database_test_harness.connect_scratch_database()
+        self.node = database_test_harness.ScratchNode(self.db)
+        self.queue = CommandQueue(self.db)
+
+    def tearDown(self):
+        self.node.remove()
+        self.db.close()
+
+    def expire_lease(self, command_id):
+        c = self.db.cursor()
+        c.execute("UPDATE commands SET lease_expires=NOW() - INTERVAL 1 SECOND WHERE command_id=%s", (command_id,))
+        self.db.commit()
+
+    def test_claim_then_complete(self):
+        command_id = self.node.post_command({"test": "complete"})
+        self.assertEqual(self.node.pending(), 1)
+        claimed = self.queue.claim_commands(self.node.node_id, directed=True)
+        self.assertEqual([each["command_id"] for each in claimed], [command_id])
+        self.assertEqual(self.node.pending(), 0)
+        dispatch_event_id, attempts, completed, dead_lettered, lease_expires = self.node.command(command_id)
+        self.assertIsNotNone(dispatch_event_id)
+        self.assertEqual(attempts, 1)
+        self.assertIsNotNone(lease_expires)
+        # leased, not handed out again
+        self.assertEqual(self.queue.claim_commands(self.node.node_id, directed=True), [])
+        self.assertTrue(self.queue.complete_command(command_id, self.node.node_id))
+        dispatch_event_id, attempts, completed, dead_lettered, lease_expires = self.node.command(command_id)
+        self.assertIsNotNone(completed)
+        self.assertIsNone(lease_expires)
+        # completed once only
+        self.assertFalse(self.queue.complete_command(command_id, self.node.node_id))
+
+    def test_fail_requeues_until_dead_lettered(self):
+        command_id = self.node.post_command({"test": "fail"})
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            claimed = self.queue.claim_commands(self.node.node_id, directed=True)
+            self.assertEqual([each["command_id"] for each in claimed], [command_id])
+            self.assertTrue(self.queue.fail_command(command_id, self.node.node_id))
+            dispatch_event_id, attempts, completed, dead_lettered, lease_expires = self.node.command(command_id)
+            self.assertEqual(attempts, attempt)
+            if attempt < MAX_ATTEMPTS:
+                self.assertIsNone(dispatch_event_id)
+                self.assertIsNone(dead_lettered)
+                self.assertEqual(self.node.pending(), 1)
+        self.assertIsNotNone(dead_lettered)
+        self.assertEqual(self.node.pending(), 0)
+        self.assertEqual(self.queue.claim_commands(self.node.node_id, directed=True), [])
+
+    def test_reap_requeues_expired_lease(self):
+        command_id = self.node.post_command({"test": "reap"})
+        self.queue.claim_commands(self.node.node_id, directed=True)
+        self.expire_lease(command_id)
+        requeued, dead_lettered = self.queue.reap_expired_leases()
+        self.assertGreaterEqual(requeued, 1)
+        self.assertIsNone(self.node.command(command_id)[0])
+        self.assertEqual(self.node.pending(), 1)
+        claimed = self.queue.claim_commands(self.node.node_id, directed=True)
+        self.assertEqual([each["command_id"] for each in claimed], [command_id])
+        self.assertEqual(self.node.command(command_id)[1], 2)
+
+    def test_reap_dead_letters_out_of_attempts(self):
+        command_id = self.node.post_command({"test": "reap dead letter"})
+        self.queue.claim_commands(self.node.node_id, directed=True)
+        c = self.db.cursor()
+        c.execute("UPDATE commands SET attempts=%s WHERE command_id=%s", (MAX_ATTEMPTS, command_id))
+        self.db.commit()
+        self.expire_lease(command_id)
+        requeued, dead_lettered = self.queue.reap_expired_leases()
+        self.assertGreaterEqual(dead_lettered, 1)
+        self.assertIsNotNone(self.node.command(command_id)[3])
+        self.assertEqual(self.queue.claim_commands(self.node.node_id, directed=True), [])
+
+    def test_purge_archives_dead_lettered(self):
+        command_id = self.node.post_command({"test": "purge dead letter"})
+        self.queue.claim_commands(self.node.node_id, directed=True)
+        c = self.db.cursor()
+        c.execute("UPDATE commands SET lease_expires=NULL, dead_lettered=NOW() - INTERVAL 2 HOUR "
+                  "WHERE command_id=%s", (command_id,))
+        self.db.commit()
+        with tempfile.TemporaryDirectory() as archive_directory:
+            self.assertGreaterEqual(self.queue.purge_completed(1, archive_directory), 1)
+            archived = []
+            for filename in os.listdir(archive_directory):
+                with gzip.open(os.path.join(archive_directory, filename), "rt") as archive:
+                    archived.extend(json.loads(line) for line in archive)
+        archived = [each for each in archived if each["command_id"] == command_id]
+        self.assertEqual(len(archived), 1)
+        self.assertIsNone(archived[0]["completed"])
+        self.assertIsNotNone(archived[0]["dead_lettered"])
+        self.assertIsNone(self.node.command(command_id))
+
+    def test_idempotency_key_absorbs_duplicate_posts(self):
+        first = self.node.post_command({"test": "idempotent"}, idempotency_key="test:" + self.node.api_key)
+        second = self.node.post_command({"test": "idempotent"}, idempotency_key="test:" + self.node.api_key)
+        self.assertEqual(first, second)
+        self.assertEqual(self.node.pending(), 1)
+        # completing releases the key, the same work can be posted again
+        self.queue.claim_commands(self.node.node_id, directed=True)
+        self.queue.complete_command(first, self.node.node_id)
+        third = self.node.post_command({"test": "idempotent"}, idempotency_key="test:" + self.node.api_key)
+        self.assertNotEqual(third, first)
+
+    def test_concurrent_claims_never_overlap(self):
+        command_ids = set(self.node.post_command({"test": "concurrent", "n": n}) for n in range(0, 20))
+        claims = []
+        claims_lock = threading.Lock()
+
+        def claimer():
+            db = database_test_harness.connect_scratch_database()
+            queue = CommandQueue(db)
+            while True:
+                claimed = queue.claim_commands(self.node.node_id, directed=True, limit=3)
+                if not claimed:
+                    break
+                with claims_lock:
+                    claims.extend(each["command_id"] for each in claimed)
+            db.close()
+
+        threads = [threading.Thread(target=claimer) for x in range(0, 4)]
+        for each in threads:
+            each.start()
+        for each in threads:
+            each.join()
+        self.assertEqual(len(claims), len(set(claims)))
+        self.assertEqual(set(claims), command_ids)
+
+
+if __name__ == "__main__":
+    unittest.main()
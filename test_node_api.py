@@ -0,0 +1,149 @@
+# node_api command_outputs: per-item statuses of a batch and the queue state they leave
+#
+#   python -m pytest -q test_node_api.py
+#
+# needs MySQL and Flask, see database_test_harness.py; skipped without them
+
+import unittest
+import json
+import os
+import random
+import time
+from unittest import mock
+import database_test_harness
+
+if not database_test_harness.mysql_available():
+    raise unittest.SkipTest("MySQL scratch database not available")
+
+from flask import Flask
+import events
+import node_api
+from command_queue import CommandQueue
+
+
+class CommandOutputsTest(unittest.TestCase):
+    def setUp(self):
+        self.db = database_test_harness.connect_scratch_database()
+        self.node = database_test_harness.ScratchNode(self.db)
+        app = Flask(__name__)
+        app.register_blueprint(node_api.node_api_blueprint)
+        self.client = app.test_client()
+        self.block_numbers = []
+
+    def tearDown(self):
+        c = self.db.cursor()
+        for block_number in self.block_numbers:
+            c.execute("DELETE external_transaction_ledger FROM external_transaction_ledger INNER JOIN block_data "
+                      "ON external_transaction_ledger.block_data_id=block_data.block_data_id "
+                      "WHERE block_data.block_number=%s", (block_number,))
+            c.execute("DELETE FROM block_data WHERE block_number=%s", (block_number,))
+        self.db.commit()
+        self.node.remove()
+        self.db.close()
+
+    def block_input(self):
+        """get_block_data output for a block number far past the chain, removed again in tearDown"""
+        block_number = random.randrange(10 ** 15, 10 ** 16)
+        self.block_numbers.append(block_number)
+        return json.dumps({"block_number": block_number,
+                           "block_hash": "0x" + os.urandom(32).hex(),
+                           "block_timestamp": int(time.time()),
+                           "gas_used": 21000,
+                           "gas_limit": 8000000,
+                           "block_size": 600,
+                           "tx_count": 0,
+                           "transactions": []})
+
+    def claim(self, count):
+        command_ids = [self.node.post_command({"test": "output", "n": n}) for n in range(0, count)]
+        CommandQueue(self.db).claim_commands(self.node.node_id, directed=True)
+        return command_ids
+
+    def post(self, outputs):
+        return self.client.post("/node_api/command_outputs/" + self.node.api_key, data=json.dumps(outputs))
+
+    def test_per_item_status(self):
+        completed_id, failed_id = self.claim(2)
+        response = self.post([
+            {"success": True, "command_id": completed_id, "input": json.dumps({"result": "ok"})},
+            {"success": False, "command_id": failed_id, "error_message": "test failure"},
+            {"success": True, "input": "{}"}
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)["results"], [
+            {"command_id": completed_id, "status": "completed"},
+            {"command_id": failed_id, "status": "failed"},
+            {"command_id": None, "status": "invalid"}
+        ])
+        self.assertIsNotNone(self.node.command(completed_id)[2])
+        # the failed command is back in the queue
+        self.assertIsNone(self.node.command(failed_id)[0])
+        self.assertEqual(self.node.pending(), 1)
+        c = self.db.cursor()
+        c.execute("SELECT COUNT(*) FROM event_log WHERE user_id=%s AND JSON_EXTRACT(event_data, '$.command_id') "
+                  "IN (%s,%s)", (self.node.node_id, completed_id, failed_id))
+        # dispatch events of both claims, plus one output and one failure event
+        self.assertEqual(c.fetchone()[0], 4)
+        self.db.commit()
+
+    def test_block_stored_already_completes(self):
+        # a node redoing an expired lease reports a block the first node already stored
+        first_id, second_id = self.claim(2)
+        block_input = self.block_input()
+        for command_id in (first_id, second_id):
+            response = self.client.post("/node_api/command_output/" + self.node.api_key,
+                                        data=json.dumps({"success": True, "command_id": command_id,
+                                                         "input": block_input}))
+            self.assertEqual(response.status_code, 200)
+            dispatch_event_id, attempts, completed, dead_lettered, lease_expires = self.node.command(command_id)
+            self.assertIsNotNone(completed)
+            self.assertEqual(attempts, 1)
+        self.assertEqual(self.node.pending(), 0)
+
+    def test_batch_block_stored_already_completes(self):
+        first_id, second_id, third_id = self.claim(3)
+        block_input = self.block_input()
+        self.client.post("/node_api/command_output/" + self.node.api_key,
+                         data=json.dumps({"success": True, "command_id": first_id, "input": block_input}))
+        response = self.post([{"success": True, "command_id": second_id, "input": block_input},
+                              {"success": True, "command_id": third_id, "input": self.block_input()}])
+        self.assertEqual(json.loads(response.data)["results"], [
+            {"command_id": second_id, "status": "completed"},
+            {"command_id": third_id, "status": "completed"}
+        ])
+        self.assertEqual(self.node.pending(), 0)
+
+    def test_event_failure_requeues_block_outputs_only(self):
+        burn_id, block_id = self.claim(2)
+        burn_output = {"erc20_function": "burn", "contract_address": "0x" + os.urandom(20).hex(),
+                       "token_id": 0, "tokens": 1, "gas_price": 1}
+        # the batch insert of the output events fails, single events still log
+        with mock.patch.object(events.Event, "log_events", return_value=None):
+            response = self.post([{"success": True, "command_id": burn_id, "input": json.dumps(burn_output)},
+                                  {"success": True, "command_id": block_id, "input": self.block_input()}])
+        self.assertEqual(json.loads(response.data)["results"], [
+            {"command_id": burn_id, "status": "completed"},
+            {"command_id": block_id, "status": "error"}
+        ])
+        # the burn is not sent back to a node, its events were logged one by one
+        self.assertIsNotNone(self.node.command(burn_id)[2])
+        c = self.db.cursor()
+        c.execute("SELECT COUNT(*) FROM event_log WHERE event_id>=%s AND user_id=%s "
+                  "AND JSON_EXTRACT(event_data, '$.command_id')=%s",
+                  (self.node.first_event_id, self.node.node_id, burn_id))
+        # dispatch, burn and command output events
+        self.assertEqual(c.fetchone()[0], 3)
+        self.db.commit()
+        # block data is redone
+        self.assertIsNone(self.node.command(block_id)[0])
+        self.assertEqual(self.node.pending(), 1)
+
+    def test_rejects_bad_batches(self):
+        self.assertEqual(self.post({"success": True}).status_code, 400)
+        self.assertEqual(self.post([{}] * (node_api.OUTPUT_BATCH_LIMIT + 1)).status_code, 400)
+        response = self.client.post("/node_api/command_outputs/not-a-key", data="[]")
+        self.assertEqual(response.status_code, 403)
+
+
+if __name__ == "__main__":
+    unittest.main()
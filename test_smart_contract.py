@@ -0,0 +1,91 @@
+# token paging and assignment: keyset page boundaries, claim-marker assign/unassign and their counters
+#
+#   python -m pytest -q test_smart_contract.py
+#
+# needs MySQL, see database_test_harness.py; skipped without it
+
+import unittest
+import database_test_harness
+
+if not database_test_harness.mysql_available():
+    raise unittest.SkipTest("MySQL scratch database not available")
+
+from smart_contract import SmartContractRepository
+
+TEST_TOKENS = 10
+
+
+class SmartContractTest(unittest.TestCase):
+    def setUp(self):
+        self.db = database_test_harness.connect_scratch_database()
+        c = self.db.cursor()
+        # created like benchmark.py does, without the rendered source
+        c.execute("INSERT INTO smart_contracts (token_name,tokens,token_symbol) VALUES (%s,%s,%s)",
+                  ("test", TEST_TOKENS, "TEST"))
+        self.smart_contract_id = c.lastrowid
+        c.executemany("INSERT INTO tokens (smart_contract_id) VALUES (%s)", [(self.smart_contract_id,)] * TEST_TOKENS)
+        self.db.commit()
+        self.contracts = SmartContractRepository(self.db)
+        self.contracts.rebuild_token_supply(self.smart_contract_id)
+
+    def tearDown(self):
+        c = self.db.cursor()
+        c.execute("DELETE transaction_ledger FROM transaction_ledger INNER JOIN tokens "
+                  "ON transaction_ledger.token_id=tokens.serial WHERE tokens.smart_contract_id=%s",
+                  (self.smart_contract_id,))
+        c.execute("DELETE FROM tokens WHERE smart_contract_id=%s", (self.smart_contract_id,))
+        c.execute("DELETE FROM token_supply WHERE smart_contract_id=%s", (self.smart_contract_id,))
+        c.execute("DELETE FROM token_holdings WHERE smart_contract_id=%s", (self.smart_contract_id,))
+        c.execute("DELETE FROM smart_contracts WHERE id=%s", (self.smart_contract_id,))
+        self.db.commit()
+        self.db.close()
+
+    def pages(self, limit):
+        serials = []
+        page_sizes = []
+        after_serial = 0
+        while True:
+            page = self.contracts.list_issued_tokens(self.smart_contract_id, after_serial, limit)
+            serials.extend(each["serial"] for each in page["tokens"])
+            page_sizes.append(len(page["tokens"]))
+            if page["next_serial"] is None:
+                return serials, page_sizes
+            after_serial = page["next_serial"]
+
+    def test_keyset_pages_cover_every_token_once(self):
+        for limit in (1, 3, 5, TEST_TOKENS, TEST_TOKENS + 1):
+            serials, page_sizes = self.pages(limit)
+            self.assertEqual(len(serials), TEST_TOKENS)
+            self.assertEqual(serials, sorted(set(serials)))
+            # a page that ends exactly on the last token has no next page
+            self.assertEqual(len(page_sizes), -(-TEST_TOKENS // limit))
+
+    def test_assign_and_unassign_move_tokens_and_counters(self):
+        c = self.db.cursor()
+        c.execute("SELECT user_id FROM users WHERE email_address='admin'")
+        row = c.fetchone()
+        self.db.commit()
+        if not row:
+            self.skipTest("assignments are initiated by the admin user")
+        user_id = row[0]
+        self.assertEqual(self.contracts.assign_tokens_to_user_id(self.smart_contract_id, user_id, 4), 4)
+        self.assertEqual(self.contracts.get_token_count_for_user_id(self.smart_contract_id, user_id), 4)
+        # only unassigned tokens can be assigned
+        self.assertEqual(self.contracts.assign_tokens_to_user_id(self.smart_contract_id, user_id, TEST_TOKENS), 6)
+        self.assertEqual(self.contracts.unassign_tokens_from_user_id(self.smart_contract_id, user_id, 3), 3)
+        supply = self.contracts.get_token_supply([self.smart_contract_id])[self.smart_contract_id]
+        self.assertEqual(supply["assigned"], TEST_TOKENS - 3)
+        self.assertEqual(self.contracts.get_token_count_for_user_id(self.smart_contract_id, user_id),
+                         TEST_TOKENS - 3)
+        c.execute("SELECT COUNT(*) FROM tokens WHERE smart_contract_id=%s AND owner_id=%s",
+                  (self.smart_contract_id, user_id))
+        self.assertEqual(c.fetchone()[0], TEST_TOKENS - 3)
+        # one ledger row per token moved, found through its claim marker
+        c.execute("SELECT COUNT(*) FROM transaction_ledger INNER JOIN tokens ON transaction_ledger.token_id="
+                  "tokens.serial WHERE tokens.smart_contract_id=%s", (self.smart_contract_id,))
+        self.assertEqual(c.fetchone()[0], TEST_TOKENS + 3)
+        self.db.commit()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,281 @@
+# token_issuance.py
+#
+# bulk issuance of random-address tokens, run as background jobs so a large ICO
+# doesn't hold an admin request open. Each job is worked through in chunks: one
+# transaction claims a chunk of pool addresses, writes the tokens and their mining
+# commands with multi-row inserts and advances the job's progress.
+#
+# Mining commands are coalesced, one command carries up to MINING_BATCH_SIZE addresses:
+#   {"erc20_function": "issue_tokens", "token_id": <smart_contract_id>, "eth_addresses": [...]}
+# and the node reports a result per address in its command output:
+#   {"erc20_function": "issue_tokens", "token_id": .., "results": [{"eth_address": .., "success": true}, ...]}
+
+import MySQLdb
+import json
+import threading
+from database import Database, COMMAND_PRIORITY_ISSUANCE, add_to_queue_depth
+import ethereum_address_pool
+from ethereum_address_pool import EthereumAddressPool
+from command_notifier import command_notifier
+from smart_contract import add_to_token_supply
+
+# tokens written per transaction
+ISSUANCE_CHUNK_SIZE = 1000
+# seconds between checks for new jobs by the background worker
+ISSUANCE_POLL_INTERVAL = 5
+# a running job whose heartbeat is older than this was abandoned by a dead worker and is taken over
+ISSUANCE_STALE_SECONDS = 120
+# token addresses carried by one issue_tokens mining command
+MINING_BATCH_SIZE = 250
+
+JOB_COLUMNS = "id,smart_contract_id,requested_by,requested,issued,status,error_message,heartbeat,created,completed"
+
+
+def issuance_job_record(row):
+    return {
+        "job_id": row[0],
+        "token_id": row[1],
+        "requested_by": row[2],
+        "requested": row[3],
+        "issued": row[4],
+        "status": row[5],
+        "error_message": row[6],
+        "heartbeat": row[7],
+        "created": row[8],
+        "completed": row[9]
+    }
+
+
+def mining_commands(smart_contract_id, new_addresses, batch_size=MINING_BATCH_SIZE):
+    """issue_tokens commands for (id, address) tuples, batch_size addresses per command"""
+    output = []
+    for x in range(0, len(new_addresses), batch_size):
+        batch = new_addresses[x:x + batch_size]
+        output.append({"erc20_function": "issue_tokens",
+                       "token_id": smart_contract_id,
+                       "eth_addresses": [eth_address for eth_address_id, eth_address in batch]})
+    return output
+
+
+class TokenIssuance:
+    def __init__(self, db, logger=None, chunk_size=ISSUANCE_CHUNK_SIZE):
+        if isinstance(db, Database):
+            self.db = db.db
+        else:
+            self.db = db
+        self.logger = logger
+        self.chunk_size = chunk_size
+
+    def log_error(self, e):
+        try:
+            msg = "MySQL Error [%d]: %s" % (e.args[0], e.args[1])
+        except IndexError:
+            msg = "MySQL Error: %s" % (str(e),)
+        if self.logger:
+            self.logger.error(msg)
+        else:
+            print(msg)
+        return msg
+
+    def create_job(self, smart_contract_id, tokens, user_id=None):
+        """Queues issuance of tokens random-address tokens, returns the job id or None"""
+        if tokens < 1:
+            raise ValueError
+        try:
+            c = self.db.cursor()
+            c.execute("INSERT INTO token_issuance_jobs (smart_contract_id,requested_by,requested) VALUES (%s,%s,%s)",
+                      (smart_contract_id, user_id, tokens))
+            self.db.commit()
+            if issuance_worker:
+                issuance_worker.wake()
+            return c.lastrowid
+        except MySQLdb.Error as e:
+            self.log_error(e)
+        return None
+
+    def get_job(self, job_id):
+        try:
+            c = self.db.cursor()
+            c.execute("SELECT " + JOB_COLUMNS + " FROM token_issuance_jobs WHERE id=%s", (job_id,))
+            row = c.fetchone()
+            c.close()
+            if row:
+                return issuance_job_record(row)
+        except MySQLdb.Error as e:
+            self.log_error(e)
+        return None
+
+    def get_unfinished_jobs(self, smart_contract_ids):
+        """Pending, running and failed jobs for each of smart_contract_ids, oldest first, in one query"""
+        output = {each: [] for each in smart_contract_ids}
+        if not smart_contract_ids:
+            return output
+        sql = "SELECT " + JOB_COLUMNS + " FROM token_issuance_jobs WHERE smart_contract_id IN ("
+        sql += ",".join(["%s"] * len(smart_contract_ids)) + ") AND status <> 'complete' ORDER BY id"
+        try:
+            c = self.db.cursor()
+            c.execute(sql, list(smart_contract_ids))
+            for row in c:
+                job = issuance_job_record(row)
+                output[job["token_id"]].append(job)
+            c.close()
+        except MySQLdb.Error as e:
+            self.log_error(e)
+        return output
+
+    def resume_job(self, job_id):
+        """Requeues a failed job, it carries on from the last committed chunk"""
+        try:
+            c = self.db.cursor()
+            c.execute("UPDATE token_issuance_jobs SET status='pending',error_message=NULL WHERE id=%s "
+                      "AND status='failed'", (job_id,))
+            self.db.commit()
+            if c.rowcount == 1:
+                if issuance_worker:
+                    issuance_worker.wake()
+                return True
+        except MySQLdb.Error as e:
+            self.log_error(e)
+        return False
+
+    def claim_job(self):
+        """Marks the oldest pending (or abandoned) job running and returns it, None when there is none"""
+        try:
+            c = self.db.cursor()
+            sql = "SELECT " + JOB_COLUMNS + " FROM token_issuance_jobs WHERE status='pending' "
+            sql += "OR (status='running' AND heartbeat < NOW() - INTERVAL %s SECOND) "
+            sql += "ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED"
+            c.execute(sql, (ISSUANCE_STALE_SECONDS,))
+            row = c.fetchone()
+            if row:
+                c.execute("UPDATE token_issuance_jobs SET status='running',heartbeat=NOW() WHERE id=%s", (row[0],))
+            self.db.commit()
+            if row:
+                return issuance_job_record(row)
+        except MySQLdb.Error as e:
+            self.db.rollback()
+            self.log_error(e)
+        return None
+
+    def issue_chunk(self, job_id):
+        """Issues the next chunk of a running job in one transaction.
+
+        Returns the number of tokens issued, 0 when the job is done or the address pool is
+        empty, or None on error (the chunk is rolled back and the job marked failed)."""
+        try:
+            c = self.db.cursor()
+            # the row lock keeps a worker taking over a stale job from racing the original one
+            c.execute("SELECT smart_contract_id, requested, issued FROM token_issuance_jobs WHERE id=%s "
+                      "AND status='running' FOR UPDATE", (job_id,))
+            row = c.fetchone()
+            if not row or row[2] >= row[1]:
+                self.db.commit()
+                return 0
+            smart_contract_id = row[0]
+            chunk = min(self.chunk_size, row[1] - row[2])
+            new_addresses = EthereumAddressPool(self.db, self.logger).claim_addresses(chunk, commit=False)
+            if new_addresses is None:
+                raise MySQLdb.Error("Could not claim addresses for issuance job {0}".format(job_id))
+            if not new_addresses:
+                # back in the queue, the next pass after the refiller has run picks it up again
+                c.execute("UPDATE token_issuance_jobs SET status='pending',heartbeat=NOW() WHERE id=%s", (job_id,))
+                self.db.commit()
+                if ethereum_address_pool.refiller:
+                    ethereum_address_pool.refiller.wake()
+                return 0
+            # no trailing semicolons, executemany only rewrites a bare VALUES clause into one multi-row INSERT
+            c.executemany("INSERT INTO tokens (eth_address,smart_contract_id) VALUES (%s,%s)",
+                          [(eth_address_id, smart_contract_id) for eth_address_id, eth_address in new_addresses])
+            commands = mining_commands(smart_contract_id, new_addresses)
+            c.executemany("INSERT INTO commands (command,command_type,priority) VALUES (%s,%s,%s)",
+                          [(json.dumps(command), "issue_tokens", COMMAND_PRIORITY_ISSUANCE) for command in commands])
+            add_to_queue_depth(c, None, len(commands), "issue_tokens")
+            add_to_token_supply(c, smart_contract_id, created=len(new_addresses))
+            sql = "UPDATE token_issuance_jobs SET issued=issued+%s,heartbeat=NOW(),"
+            sql += "status=IF(issued>=requested,'complete',status),"
+            sql += "completed=IF(issued>=requested,NOW(),NULL) WHERE id=%s"
+            c.execute(sql, (len(new_addresses), job_id))
+            self.db.commit()
+            command_notifier.notify()
+            return len(new_addresses)
+        except MySQLdb.Error as e:
+            self.db.rollback()
+            self.fail_job(job_id, self.log_error(e))
+        return None
+
+    def fail_job(self, job_id, error_message):
+        try:
+            c = self.db.cursor()
+            c.execute("UPDATE token_issuance_jobs SET status='failed',error_message=%s WHERE id=%s",
+                      (error_message[:255], job_id))
+            self.db.commit()
+        except MySQLdb.Error as e:
+            self.log_error(e)
+
+    def run_job(self, job_id):
+        """Issues chunks until the job completes, fails or the address pool runs dry, True once complete"""
+        while True:
+            issued = self.issue_chunk(job_id)
+            if issued is None:
+                return False
+            if issued == 0:
+                job = self.get_job(job_id)
+                return job is not None and job["status"] == "complete"
+
+
+class TokenIssuanceWorker(threading.Thread):
+    """Daemon thread that works through queued issuance jobs off the request path"""
+
+    def __init__(self, logger=None, interval=ISSUANCE_POLL_INTERVAL):
+        threading.Thread.__init__(self, name="token-issuance-worker", daemon=True)
+        self.logger = logger
+        self.interval = interval
+        self.wakeup = threading.Event()
+
+    def wake(self):
+        self.wakeup.set()
+
+    def connect(self):
+        config_stream = open("config.json", "r")
+        config_data = json.load(config_stream)
+        config_stream.close()
+        return MySQLdb.connect(config_data["mysql_host"],
+                               config_data["mysql_user"],
+                               config_data["mysql_password"],
+                               config_data["mysql_database"])
+
+    def run(self):
+        issuance = None
+        while True:
+            try:
+                if issuance is None:
+                    issuance = TokenIssuance(self.connect(), self.logger)
+                issuance.db.ping()
+                job = issuance.claim_job()
+                while job:
+                    if self.logger:
+                        self.logger.info("Issuing tokens for job {0}: {1} of {2} issued.".format(job["job_id"],
+                                                                                               job["issued"],
+                                                                                               job["requested"]))
+                    if not issuance.run_job(job["job_id"]):
+                        break
+                    job = issuance.claim_job()
+            except MySQLdb.Error as e:
+                if self.logger:
+                    self.logger.error("Token issuance worker: %s" % (str(e),))
+                # reconnect on the next pass
+                issuance = None
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+
+issuance_worker = None
+
+
+def start_issuance_worker(logger=None):
+    """Starts this worker's background issuance thread, once"""
+    global issuance_worker
+    if issuance_worker is None:
+        issuance_worker = TokenIssuanceWorker(logger)
+        issuance_worker.start()
+    return issuance_worker